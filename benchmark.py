@@ -0,0 +1,554 @@
+"""
+⏱️ Benchmark offline - Observer Bot
+Mide el rendimiento de Observer sin servidor de Discord ni clave de API:
+- Servidor, canales de texto, foros e hilos falsos en memoria, con historial
+  de tamaño y latencia configurables
+- Endpoint local de chat completions con latencia y tasa de errores
+  configurables
+- Tiempos por etapa y pico de memoria (tracemalloc) de cada escenario
+
+Los resultados se guardan en JSON (benchmark_resultados/) para comparar
+entre commits:
+
+    python benchmark.py                                  # todos los escenarios
+    python benchmark.py --escenarios mensajes_2000 servidor_300
+    python benchmark.py --comparar benchmark_resultados/anterior.json
+
+Nota: tracemalloc ralentiza Python; los tiempos solo son comparables entre
+ejecuciones del propio benchmark.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import discord
+from aiohttp import web
+
+# bot.py exige credenciales al importarse; aquí no se conecta a nada real
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+import bot
+
+DIRECTORIO_REPO = os.path.dirname(os.path.abspath(__file__))
+DIRECTORIO_RESULTADOS = os.path.join(DIRECTORIO_REPO, 'benchmark_resultados')
+INICIO_HISTORIAL = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# ============= DISCORD FALSO =============
+# Subclases de los tipos de discord.py (sin su __init__) para que pasen los
+# isinstance del bot; solo se rellenan los atributos que usa Observer.
+
+class PermisosFalsos:
+    read_message_history = True
+
+class CategoriaFalsa:
+    def __init__(self, nombre: str):
+        self.name = nombre
+
+class AutorFalso:
+    __slots__ = ('name', 'id', 'bot')
+
+    def __init__(self, nombre: str, autor_id: int, es_bot: bool):
+        self.name = nombre
+        self.id = autor_id
+        self.bot = es_bot
+
+class MensajeFalso:
+    __slots__ = ('id', 'channel', 'guild', 'author', 'content', 'webhook_id', 'created_at')
+
+    def __init__(self, canal, indice: int):
+        self.channel = canal
+        self.guild = canal.guild
+        self.created_at = INICIO_HISTORIAL + timedelta(seconds=30 * indice)
+        self.id = discord.utils.time_snowflake(self.created_at)
+
+        # Reparto aproximado de un canal de rol: mitad Tupperbox, algo de bots
+        semilla = (canal.id + indice) % 20
+        if semilla < 10:
+            self.author = canal.personajes[semilla % len(canal.personajes)]
+            self.webhook_id = 1
+        elif semilla < 11:
+            self.author = canal.bots[0]
+            self.webhook_id = None
+        else:
+            self.author = canal.usuarios[semilla % len(canal.usuarios)]
+            self.webhook_id = None
+        self.content = (f"{self.author.name} mensaje {indice}: *avanza por la taberna y mira a su "
+                        f"alrededor* " + "lorem ipsum " * (indice % 7))
+
+class HistorialFalso:
+    """Historial generado bajo demanda: solo se guarda la cantidad de mensajes"""
+    def _iniciar_historial(self, cantidad: int, latencia: float):
+        self.cantidad = cantidad
+        self.latencia = latencia  # Segundos por página de 100 mensajes
+        self.personajes = [AutorFalso(f"Personaje {self.id % 97}-{i}", 9000 + i, True) for i in range(6)]
+        self.usuarios = [AutorFalso(f"usuario{i}", 1000 + i, False) for i in range(5)]
+        self.bots = [AutorFalso("BotMúsica", 500, True)]
+        self.last_message_id = MensajeFalso(self, cantidad - 1).id if cantidad else None
+
+    def agregar_mensajes(self, cantidad: int) -> list:
+        """Simula mensajes nuevos y los devuelve (para pasarlos a on_message)"""
+        nuevos = [MensajeFalso(self, i) for i in range(self.cantidad, self.cantidad + cantidad)]
+        self.cantidad += cantidad
+        self.last_message_id = nuevos[-1].id if nuevos else self.last_message_id
+        return nuevos
+
+    def permissions_for(self, miembro):
+        return PermisosFalsos()
+
+    def history(self, limit=100, before=None, after=None, oldest_first=None):
+        return self._historial(limit, before, after, oldest_first)
+
+    async def _historial(self, limit, before, after, oldest_first):
+        if oldest_first is None:
+            oldest_first = after is not None
+        # Los ids crecen con el índice, así que los límites se traducen a índices
+        desde = self._indice_de(after.id, posterior=True) if after is not None else 0
+        hasta = self._indice_de(before.id, posterior=False) if before is not None else self.cantidad
+
+        indices = range(desde, hasta) if oldest_first else range(hasta - 1, desde - 1, -1)
+        for entregados, indice in enumerate(indices):
+            if limit is not None and entregados >= limit:
+                break
+            if entregados % 100 == 0 and self.latencia:
+                await asyncio.sleep(self.latencia)
+            yield MensajeFalso(self, indice)
+
+    def _indice_de(self, message_id: int, posterior: bool) -> int:
+        """Primer índice con id mayor (posterior=True) o mayor o igual que message_id"""
+        milisegundos = (message_id >> 22) + discord.utils.DISCORD_EPOCH - int(INICIO_HISTORIAL.timestamp() * 1000)
+        indice = milisegundos // 30000 + 1 if posterior else -(-milisegundos // 30000)
+        return min(self.cantidad, max(0, indice))
+
+    async def archived_threads(self, *, limit=None, before=None, private=False, joined=False):
+        return
+        yield
+
+class CanalTextoFalso(HistorialFalso, discord.TextChannel):
+    def __init__(self, guild, canal_id: int, nombre: str, categoria, cantidad: int, latencia: float):
+        self.guild = guild
+        self.id = canal_id
+        self.name = nombre
+        self.categoria = categoria
+        self._iniciar_historial(cantidad, latencia)
+
+    @property
+    def category(self):
+        return self.categoria
+
+    @property
+    def threads(self):
+        return []
+
+class HiloFalso(HistorialFalso, discord.Thread):
+    def __init__(self, guild, foro, hilo_id: int, nombre: str, cantidad: int, latencia: float, archivado: bool = False):
+        self.guild = guild
+        self.id = hilo_id
+        self.name = nombre
+        self.foro = foro
+        self.parent_id = foro.id
+        self.archived = archivado
+        self.archive_timestamp = discord.utils.utcnow() - timedelta(days=1) if archivado else None
+        self.message_count = cantidad
+        self._iniciar_historial(cantidad, latencia)
+
+    @property
+    def category(self):
+        return self.foro.categoria
+
+    @property
+    def created_at(self):
+        return INICIO_HISTORIAL
+
+class ForoFalso(discord.ForumChannel):
+    def __init__(self, guild, foro_id: int, nombre: str, categoria):
+        self.guild = guild
+        self.id = foro_id
+        self.name = nombre
+        self.categoria = categoria
+        self.last_message_id = None
+        self.activos = []
+        self.archivados = []
+
+    @property
+    def category(self):
+        return self.categoria
+
+    @property
+    def threads(self):
+        return self.activos
+
+    def permissions_for(self, miembro):
+        return PermisosFalsos()
+
+    def get_thread(self, thread_id):
+        return next((h for h in self.activos if h.id == thread_id), None)
+
+    async def archived_threads(self, *, limit=None, before=None, private=False, joined=False):
+        for thread in self.archivados:
+            yield thread
+
+class ServidorFalso:
+    """Stand-in de discord.Guild con canales de texto, foros e hilos"""
+    def __init__(self, nombre: str = "Servidor de prueba", guild_id: int = 4242):
+        self.id = guild_id
+        self.name = nombre
+        self.me = object()
+        self.text_channels = []
+        self.forums = []
+        self._siguiente_id = guild_id * 1000
+
+    def _nuevo_id(self) -> int:
+        self._siguiente_id += 1
+        return self._siguiente_id
+
+    def crear_canal(self, nombre: str, mensajes: int, latencia: float, categoria=None) -> CanalTextoFalso:
+        canal = CanalTextoFalso(self, self._nuevo_id(), nombre, categoria, mensajes, latencia)
+        self.text_channels.append(canal)
+        return canal
+
+    def crear_foro(self, nombre: str, hilos: int, mensajes: int, latencia: float, archivados: int = 0,
+                   categoria=None) -> ForoFalso:
+        foro = ForoFalso(self, self._nuevo_id(), nombre, categoria)
+        for i in range(hilos + archivados):
+            hilo = HiloFalso(self, foro, self._nuevo_id(), f"Casa {i}", mensajes, latencia, archivado=i >= hilos)
+            (foro.archivados if hilo.archived else foro.activos).append(hilo)
+        self.forums.append(foro)
+        return foro
+
+    @property
+    def threads(self):
+        return [hilo for foro in self.forums for hilo in foro.activos]
+
+    def get_channel(self, channel_id):
+        return next((c for c in (*self.text_channels, *self.forums) if c.id == channel_id), None)
+
+    def get_thread(self, thread_id):
+        return next((h for h in self.threads if h.id == thread_id), None)
+
+    def get_channel_or_thread(self, channel_id):
+        return self.get_channel(channel_id) or self.get_thread(channel_id)
+
+# ============= IA FALSA =============
+
+class ServidorIAFalso:
+    """Endpoint /v1/chat/completions local con latencia y errores inyectados"""
+    def __init__(self, latencia: float, tasa_errores: float, semilla: int = 1234):
+        self.latencia = latencia
+        self.tasa_errores = tasa_errores
+        self.azar = random.Random(semilla)
+        self.peticiones = 0
+        self.errores_inyectados = 0
+        self._runner = None
+        self.url = None
+
+    async def _completar(self, request: web.Request) -> web.Response:
+        cuerpo = await request.json()
+        self.peticiones += 1
+        await asyncio.sleep(self.latencia)
+
+        if self.azar.random() < self.tasa_errores:
+            self.errores_inyectados += 1
+            # Mitad límite de tasa, mitad error del proveedor (ambos se reintentan)
+            estado = 429 if self.azar.random() < 0.5 else 503
+            return web.json_response({'error': {'message': 'error simulado'}}, status=estado,
+                                     headers={'retry-after': '0.1'})
+
+        prompt = cuerpo['messages'][-1]['content']
+        huella = hashlib.sha256(prompt.encode()).hexdigest()[:6]
+        contenido = {
+            'resumen': f"Escena {huella}: los personajes se reúnen en la taberna",
+            'temas': ['roleplay', f'trama {huella[:2]}'],
+            'proposito_canal': 'roleplay',
+            'elementos_mundo': ['Taberna del Dragón', f'Reliquia {huella[:3]}'],
+            'eventos': [{
+                'tipo': 'encuentro',
+                'descripcion': f"Encuentro {huella} en la taberna",
+                'participantes': ['Personaje 1-0', 'Personaje 1-1'],
+                'importancia': 'alta' if int(huella, 16) % 3 == 0 else 'media',
+                'mensaje': 1
+            }]
+        }
+        tokens_prompt = len(prompt) // 3
+        return web.json_response({
+            'choices': [{'message': {'role': 'assistant', 'content': json.dumps(contenido, ensure_ascii=False)}}],
+            'usage': {'prompt_tokens': tokens_prompt, 'completion_tokens': 150, 'total_tokens': tokens_prompt + 150}
+        })
+
+    async def iniciar(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self._completar)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        sitio = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await sitio.start()
+        puerto = sitio._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{puerto}/v1"
+
+    async def detener(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+# ============= MEDICIÓN =============
+
+class Medidor:
+    """Tiempos y picos de memoria por etapa de un escenario"""
+    def __init__(self):
+        self.etapas = {}
+        self.internas = {}  # {método: {'segundos', 'llamadas'}}
+        self.pico_absoluto = 0  # reset_peak() borra el pico global; se conserva aquí
+
+    @contextlib.asynccontextmanager
+    async def etapa(self, nombre: str):
+        memoria_inicial = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            duracion = time.perf_counter() - inicio
+            pico = tracemalloc.get_traced_memory()[1]
+            self.pico_absoluto = max(self.pico_absoluto, pico)
+            self.etapas[nombre] = {
+                'segundos': round(duracion, 4),
+                'pico_memoria_kb': round((pico - memoria_inicial) / 1024, 1)
+            }
+
+    def envolver(self, objeto, metodo: str, nombre: str = None):
+        """Acumula el tiempo de un método asíncrono del bot (solo en esta instancia)"""
+        original = getattr(objeto, metodo)
+        registro = self.internas.setdefault(nombre or metodo, {'segundos': 0.0, 'llamadas': 0})
+
+        async def medido(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                registro['segundos'] += time.perf_counter() - inicio
+                registro['llamadas'] += 1
+
+        setattr(objeto, metodo, medido)
+
+    def resultado(self) -> dict:
+        return {
+            'etapas': self.etapas,
+            'internas': {k: {'segundos': round(v['segundos'], 4), 'llamadas': v['llamadas']}
+                         for k, v in self.internas.items()}
+        }
+
+def preparar_observer(ia: ServidorIAFalso, medidor: Medidor) -> 'bot.ObserverBot':
+    observer = bot.ObserverBot()
+    analizador = observer.analyzer
+    analizador.llm = bot.ClienteLLM('benchmark', base_url=ia.url)
+    # El proveedor falso no tiene límites; el limitador no debe dominar los tiempos
+    analizador.llm.limitador = bot.LimitadorTasa(10 ** 6, 10 ** 9)
+
+    medidor.envolver(analizador, '_recolectar_y_analizar', 'lectura_e_ia')
+    medidor.envolver(analizador, '_reducir_resumenes', 'reduccion_resumenes')
+    medidor.envolver(analizador, 'detectar_canales_relacionados', 'hilos_relacionados')
+    medidor.envolver(analizador.analisis_cache, 'guardar', 'guardar_cache')
+    medidor.envolver(analizador.llm, 'completar', 'llamadas_ia')
+    return observer
+
+# ============= ESCENARIOS =============
+
+async def escenario_canal(args, ia: ServidorIAFalso, medidor: Medidor, mensajes: int) -> dict:
+    """Un canal de texto: análisis inicial, incremental, desde caché y embed"""
+    guild = ServidorFalso()
+    canal = guild.crear_canal('🎭・rol-principal', mensajes, args.latencia_discord, CategoriaFalsa('Rol'))
+    observer = preparar_observer(ia, medidor)
+    analizador = observer.analyzer
+    # Sin tope de mensajes: el escenario debe leer el historial completo
+    bot.LIMITE_MENSAJES = max(mensajes, 1)
+
+    try:
+        async with medidor.etapa('analisis_inicial'):
+            analisis = await analizador.analizar_canal(canal)
+
+        nuevos = canal.agregar_mensajes(max(1, mensajes // 100))
+        async with medidor.etapa('registrar_mensajes_nuevos'):
+            for msg in nuevos:
+                await analizador.espejo.registrar(msg)
+
+        async with medidor.etapa('analisis_incremental'):
+            analisis = await analizador.analizar_canal(canal, refrescar=True)
+
+        async with medidor.etapa('analisis_desde_cache'):
+            analisis = await analizador.analizar_canal(canal)
+
+        async with medidor.etapa('crear_embed'):
+            observer.crear_embed_analisis(analisis)
+
+        return {
+            'mensajes': mensajes,
+            'mensajes_analizados': analisis.get('mensajes_analizados'),
+            'eventos': analisis.get('num_eventos')
+        }
+    finally:
+        await analizador.llm.cerrar()
+
+async def escenario_servidor(args, ia: ServidorIAFalso, medidor: Medidor, canales: int) -> dict:
+    """Servidor grande: mapeo, búsquedas, lote de todos los canales y foro completo"""
+    guild = ServidorFalso()
+    categorias = [CategoriaFalsa(f"Zona {i}") for i in range(max(1, canales // 30))]
+    for i in range(canales):
+        guild.crear_canal(f"canal-{i}-{'taberna' if i % 3 else 'mercado'}", args.mensajes_por_canal,
+                          args.latencia_discord, categorias[i % len(categorias)])
+    foro = guild.crear_foro('residencias', hilos=20, mensajes=args.mensajes_por_canal,
+                            latencia=args.latencia_discord, archivados=10, categoria=categorias[0])
+    observer = preparar_observer(ia, medidor)
+    analizador = observer.analyzer
+    bot.LIMITE_MENSAJES = 2000
+
+    try:
+        async with medidor.etapa('mapear_servidor'):
+            await analizador.mapear_servidor(guild)
+
+        consultas = [f"canal {i} taberna" for i in range(0, canales, 3)] + ['mercdo', 'residencias', 'zona 3']
+        async with medidor.etapa('buscar_canal'):
+            for consulta in consultas:
+                analizador.buscar_canal(guild.id, consulta)
+
+        canales_info = [c for c in analizador.canales_mapeados[guild.id].values() if c.tipo != 'foro']
+        async with medidor.etapa('analizar_lote'):
+            lote = await analizador.analizar_lote(guild, canales_info)
+
+        async with medidor.etapa('crear_embed_lote'):
+            observer.crear_embed_lote(lote, guild.name)
+
+        async with medidor.etapa('analizar_foro'):
+            informe = await analizador.analizar_foro(foro)
+
+        async with medidor.etapa('crear_embed_foro'):
+            observer.crear_embed_foro(informe)
+
+        return {
+            'canales': canales,
+            'mensajes_por_canal': args.mensajes_por_canal,
+            'canales_analizados': len(lote['canales']),
+            'errores_lote': len(lote['errores']),
+            'hilos_foro': informe['hilos_analizados']
+        }
+    finally:
+        await analizador.llm.cerrar()
+
+ESCENARIOS = {
+    'mensajes_10': lambda args, ia, m: escenario_canal(args, ia, m, 10),
+    'mensajes_2000': lambda args, ia, m: escenario_canal(args, ia, m, 2000),
+    'mensajes_100k': lambda args, ia, m: escenario_canal(args, ia, m, 100_000),
+    'servidor_300': lambda args, ia, m: escenario_servidor(args, ia, m, 300),
+}
+
+async def ejecutar_escenario(nombre: str, args) -> dict:
+    ia = ServidorIAFalso(args.latencia_ia, args.errores_ia)
+    await ia.iniciar()
+    medidor = Medidor()
+    directorio_original = os.getcwd()
+
+    # Cada escenario empieza sin cachés ni copia local
+    with tempfile.TemporaryDirectory(prefix='observer_bench_') as directorio:
+        os.chdir(directorio)
+        salida = io.StringIO()
+        tracemalloc.start()
+        inicio = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else salida):
+                datos = await ESCENARIOS[nombre](args, ia, medidor)
+        finally:
+            duracion = time.perf_counter() - inicio
+            pico_total = max(medidor.pico_absoluto, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            os.chdir(directorio_original)
+            await ia.detener()
+
+    return {
+        **datos,
+        **medidor.resultado(),
+        'segundos_total': round(duracion, 4),
+        'pico_memoria_kb': round(pico_total / 1024, 1),
+        'peticiones_ia': ia.peticiones,
+        'errores_ia_inyectados': ia.errores_inyectados
+    }
+
+# ============= RESULTADOS =============
+
+def commit_actual() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DIRECTORIO_REPO,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconocido'
+
+def imprimir_escenario(nombre: str, resultado: dict, anterior: dict = None):
+    print(f"\n📊 {nombre}: {resultado['segundos_total']:.2f} s • pico {resultado['pico_memoria_kb'] / 1024:.1f} MB • "
+          f"{resultado['peticiones_ia']} peticiones IA ({resultado['errores_ia_inyectados']} errores inyectados)")
+    for etapa, valores in resultado['etapas'].items():
+        linea = f"   {etapa:<28} {valores['segundos']:>9.3f} s {valores['pico_memoria_kb'] / 1024:>9.1f} MB"
+        previo = (anterior or {}).get('etapas', {}).get(etapa)
+        if previo and previo['segundos']:
+            linea += f"   ({(valores['segundos'] / previo['segundos'] - 1) * 100:+.0f}% tiempo)"
+        print(linea)
+    for metodo, valores in resultado['internas'].items():
+        print(f"     · {metodo:<26} {valores['segundos']:>9.3f} s  ({valores['llamadas']} llamadas)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline de Observer")
+    parser.add_argument('--escenarios', nargs='+', choices=list(ESCENARIOS), default=list(ESCENARIOS))
+    parser.add_argument('--latencia-discord', type=float, default=0.01,
+                        help="segundos por página de 100 mensajes del historial (por defecto 0.01)")
+    parser.add_argument('--latencia-ia', type=float, default=0.05,
+                        help="segundos por respuesta de la IA falsa (por defecto 0.05)")
+    parser.add_argument('--errores-ia', type=float, default=0.02,
+                        help="fracción de peticiones a la IA que fallan con 429/503 (por defecto 0.02)")
+    parser.add_argument('--mensajes-por-canal', type=int, default=50,
+                        help="mensajes de cada canal en servidor_300 (por defecto 50)")
+    parser.add_argument('--comparar', help="JSON de una ejecución anterior para mostrar diferencias")
+    parser.add_argument('--salida', help="ruta del JSON de resultados")
+    parser.add_argument('--verbose', action='store_true', help="mostrar la salida del bot")
+    args = parser.parse_args()
+
+    anterior = {}
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anterior = json.load(f).get('escenarios', {})
+
+    commit = commit_actual()
+    resultados = {
+        'commit': commit,
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'discord_py': discord.__version__,
+        'parametros': {k: v for k, v in vars(args).items() if k not in ('comparar', 'salida', 'verbose')},
+        'escenarios': {}
+    }
+
+    print(f"⏱️ Benchmark de Observer (commit {commit})")
+    for nombre in args.escenarios:
+        resultado = asyncio.run(ejecutar_escenario(nombre, args))
+        resultados['escenarios'][nombre] = resultado
+        imprimir_escenario(nombre, resultado, anterior.get(nombre))
+
+    ruta = args.salida or os.path.join(
+        DIRECTORIO_RESULTADOS, f"benchmark_{datetime.now():%Y%m%d_%H%M%S}_{commit}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump(resultados, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultados guardados en {ruta}")
+
+
+if __name__ == "__main__":
+    main()
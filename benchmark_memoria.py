@@ -0,0 +1,75 @@
+"""
+📏 Benchmark de memoria - Observer Bot
+Compara lo que ocupa cada mensaje del historial en memoria: el diccionario
+que se usaba antes (strings, datetime y URL ya construida) frente a
+RegistroMensaje (__slots__, ids enteros, epoch y autor internado).
+
+Uso: python benchmark_memoria.py [cantidades...]   (por defecto 2000 y 100000)
+"""
+
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+
+# bot.py exige credenciales al importarse; el benchmark no se conecta a nada
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from bot import RegistroMensaje, url_mensaje
+
+GUILD_ID = 712345678901234567
+CHANNEL_ID = 812345678901234567
+PRIMER_MENSAJE_ID = 1212345678901234567
+AUTORES = [f"Personaje {i}" for i in range(12)]  # Pocos autores que se repiten, como en un canal de rol
+
+
+def filas(cantidad: int):
+    """Filas tal como salen de la copia local (SQLite)"""
+    for i in range(cantidad):
+        # Strings nuevos en cada fila, como los que devuelve sqlite3
+        autor = ''.join(AUTORES[i % len(AUTORES)])
+        yield (GUILD_ID, CHANNEL_ID, PRIMER_MENSAJE_ID + i, autor, 1000 + i % len(AUTORES),
+               0, 1, f"Mensaje de rol número {i}: *camina hacia la taberna*", 1700000000.0 + i * 30)
+
+
+def como_diccionario(guild_id, channel_id, message_id, autor, autor_id, es_bot, es_webhook, contenido, timestamp):
+    """Representación anterior de cada mensaje"""
+    return {
+        'id': message_id,
+        'autor': autor,
+        'autor_id': autor_id,
+        'es_bot': bool(es_bot),
+        'es_webhook': bool(es_webhook),
+        'contenido': contenido,
+        'timestamp': datetime.fromtimestamp(timestamp, tz=timezone.utc),
+        'url': url_mensaje(guild_id, channel_id, message_id)
+    }
+
+
+def medir(construir, cantidad: int) -> int:
+    """Bytes retenidos por `cantidad` mensajes (sin contar las filas de origen)"""
+    datos = list(filas(cantidad))
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    mensajes = [construir(*fila) for fila in datos]
+    despues = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del mensajes
+    # Lo que ya ocupaban las filas (contenido, ids) no cuenta para ninguno
+    return despues - antes
+
+
+def main():
+    cantidades = [int(c) for c in sys.argv[1:]] or [2000, 100000]
+    print(f"{'Mensajes':>10} | {'Diccionario':>14} | {'RegistroMensaje':>16} | {'Ahorro':>7}")
+    print('-' * 58)
+    for cantidad in cantidades:
+        anterior = medir(como_diccionario, cantidad)
+        nuevo = medir(RegistroMensaje, cantidad)
+        print(f"{cantidad:>10,} | {anterior / 1024:>11,.0f} KB | {nuevo / 1024:>13,.0f} KB | {1 - nuevo / anterior:>6.0%}")
+        print(f"{'':>10} | {anterior / cantidad:>9,.0f} B/msg | {nuevo / cantidad:>10,.0f} B/msg |")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,23 @@ Versión con botones interactivos para navegación fluida
 import discord
 from discord.ext import commands
 import asyncio
-import openai
+import contextvars
+import csv
+import difflib
+import gzip
+import io
 import os
+import hashlib
 import json
 import re
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing, contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
 from dotenv import load_dotenv
 import unicodedata
 
@@ -27,8 +38,90 @@ if not DISCORD_TOKEN or not OPENAI_API_KEY:
     print("OPENAI_API_KEY=tu_api_key_aqui")
     exit(1)
 
-# Configurar OpenAI
-openai.api_key = OPENAI_API_KEY
+# Mensajes máximos leídos por canal y eventos conservados entre actualizaciones
+LIMITE_MENSAJES = 2000
+MAX_EVENTOS_GUARDADOS = 500
+
+# Modelo de IA y versión de los prompts (cambiarla invalida las respuestas en caché)
+MODELO_IA = os.getenv('OBSERVER_MODELO', 'gpt-3.5-turbo')
+VERSION_PROMPT_CHUNK = 3
+VERSION_PROMPT_REDUCCION = 1
+
+# Presupuesto de tokens por llamada (prompt completo) y máximo por mensaje
+PRESUPUESTO_TOKENS_CHUNK = int(os.getenv('OBSERVER_PRESUPUESTO_TOKENS_CHUNK', '4000'))
+MAX_TOKENS_MENSAJE = int(os.getenv('OBSERVER_MAX_TOKENS_MENSAJE', '400'))
+
+# Uno de cada N mensajes (elegido por su id) cierra siempre su chunk, para que
+# los límites entre chunks no cambien al llegar mensajes nuevos
+MENSAJES_POR_ANCLA = max(1, int(os.getenv('OBSERVER_MENSAJES_POR_ANCLA', '128')))
+
+# Reducción jerárquica de resúmenes: parciales combinados por llamada y
+# máximo de resúmenes parciales conservados entre actualizaciones
+REDUCCION_GRUPO = max(2, int(os.getenv('OBSERVER_REDUCCION_GRUPO', '4')))
+MAX_RESUMENES_PARCIALES = 64
+
+# Segundos mínimos entre ediciones de un mismo mensaje de progreso
+INTERVALO_PROGRESO = float(os.getenv('OBSERVER_INTERVALO_PROGRESO', '2'))
+
+# Datos persistentes (bases SQLite bajo observer_data/db)
+DIRECTORIO_DATOS = 'observer_data'
+DIRECTORIO_DB = os.path.join(DIRECTORIO_DATOS, 'db')
+
+# Caché de análisis: vigencia y entradas máximas en memoria y en disco
+CACHE_TTL_MINUTOS = int(os.getenv('OBSERVER_CACHE_TTL_MINUTOS', '30'))
+CACHE_MAX_MEMORIA = int(os.getenv('OBSERVER_CACHE_MAX_MEMORIA', '200'))
+CACHE_MAX_DISCO = int(os.getenv('OBSERVER_CACHE_MAX_DISCO', '5000'))
+
+# Caché de respuestas de la IA (tamaño máximo en disco)
+CACHE_IA_MAX_MB = float(os.getenv('OBSERVER_CACHE_IA_MAX_MB', '50'))
+
+# Consumo de la IA: precio en USD por millón de tokens y presupuesto diario
+# de tokens por servidor (0 = sin límite). Al 80% se reduce el análisis y al
+# 100% solo se usan respuestas en caché.
+PRECIO_ENTRADA_1M = float(os.getenv('OBSERVER_PRECIO_ENTRADA_1M', '0.50'))
+PRECIO_SALIDA_1M = float(os.getenv('OBSERVER_PRECIO_SALIDA_1M', '1.50'))
+PRESUPUESTO_DIARIO_TOKENS = int(os.getenv('OBSERVER_PRESUPUESTO_DIARIO_TOKENS', '0'))
+UMBRAL_REDUCIDO = 0.8
+
+# Exportación del historial a CSV: filas y MB en disco máximos por parte, y
+# compresión gzip por defecto (se puede pedir también en el comando)
+EXPORTAR_FILAS_PARTE = int(os.getenv('OBSERVER_EXPORTAR_FILAS_PARTE', '50000'))
+EXPORTAR_MB_PARTE = float(os.getenv('OBSERVER_EXPORTAR_MB_PARTE', '20'))
+EXPORTAR_GZIP = os.getenv('OBSERVER_EXPORTAR_GZIP', '0') == '1'
+
+# Canales analizados a la vez en los análisis por lotes (categoría o servidor)
+CANALES_CONCURRENTES = max(1, int(os.getenv('OBSERVER_CANALES_CONCURRENTES', '3')))
+
+# Catálogo de hilos: días que se conservan los archivados y canales consultados a la vez
+DIAS_HILOS_ARCHIVADOS = int(os.getenv('OBSERVER_DIAS_HILOS_ARCHIVADOS', '30'))
+PADRES_CONCURRENTES = max(1, int(os.getenv('OBSERVER_PADRES_CONCURRENTES', '5')))
+
+# Precalentado: canales más consultados que se re-analizan en segundo plano antes
+# de que caduquen (0 lo desactiva), segundos entre revisiones y vida media (horas)
+# de la popularidad de un canal. Solo se usa la capacidad de la IA que sobra.
+PRECALENTAR_CANALES = int(os.getenv('OBSERVER_PRECALENTAR_CANALES', '10'))
+INTERVALO_PRECALENTADO = float(os.getenv('OBSERVER_INTERVALO_PRECALENTADO', '120'))
+VIDA_MEDIA_POPULARIDAD = float(os.getenv('OBSERVER_VIDA_MEDIA_POPULARIDAD', '24'))
+CAPACIDAD_LIBRE_PRECALENTADO = 0.5  # Fracción del límite por minuto que debe estar libre
+
+# Número máximo de partes analizadas con IA al mismo tiempo por canal
+CHUNKS_CONCURRENTES = max(1, int(os.getenv('OBSERVER_CHUNKS_CONCURRENTES', '4')))
+
+# Cliente de IA (API compatible con chat completions de OpenAI)
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+LLM_TIMEOUT_CONEXION = float(os.getenv('OBSERVER_LLM_TIMEOUT_CONEXION', '5'))
+LLM_TIMEOUT_LECTURA = float(os.getenv('OBSERVER_LLM_TIMEOUT_LECTURA', '15'))
+LLM_MAX_CONEXIONES = int(os.getenv('OBSERVER_LLM_MAX_CONEXIONES', '10'))
+LLM_MAX_KEEPALIVE = int(os.getenv('OBSERVER_LLM_MAX_KEEPALIVE', '5'))
+
+# Límites del proveedor de IA para todo el proceso (peticiones y tokens por minuto)
+LLM_PETICIONES_POR_MINUTO = int(os.getenv('OBSERVER_LLM_RPM', '500'))
+LLM_TOKENS_POR_MINUTO = int(os.getenv('OBSERVER_LLM_TPM', '90000'))
+LLM_REINTENTOS = int(os.getenv('OBSERVER_LLM_REINTENTOS', '4'))
+
+# Métricas: endpoint Prometheus solo en localhost (puerto 0 lo desactiva)
+METRICAS_PUERTO = int(os.getenv('OBSERVER_METRICAS_PUERTO', '9464'))
+METRICAS_VENTANA = 1024  # Duraciones recientes que se guardan por etapa para los percentiles
 
 # Importar httpx para requests asíncronos
 try:
@@ -40,18 +133,1153 @@ except ImportError:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "httpx"])
     import httpx
 
+# ============= MÉTRICAS =============
+
+class Metricas:
+    """Tiempos por etapa, contadores e indicadores del proceso.
+    
+    Cada etapa guarda sus últimas METRICAS_VENTANA duraciones (para p50/p95)
+    más el total y la cantidad acumulados; registrar una duración es O(1), así
+    que puede quedar activo en producción. Los percentiles solo se calculan
+    al consultarlos.
+    """
+    def __init__(self, ventana: int = METRICAS_VENTANA):
+        self.ventana = ventana
+        self.duraciones: Dict[str, deque] = {}
+        self.acumulados: Dict[str, List[float]] = {}  # {etapa: [cantidad, suma]}
+        self.contadores: Dict[Tuple[str, Tuple], float] = {}
+        self.indicadores: Dict[str, float] = {}
+        self.fuentes = []  # Funciones que devuelven {nombre: valor} al exportar
+        self._servidor = None
+        self._vigilante: Optional[asyncio.Task] = None
+    
+    def registrar(self, etapa: str, segundos: float):
+        if etapa not in self.duraciones:
+            self.duraciones[etapa] = deque(maxlen=self.ventana)
+            self.acumulados[etapa] = [0, 0.0]
+        self.duraciones[etapa].append(segundos)
+        acumulado = self.acumulados[etapa]
+        acumulado[0] += 1
+        acumulado[1] += segundos
+    
+    @contextmanager
+    def tramo(self, etapa: str):
+        """Mide el bloque (también si contiene awaits o lanza una excepción)"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(etapa, time.perf_counter() - inicio)
+    
+    def incrementar(self, nombre: str, valor: float = 1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        self.contadores[clave] = self.contadores.get(clave, 0) + valor
+    
+    def fijar(self, nombre: str, valor: float):
+        self.indicadores[nombre] = valor
+    
+    @contextmanager
+    def en_curso(self, nombre: str):
+        """Indicador de operaciones en marcha (sube al entrar, baja al salir)"""
+        self.indicadores[nombre] = self.indicadores.get(nombre, 0) + 1
+        try:
+            yield
+        finally:
+            self.indicadores[nombre] -= 1
+    
+    def percentiles(self, etapa: str) -> Dict[str, float]:
+        valores = sorted(self.duraciones.get(etapa, ()))
+        if not valores:
+            return {'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+        return {
+            'p50': valores[len(valores) // 2],
+            'p95': valores[min(len(valores) - 1, int(len(valores) * 0.95))],
+            'max': valores[-1]
+        }
+    
+    def resumen(self) -> Dict[str, Dict[str, float]]:
+        """{etapa: {p50, p95, max, cantidad}} de todas las etapas medidas"""
+        return {
+            etapa: {**self.percentiles(etapa), 'cantidad': self.acumulados[etapa][0]}
+            for etapa in sorted(self.duraciones)
+        }
+    
+    def texto_prometheus(self) -> str:
+        """Exportación en el formato de texto de Prometheus"""
+        lineas = ['# TYPE observer_etapa_segundos summary']
+        for etapa in sorted(self.duraciones):
+            percentiles = self.percentiles(etapa)
+            for cuantil, clave in (('0.5', 'p50'), ('0.95', 'p95')):
+                lineas.append(f'observer_etapa_segundos{{etapa="{etapa}",quantile="{cuantil}"}} {percentiles[clave]:.6f}')
+            cantidad, suma = self.acumulados[etapa]
+            lineas.append(f'observer_etapa_segundos_sum{{etapa="{etapa}"}} {suma:.6f}')
+            lineas.append(f'observer_etapa_segundos_count{{etapa="{etapa}"}} {cantidad}')
+        
+        nombres = sorted({nombre for nombre, _ in self.contadores})
+        for nombre in nombres:
+            lineas.append(f'# TYPE observer_{nombre}_total counter')
+            for (otro, etiquetas), valor in sorted(self.contadores.items()):
+                if otro == nombre:
+                    texto = ','.join(f'{k}="{v}"' for k, v in etiquetas)
+                    lineas.append(f'observer_{nombre}_total{{{texto}}} {valor:g}')
+        
+        indicadores = dict(self.indicadores)
+        for fuente in self.fuentes:
+            try:
+                indicadores.update(fuente())
+            except Exception as e:
+                print(f"⚠️ Error leyendo una fuente de métricas: {e}")
+        for nombre, valor in sorted(indicadores.items()):
+            lineas.append(f'# TYPE observer_{nombre} gauge')
+            lineas.append(f'observer_{nombre} {valor:g}')
+        return '\n'.join(lineas) + '\n'
+    
+    async def vigilar_event_loop(self, intervalo: float = 0.5):
+        """Mide cuánto se retrasa el event loop respecto a lo programado"""
+        while True:
+            inicio = time.perf_counter()
+            await asyncio.sleep(intervalo)
+            retraso = max(0.0, time.perf_counter() - inicio - intervalo)
+            self.registrar('retraso_event_loop', retraso)
+            self.fijar('retraso_event_loop_segundos', retraso)
+    
+    async def iniciar(self, puerto: int = METRICAS_PUERTO):
+        """Arranca la vigilancia del event loop y el endpoint /metrics en 127.0.0.1"""
+        if self._vigilante is None:
+            self._vigilante = asyncio.create_task(self.vigilar_event_loop())
+        if not puerto or self._servidor is not None:
+            return
+        
+        from aiohttp import web  # Dependencia de discord.py
+        
+        async def exportar(request):
+            return web.Response(text=self.texto_prometheus(), content_type='text/plain', charset='utf-8')
+        
+        app = web.Application()
+        app.router.add_get('/metrics', exportar)
+        self._servidor = web.AppRunner(app, access_log=None)
+        await self._servidor.setup()
+        try:
+            await web.TCPSite(self._servidor, '127.0.0.1', puerto).start()
+            print(f"📈 Métricas en http://127.0.0.1:{puerto}/metrics")
+        except OSError as e:
+            print(f"⚠️ No se pudo abrir el puerto de métricas {puerto}: {e}")
+            await self._servidor.cleanup()
+            self._servidor = None
+    
+    async def detener(self):
+        if self._vigilante:
+            self._vigilante.cancel()
+            self._vigilante = None
+        if self._servidor:
+            await self._servidor.cleanup()
+            self._servidor = None
+
+metricas = Metricas()
+
+# ============= CLIENTE IA =============
+
+# tiktoken es opcional: sin él se usa una estimación por caracteres
+try:
+    import tiktoken
+    _CODIFICADOR = tiktoken.get_encoding('cl100k_base')
+except Exception:
+    _CODIFICADOR = None
+
+def estimar_tokens(texto: str) -> int:
+    """Cuenta (o estima) los tokens de un texto"""
+    if _CODIFICADOR is not None:
+        return len(_CODIFICADOR.encode(texto, disallowed_special=()))
+    # Aproximación conservadora: ~3 caracteres por token en español
+    return (len(texto) + 2) // 3
+
+def recortar_a_tokens(texto: str, max_tokens: int) -> str:
+    """Recorta un texto largo conservando el inicio y el final"""
+    if estimar_tokens(texto) <= max_tokens:
+        return texto
+    
+    # Ajustar los caracteres conservados según la proporción tokens/caracteres
+    conservar = max(1, int(len(texto) * max_tokens / estimar_tokens(texto)) - 20)
+    inicio = texto[:conservar * 2 // 3]
+    final = texto[-(conservar // 3):] if conservar >= 3 else ''
+    omitidos = len(texto) - len(inicio) - len(final)
+    return f"{inicio} […{omitidos} caracteres omitidos…] {final}"
+
+class EmpaquetadorChunks:
+    """Agrupa mensajes en chunks que llenan un presupuesto de tokens.
+    
+    Respeta los límites entre mensajes y no descarta ninguno: los mensajes
+    que superan MAX_TOKENS_MENSAJE se recortan de forma explícita (se marca la
+    parte omitida) y el resto se envía completo.
+    """
+    def __init__(self, presupuesto: int, formatear):
+        self.presupuesto = presupuesto
+        self.formatear = formatear  # msg -> línea del prompt
+        self._actual = []
+        self._tokens = 0
+    
+    def agregar(self, msg: 'RegistroMensaje') -> Optional[List['RegistroMensaje']]:
+        """Agrega un mensaje; si ya no cabe, devuelve el chunk lleno anterior"""
+        tokens = estimar_tokens(self.formatear(msg)) + 1  # +1 por el salto de línea
+        if tokens > MAX_TOKENS_MENSAJE:
+            msg.contenido = recortar_a_tokens(msg.contenido, MAX_TOKENS_MENSAJE)
+            msg.recortado = True
+            tokens = estimar_tokens(self.formatear(msg)) + 1
+        
+        lleno = None
+        if self._actual and self._tokens + tokens > self.presupuesto:
+            lleno = self.vaciar()
+        self._actual.append(msg)
+        self._tokens += tokens
+        return lleno
+    
+    def vaciar(self) -> Optional[List['RegistroMensaje']]:
+        """Devuelve el chunk en curso (o None si está vacío)"""
+        chunk, self._actual, self._tokens = self._actual, [], 0
+        return chunk or None
+    
+    @staticmethod
+    def es_ancla(message_id: int) -> bool:
+        """Indica si el mensaje cierra siempre el chunk en el que entra.
+        
+        Depende solo del id (mezclado para no seguir los bits del snowflake),
+        así que el corte cae en el mismo sitio en cada lectura y los chunks
+        entre dos anclas se repiten idénticos aunque cambie el resto.
+        """
+        mezcla = (message_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return (mezcla >> 32) % MENSAJES_POR_ANCLA == 0
+
+class ErrorLLM(Exception):
+    """Error devuelto por la API de IA"""
+    def __init__(self, mensaje, status_code=None):
+        super().__init__(mensaje)
+        self.status_code = status_code
+
+# Análisis al que pertenecen las llamadas a la IA de la tarea actual (un
+# GrupoProgreso); el limitador lo consulta para saber si es de segundo plano
+analisis_actual = contextvars.ContextVar('analisis_actual', default=None)
+
+class LimitadorTasa:
+    """Token bucket global para las peticiones y los tokens por minuto de la IA.
+    
+    Cada llamada reserva 1 petición y sus tokens estimados antes de enviarse;
+    si no hay capacidad espera su turno (en orden de llegada) en lugar de
+    fallar. Guarda los tiempos de espera en cola para poder dimensionar la
+    concurrencia. Las llamadas de segundo plano (precalentado) no entran en
+    la cola mientras haya otras esperando o quede poca capacidad libre.
+    """
+    def __init__(self, peticiones_por_minuto: int = LLM_PETICIONES_POR_MINUTO,
+                 tokens_por_minuto: int = LLM_TOKENS_POR_MINUTO):
+        self.capacidad_peticiones = float(peticiones_por_minuto)
+        self.capacidad_tokens = float(tokens_por_minuto)
+        self._peticiones = self.capacidad_peticiones
+        self._tokens = self.capacidad_tokens
+        self._ultima_recarga = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._turno = asyncio.Lock()  # Los que esperan se atienden en orden
+        self.en_cola = 0
+        self.adquisiciones = 0
+        self.espera_total = 0.0
+        self.esperas = deque(maxlen=1000)  # Últimas esperas en segundos
+    
+    def _recargar(self):
+        ahora = time.monotonic()
+        transcurrido = ahora - self._ultima_recarga
+        self._ultima_recarga = ahora
+        self._peticiones = min(self.capacidad_peticiones, self._peticiones + transcurrido * self.capacidad_peticiones / 60)
+        self._tokens = min(self.capacidad_tokens, self._tokens + transcurrido * self.capacidad_tokens / 60)
+    
+    async def adquirir(self, tokens: int) -> float:
+        """Espera hasta poder enviar una petición de `tokens` tokens. Devuelve la espera"""
+        tokens = min(tokens, self.capacidad_tokens)  # Una petición enorme no debe esperar para siempre
+        inicio = time.monotonic()
+        origen = analisis_actual.get()
+        if origen is not None and origen.segundo_plano:
+            await self._esperar_capacidad_libre(origen, tokens)
+        self.en_cola += 1
+        try:
+            async with self._turno:
+                while True:
+                    self._recargar()
+                    pausa = self._pausa_hasta - time.monotonic()
+                    if pausa <= 0 and self._peticiones >= 1 and self._tokens >= tokens:
+                        self._peticiones -= 1
+                        self._tokens -= tokens
+                        break
+                    falta = max(
+                        pausa,
+                        (1 - self._peticiones) * 60 / self.capacidad_peticiones,
+                        (tokens - self._tokens) * 60 / self.capacidad_tokens
+                    )
+                    await asyncio.sleep(max(falta, 0.01))
+        finally:
+            self.en_cola -= 1
+        
+        espera = time.monotonic() - inicio
+        self.adquisiciones += 1
+        self.espera_total += espera
+        self.esperas.append(espera)
+        return espera
+    
+    async def _esperar_capacidad_libre(self, origen, tokens: int):
+        """Retiene una llamada de segundo plano hasta que sobre capacidad (o deje de serlo)"""
+        while origen.segundo_plano:
+            self._recargar()
+            reserva_tokens = min(self.capacidad_tokens, tokens + self.capacidad_tokens * CAPACIDAD_LIBRE_PRECALENTADO)
+            if (not self.en_cola and time.monotonic() >= self._pausa_hasta
+                    and self._peticiones >= self.capacidad_peticiones * CAPACIDAD_LIBRE_PRECALENTADO
+                    and self._tokens >= reserva_tokens):
+                return
+            await asyncio.sleep(0.25)
+    
+    def ajustar(self, tokens_estimados: int, tokens_reales: int):
+        """Corrige el cubo de tokens con el uso real informado por la API"""
+        self._tokens = min(self.capacidad_tokens, self._tokens + tokens_estimados - tokens_reales)
+    
+    def pausar(self, segundos: float):
+        """Detiene todas las peticiones (el proveedor respondió 429)"""
+        self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+    
+    def estadisticas(self) -> Dict:
+        esperas = sorted(self.esperas)
+        return {
+            'en_cola': self.en_cola,
+            'adquisiciones': self.adquisiciones,
+            'espera_media': self.espera_total / self.adquisiciones if self.adquisiciones else 0.0,
+            'espera_p95': esperas[int(len(esperas) * 0.95)] if esperas else 0.0,
+            'espera_max': esperas[-1] if esperas else 0.0
+        }
+
+class ClienteLLM:
+    """Cliente asíncrono de chat completions con un pool de conexiones compartido.
+    
+    Usa una sola instancia de httpx.AsyncClient (keep-alive) para todas las
+    llamadas. Al cancelar la corrutina (por ejemplo con asyncio.wait_for) se
+    cancela también la petición HTTP en curso. Todas las llamadas pasan por
+    un LimitadorTasa compartido y los 429/5xx se reintentan tras esperar.
+    """
+    def __init__(self, api_key: str, base_url: str = OPENAI_BASE_URL,
+                 timeout_conexion: float = LLM_TIMEOUT_CONEXION,
+                 timeout_lectura: float = LLM_TIMEOUT_LECTURA,
+                 max_conexiones: int = LLM_MAX_CONEXIONES,
+                 max_keepalive: int = LLM_MAX_KEEPALIVE):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = httpx.Timeout(timeout_lectura, connect=timeout_conexion)
+        self.limites = httpx.Limits(
+            max_connections=max_conexiones,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=30
+        )
+        self._http: Optional[httpx.AsyncClient] = None
+        self.limitador = LimitadorTasa()
+    
+    def _obtener_http(self) -> httpx.AsyncClient:
+        """Crea el cliente HTTP la primera vez que se usa (dentro del event loop)"""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={'Authorization': f'Bearer {self.api_key}'},
+                timeout=self.timeout,
+                limits=self.limites
+            )
+        return self._http
+    
+    async def completar(self, messages: List[Dict], model: str, temperature: float = 0.5,
+                        max_tokens: int = 800, timeout: Optional[float] = None) -> Dict:
+        """Hace una llamada a /chat/completions y devuelve el JSON de respuesta.
+        
+        El timeout se aplica a cada petición HTTP, no a la espera en la cola
+        del limitador.
+        """
+        with metricas.tramo('ia_llamada'):
+            return await self._completar(messages, model, temperature, max_tokens, timeout)
+    
+    async def _completar(self, messages: List[Dict], model: str, temperature: float,
+                         max_tokens: int, timeout: Optional[float]) -> Dict:
+        tokens_estimados = sum(estimar_tokens(m.get('content', '')) for m in messages) + max_tokens
+        
+        for intento in range(LLM_REINTENTOS + 1):
+            metricas.registrar('ia_espera_cola', await self.limitador.adquirir(tokens_estimados))
+            try:
+                with metricas.tramo('ia_peticion'):
+                    response = await asyncio.wait_for(self._obtener_http().post('/chat/completions', json={
+                        'model': model,
+                        'messages': messages,
+                        'temperature': temperature,
+                        'max_tokens': max_tokens
+                    }), timeout)
+            except httpx.TimeoutException as e:
+                metricas.incrementar('ia_respuestas', estado='timeout')
+                raise asyncio.TimeoutError(str(e)) from e
+            
+            metricas.incrementar('ia_respuestas', estado=response.status_code)
+            if response.status_code == 200:
+                datos = response.json()
+                tokens_reales = datos.get('usage', {}).get('total_tokens')
+                if tokens_reales is not None:
+                    self.limitador.ajustar(tokens_estimados, tokens_reales)
+                return datos
+            
+            # Límite de tasa o error temporal del proveedor: esperar y reintentar
+            if (response.status_code == 429 or response.status_code >= 500) and intento < LLM_REINTENTOS:
+                try:
+                    espera = float(response.headers.get('retry-after', ''))
+                except ValueError:
+                    espera = 2 ** intento
+                if response.status_code == 429:
+                    self.limitador.pausar(espera)
+                    print(f"⏳ Límite de tasa de la IA, reintentando en {espera:.1f}s...")
+                else:
+                    await asyncio.sleep(espera)
+                continue
+            
+            raise ErrorLLM(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+    
+    async def cerrar(self):
+        """Cierra el pool de conexiones"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+# ============= ALMACENAMIENTO =============
+
+class AlmacenSQLite:
+    """Base SQLite compartida por los almacenes persistentes.
+    
+    Usa una sola conexión protegida con un lock; los métodos asíncronos
+    ejecutan las consultas en un thread para no bloquear el event loop.
+    """
+    def __init__(self, ruta: str, esquema: str):
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False)
+        self._conexion.execute('PRAGMA journal_mode=WAL')
+        self._conexion.executescript(esquema)
+        self._conexion.commit()
+    
+    def ejecutar_sync(self, sql: str, params=()) -> List[tuple]:
+        with self._lock:
+            filas = self._conexion.execute(sql, params).fetchall()
+            self._conexion.commit()
+            return filas
+    
+    def ejecutar_muchos_sync(self, sql: str, filas) -> None:
+        with self._lock:
+            self._conexion.executemany(sql, filas)
+            self._conexion.commit()
+    
+    async def ejecutar(self, sql: str, params=()) -> List[tuple]:
+        return await asyncio.to_thread(self.ejecutar_sync, sql, params)
+    
+    async def ejecutar_muchos(self, sql: str, filas) -> None:
+        await asyncio.to_thread(self.ejecutar_muchos_sync, sql, list(filas))
+
+class CacheAnalisis:
+    """Caché de análisis en dos niveles: LRU en memoria y SQLite en disco.
+    
+    Un análisis es vigente si el canal no tiene mensajes nuevos desde que se
+    hizo (mismo último mensaje) o si su edad es menor que el TTL. Al reiniciar
+    el bot los análisis se recuperan del disco.
+    """
+    ESQUEMA = '''
+        CREATE TABLE IF NOT EXISTS analisis (
+            channel_id INTEGER PRIMARY KEY,
+            ultimo_mensaje_id INTEGER,
+            timestamp REAL NOT NULL,
+            datos TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_analisis_timestamp ON analisis (timestamp);
+    '''
+    
+    def __init__(self, ruta: str = os.path.join(DIRECTORIO_DB, 'analisis.db'),
+                 ttl_minutos: int = CACHE_TTL_MINUTOS,
+                 max_memoria: int = CACHE_MAX_MEMORIA,
+                 max_disco: int = CACHE_MAX_DISCO):
+        self.ttl_minutos = ttl_minutos
+        self.max_memoria = max_memoria
+        self.max_disco = max_disco
+        self.memoria: OrderedDict = OrderedDict()  # {channel_id: analisis_data}
+        self.disco = AlmacenSQLite(ruta, self.ESQUEMA)
+    
+    @staticmethod
+    def edad_minutos(datos: Dict) -> float:
+        """Minutos transcurridos desde que se hizo el análisis"""
+        tiempo_cache = datetime.fromisoformat(datos['timestamp_analisis'])
+        return (datetime.now() - tiempo_cache).total_seconds() / 60
+    
+    def es_vigente(self, datos: Dict, ultimo_mensaje_id: Optional[int] = None) -> bool:
+        """Indica si un análisis sigue siendo válido para el canal"""
+        if ultimo_mensaje_id and datos.get('ultimo_mensaje_id') == ultimo_mensaje_id:
+            return True  # Sin mensajes nuevos desde el análisis
+        return self.edad_minutos(datos) < self.ttl_minutos
+    
+    def _recordar(self, channel_id: int, datos: Dict):
+        self.memoria[channel_id] = datos
+        self.memoria.move_to_end(channel_id)
+        while len(self.memoria) > self.max_memoria:
+            self.memoria.popitem(last=False)
+    
+    async def obtener(self, channel_id: int) -> Optional[Dict]:
+        """Devuelve el último análisis del canal (vigente o no)"""
+        if channel_id in self.memoria:
+            self.memoria.move_to_end(channel_id)
+            return self.memoria[channel_id]
+        
+        filas = await self.disco.ejecutar('SELECT datos FROM analisis WHERE channel_id = ?', (channel_id,))
+        if not filas:
+            return None
+        
+        try:
+            datos = json.loads(filas[0][0])
+        except json.JSONDecodeError:
+            return None
+        self._recordar(channel_id, datos)
+        return datos
+    
+    async def guardar(self, channel_id: int, datos: Dict):
+        """Guarda un análisis en memoria y en disco"""
+        self._recordar(channel_id, datos)
+        timestamp = datetime.fromisoformat(datos['timestamp_analisis']).timestamp()
+        await self.disco.ejecutar(
+            'INSERT OR REPLACE INTO analisis (channel_id, ultimo_mensaje_id, timestamp, datos) VALUES (?, ?, ?, ?)',
+            (channel_id, datos.get('ultimo_mensaje_id'), timestamp, json.dumps(datos, ensure_ascii=False, default=str))
+        )
+        # Mantener acotado el tamaño en disco (se descartan los más antiguos)
+        await self.disco.ejecutar(
+            'DELETE FROM analisis WHERE channel_id NOT IN '
+            '(SELECT channel_id FROM analisis ORDER BY timestamp DESC LIMIT ?)',
+            (self.max_disco,)
+        )
+    
+    async def invalidar(self, channel_id: int):
+        """Elimina el análisis de un canal de ambos niveles"""
+        self.memoria.pop(channel_id, None)
+        await self.disco.ejecutar('DELETE FROM analisis WHERE channel_id = ?', (channel_id,))
+
+class CacheRespuestasIA:
+    """Caché en disco de respuestas de la IA, direccionado por contenido.
+    
+    La clave es un hash de todo lo que determina la respuesta (modelo, versión
+    del prompt, ids y contenido de los mensajes), así que un chunk sin cambios
+    nunca vuelve a la API. Al superar el tamaño máximo se descartan las
+    entradas usadas hace más tiempo.
+    """
+    ESQUEMA = '''
+        CREATE TABLE IF NOT EXISTS respuestas (
+            clave TEXT PRIMARY KEY,
+            respuesta TEXT NOT NULL,
+            tamano INTEGER NOT NULL,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            latencia REAL NOT NULL DEFAULT 0,
+            ultimo_uso REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_respuestas_uso ON respuestas (ultimo_uso);
+    '''
+    
+    def __init__(self, ruta: str = os.path.join(DIRECTORIO_DB, 'respuestas_ia.db'),
+                 max_mb: float = CACHE_IA_MAX_MB):
+        self.db = AlmacenSQLite(ruta, self.ESQUEMA)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.tamano_total = self.db.ejecutar_sync('SELECT COALESCE(SUM(tamano), 0) FROM respuestas')[0][0]
+        self.aciertos = 0
+        self.fallos = 0
+        self.tokens_ahorrados = 0
+        self.segundos_ahorrados = 0.0
+    
+    @staticmethod
+    def calcular_clave(*partes) -> str:
+        return hashlib.sha256(json.dumps(partes, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+    
+    async def obtener(self, clave: str) -> Optional[Dict]:
+        filas = await self.db.ejecutar('SELECT respuesta, tokens, latencia FROM respuestas WHERE clave = ?', (clave,))
+        if not filas:
+            self.fallos += 1
+            return None
+        
+        respuesta, tokens, latencia = filas[0]
+        self.aciertos += 1
+        self.tokens_ahorrados += tokens
+        self.segundos_ahorrados += latencia
+        await self.db.ejecutar('UPDATE respuestas SET ultimo_uso = ? WHERE clave = ?', (time.time(), clave))
+        return json.loads(respuesta)
+    
+    async def guardar(self, clave: str, respuesta: Dict, tokens: int = 0, latencia: float = 0.0):
+        texto = json.dumps(respuesta, ensure_ascii=False)
+        tamano = len(texto.encode())
+        filas = await self.db.ejecutar('SELECT tamano FROM respuestas WHERE clave = ?', (clave,))
+        await self.db.ejecutar(
+            'INSERT OR REPLACE INTO respuestas (clave, respuesta, tamano, tokens, latencia, ultimo_uso) VALUES (?, ?, ?, ?, ?, ?)',
+            (clave, texto, tamano, tokens, latencia, time.time())
+        )
+        self.tamano_total += tamano - (filas[0][0] if filas else 0)
+        
+        # Desalojar las entradas menos usadas hasta volver bajo el límite
+        while self.tamano_total > self.max_bytes:
+            await self.db.ejecutar(
+                'DELETE FROM respuestas WHERE clave IN (SELECT clave FROM respuestas ORDER BY ultimo_uso LIMIT 50)'
+            )
+            self.tamano_total = (await self.db.ejecutar('SELECT COALESCE(SUM(tamano), 0) FROM respuestas'))[0][0]
+    
+    def estadisticas(self) -> Dict:
+        consultas = self.aciertos + self.fallos
+        return {
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'tasa_aciertos': self.aciertos / consultas if consultas else 0.0,
+            'tokens_ahorrados': self.tokens_ahorrados,
+            'segundos_ahorrados': round(self.segundos_ahorrados, 1),
+            'tamano_mb': round(self.tamano_total / (1024 * 1024), 2)
+        }
+
+class RegistroConsumo:
+    """Tokens, latencia y costo de las llamadas a la IA (consumo.db).
+    
+    Se acumula por día (UTC), servidor, canal y modelo. El consumo del día de
+    cada servidor se mantiene en memoria para decidir el modo de análisis sin
+    consultar el disco.
+    """
+    ESQUEMA = '''
+        CREATE TABLE IF NOT EXISTS consumo (
+            dia TEXT NOT NULL,
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            modelo TEXT NOT NULL,
+            llamadas INTEGER NOT NULL,
+            tokens_entrada INTEGER NOT NULL,
+            tokens_salida INTEGER NOT NULL,
+            segundos REAL NOT NULL,
+            costo REAL NOT NULL,
+            PRIMARY KEY (dia, guild_id, channel_id, modelo)
+        );
+        CREATE TABLE IF NOT EXISTS presupuestos (
+            guild_id INTEGER PRIMARY KEY,
+            tokens INTEGER NOT NULL
+        );
+    '''
+    
+    def __init__(self, ruta: str = os.path.join(DIRECTORIO_DB, 'consumo.db'),
+                 presupuesto_diario: int = PRESUPUESTO_DIARIO_TOKENS):
+        self.db = AlmacenSQLite(ruta, self.ESQUEMA)
+        self.presupuesto_diario = presupuesto_diario
+        self.presupuestos = dict(self.db.ejecutar_sync('SELECT guild_id, tokens FROM presupuestos'))
+        self.dia = self.dia_actual()
+        self.tokens_hoy = dict(self.db.ejecutar_sync(
+            'SELECT guild_id, SUM(tokens_entrada + tokens_salida) FROM consumo WHERE dia = ? GROUP BY guild_id',
+            (self.dia,)
+        ))
+    
+    @staticmethod
+    def dia_actual() -> str:
+        return datetime.now(timezone.utc).date().isoformat()
+    
+    @staticmethod
+    def costo(tokens_entrada: int, tokens_salida: int) -> float:
+        return (tokens_entrada * PRECIO_ENTRADA_1M + tokens_salida * PRECIO_SALIDA_1M) / 1_000_000
+    
+    def _renovar_dia(self):
+        dia = self.dia_actual()
+        if dia != self.dia:
+            self.dia = dia
+            self.tokens_hoy = {}
+    
+    async def registrar(self, guild_id: int, channel_id: int, modelo: str, uso: Dict, segundos: float):
+        """Suma una llamada con el 'usage' devuelto por la API"""
+        self._renovar_dia()
+        entrada = uso.get('prompt_tokens', 0)
+        salida = uso.get('completion_tokens', 0)
+        self.tokens_hoy[guild_id] = self.tokens_hoy.get(guild_id, 0) + entrada + salida
+        metricas.incrementar('ia_tokens', entrada, tipo='entrada', modelo=modelo)
+        metricas.incrementar('ia_tokens', salida, tipo='salida', modelo=modelo)
+        await self.db.ejecutar(
+            'INSERT INTO consumo (dia, guild_id, channel_id, modelo, llamadas, tokens_entrada, tokens_salida, segundos, costo) '
+            'VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?) '
+            'ON CONFLICT (dia, guild_id, channel_id, modelo) DO UPDATE SET '
+            'llamadas = llamadas + 1, tokens_entrada = tokens_entrada + excluded.tokens_entrada, '
+            'tokens_salida = tokens_salida + excluded.tokens_salida, segundos = segundos + excluded.segundos, '
+            'costo = costo + excluded.costo',
+            (self.dia, guild_id, channel_id, modelo, entrada, salida, segundos, self.costo(entrada, salida))
+        )
+    
+    def presupuesto(self, guild_id: int) -> int:
+        """Tokens diarios permitidos al servidor (0 = sin límite)"""
+        return self.presupuestos.get(guild_id, self.presupuesto_diario)
+    
+    async def fijar_presupuesto(self, guild_id: int, tokens: int):
+        self.presupuestos[guild_id] = tokens
+        await self.db.ejecutar('INSERT OR REPLACE INTO presupuestos (guild_id, tokens) VALUES (?, ?)', (guild_id, tokens))
+    
+    def modo(self, guild_id: int) -> str:
+        """'normal', 'reducido' (cerca del límite) o 'solo_cache' (límite alcanzado)"""
+        self._renovar_dia()
+        presupuesto = self.presupuesto(guild_id)
+        if not presupuesto:
+            return 'normal'
+        usado = self.tokens_hoy.get(guild_id, 0) / presupuesto
+        if usado >= 1:
+            return 'solo_cache'
+        if usado >= UMBRAL_REDUCIDO:
+            return 'reducido'
+        return 'normal'
+    
+    async def mayores_consumidores(self, guild_id: Optional[int] = None, dias: int = 1, limite: int = 10) -> List[tuple]:
+        """[(guild_id, channel_id, llamadas, tokens, costo, segundos)] de los últimos `dias` días"""
+        desde = (datetime.now(timezone.utc).date() - timedelta(days=dias - 1)).isoformat()
+        filtro, params = ('AND guild_id = ?', (desde, guild_id, limite)) if guild_id else ('', (desde, limite))
+        return await self.db.ejecutar(
+            'SELECT guild_id, channel_id, SUM(llamadas), SUM(tokens_entrada + tokens_salida), SUM(costo), SUM(segundos) '
+            f'FROM consumo WHERE dia >= ? {filtro} GROUP BY guild_id, channel_id ORDER BY SUM(costo) DESC LIMIT ?',
+            params
+        )
+
+def url_mensaje(guild_id: int, channel_id: int, message_id: int) -> str:
+    """Construye el enlace a un mensaje sin necesitar el objeto de Discord"""
+    return f"https://discord.com/channels/{guild_id}/{channel_id}/{message_id}"
+
+class RegistroMensaje:
+    """Mensaje leído del historial, en forma compacta.
+    
+    Con __slots__, ids enteros y la fecha como epoch ocupa bastante menos que
+    un diccionario con datetime y URL. El nombre del autor se interna (se
+    repite en casi todos los mensajes) y la URL y la fecha se calculan solo
+    cuando se piden.
+    """
+    __slots__ = ('guild_id', 'channel_id', 'id', 'autor', 'autor_id', 'es_bot', 'es_webhook',
+                 'contenido', 'epoch', 'recortado')
+    
+    def __init__(self, guild_id: int, channel_id: int, message_id: int, autor: str, autor_id: int,
+                 es_bot, es_webhook, contenido: str, epoch: float):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.id = message_id
+        self.autor = sys.intern(autor)
+        self.autor_id = autor_id
+        self.es_bot = bool(es_bot)
+        self.es_webhook = bool(es_webhook)
+        self.contenido = contenido
+        self.epoch = epoch
+        self.recortado = False
+    
+    @property
+    def es_tupperbox(self) -> bool:
+        """Los mensajes de Tupperbox vienen de webhooks: el autor es el personaje"""
+        return self.es_webhook
+    
+    @property
+    def url(self) -> str:
+        return url_mensaje(self.guild_id, self.channel_id, self.id)
+    
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.epoch, tz=timezone.utc)
+
+class EspejoMensajes:
+    """Copia local (SQLite) del historial de mensajes de los canales analizados.
+    
+    Cada canal se descarga una vez (los últimos LIMITE_MENSAJES mensajes) y
+    luego se mantiene al día con history(after=ultimo_id) y con los eventos
+    en vivo de mensajes nuevos, editados y eliminados. Mientras el bot siga
+    conectado, un canal ya sincronizado no vuelve a consultar la API.
+    
+    La copia de cada canal es siempre continua: desde el mensaje más nuevo
+    hasta el más antiguo guardado no falta ninguno.
+    """
+    ESQUEMA = '''
+        CREATE TABLE IF NOT EXISTS mensajes (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            autor TEXT NOT NULL,
+            autor_id INTEGER,
+            es_bot INTEGER NOT NULL DEFAULT 0,
+            es_webhook INTEGER NOT NULL DEFAULT 0,
+            contenido TEXT NOT NULL DEFAULT '',
+            timestamp REAL NOT NULL,
+            PRIMARY KEY (channel_id, message_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_mensajes_guild ON mensajes (guild_id, channel_id, message_id);
+        CREATE TABLE IF NOT EXISTS sincronizacion (
+            channel_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            ultimo_id INTEGER
+        );
+    '''
+    INSERTAR = (
+        'INSERT OR REPLACE INTO mensajes '
+        '(guild_id, channel_id, message_id, autor, autor_id, es_bot, es_webhook, contenido, timestamp) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    )
+    
+    def __init__(self, ruta: str = os.path.join(DIRECTORIO_DB, 'mensajes.db')):
+        self.db = AlmacenSQLite(ruta, self.ESQUEMA)
+        # {channel_id: ultimo_id} de los canales ya descargados
+        self.sincronizados = dict(self.db.ejecutar_sync('SELECT channel_id, ultimo_id FROM sincronizacion'))
+        self._al_dia = set()  # Canales sincronizados desde la última conexión
+        self._locks = {}      # {channel_id: asyncio.Lock}
+    
+    @staticmethod
+    def _fila(msg: discord.Message) -> tuple:
+        return (
+            msg.guild.id if msg.guild else 0,
+            msg.channel.id,
+            msg.id,
+            msg.author.name,
+            msg.author.id,
+            int(msg.author.bot),
+            int(bool(msg.webhook_id)),
+            msg.content or '',
+            msg.created_at.timestamp()
+        )
+    
+    async def _guardar_estado(self, channel_id: int, guild_id: int, ultimo_id: Optional[int]):
+        self.sincronizados[channel_id] = ultimo_id
+        await self.db.ejecutar(
+            'INSERT OR REPLACE INTO sincronizacion (channel_id, guild_id, ultimo_id) VALUES (?, ?, ?)',
+            (channel_id, guild_id, ultimo_id)
+        )
+    
+    async def flujo(self, channel, despues_de: Optional[int] = None, limite: int = LIMITE_MENSAJES, al_progresar=None):
+        """Recorre los mensajes del canal, del más nuevo al más antiguo.
+        
+        Si la copia local no está al día, primero se piden a la API los mensajes
+        que faltan (se guardan y se entregan a medida que llegan) y después se
+        sigue con los ya guardados. Así quien consume puede empezar a trabajar
+        sin esperar a que termine la descarga.
+        """
+        entregados = 0
+        cursor = None  # Los mensajes guardados se leen por debajo de este id
+        
+        lock = self._locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            if channel.id not in self._al_dia:
+                ultimo_id = self.sincronizados.get(channel.id)
+                puesta_al_dia = channel.id in self.sincronizados
+                if puesta_al_dia:
+                    historial = channel.history(limit=LIMITE_MENSAJES, after=discord.Object(id=ultimo_id or 0), oldest_first=False)
+                else:
+                    historial = channel.history(limit=LIMITE_MENSAJES)  # Descarga inicial
+                
+                leidos = 0
+                lote = []
+                # Solo cuenta la espera a la API, no el tiempo que el consumidor retiene cada mensaje
+                en_api = 0.0
+                inicio = time.perf_counter()
+                async for msg in historial:
+                    en_api += time.perf_counter() - inicio
+                    leidos += 1
+                    fila = self._fila(msg)
+                    lote.append(fila)
+                    cursor = msg.id
+                    if not ultimo_id or msg.id > ultimo_id:
+                        ultimo_id = msg.id
+                    
+                    if len(lote) >= 100:
+                        await self.db.ejecutar_muchos(self.INSERTAR, lote)
+                        lote = []
+                        if al_progresar:
+                            await al_progresar(leidos)
+                    
+                    if entregados < limite and msg.id > (despues_de or 0):
+                        entregados += 1
+                        yield RegistroMensaje(*fila)
+                    inicio = time.perf_counter()
+                
+                metricas.registrar('lectura_historial', en_api)
+                if lote:
+                    await self.db.ejecutar_muchos(self.INSERTAR, lote)
+                
+                if puesta_al_dia and leidos >= LIMITE_MENSAJES:
+                    # Llegaron más mensajes de los que se piden: puede haber un hueco entre
+                    # los descargados y los ya guardados. Lo anterior al hueco se descarta
+                    # para que las lecturas desde disco no lo salten sin avisar.
+                    await self.db.ejecutar('DELETE FROM mensajes WHERE channel_id = ? AND message_id < ?',
+                                           (channel.id, cursor))
+                    print(f"⚠️ #{channel.name}: más de {LIMITE_MENSAJES} mensajes nuevos, se descarta la copia anterior")
+                
+                await self._guardar_estado(channel.id, channel.guild.id, ultimo_id)
+                self._al_dia.add(channel.id)
+        
+        # Continuar con los mensajes ya guardados, por páginas
+        while entregados < limite:
+            with metricas.tramo('lectura_espejo'):
+                filas = await self.db.ejecutar(
+                    'SELECT guild_id, channel_id, message_id, autor, autor_id, es_bot, es_webhook, contenido, timestamp '
+                    'FROM mensajes WHERE channel_id = ? AND message_id > ? AND message_id < ? '
+                    'ORDER BY message_id DESC LIMIT ?',
+                    (channel.id, despues_de or 0, cursor or 2 ** 63 - 1, min(500, limite - entregados))
+                )
+            if not filas:
+                break
+            for fila in filas:
+                entregados += 1
+                yield RegistroMensaje(*fila)
+            cursor = filas[-1][2]
+    
+    async def sincronizar(self, channel, al_progresar=None):
+        """Descarga los mensajes que faltan en la copia local"""
+        async for _ in self.flujo(channel, limite=0, al_progresar=al_progresar):
+            pass
+    
+    async def leer(self, channel_id: int, limite: int = LIMITE_MENSAJES, despues_de: Optional[int] = None) -> List[RegistroMensaje]:
+        """Devuelve los mensajes más recientes del canal (del más nuevo al más antiguo)"""
+        filas = await self.db.ejecutar(
+            'SELECT guild_id, channel_id, message_id, autor, autor_id, es_bot, es_webhook, contenido, timestamp '
+            'FROM mensajes WHERE channel_id = ? AND message_id > ? ORDER BY message_id DESC LIMIT ?',
+            (channel_id, despues_de or 0, limite)
+        )
+        return [RegistroMensaje(*fila) for fila in filas]
+    
+    async def registrar(self, msg: discord.Message):
+        """Guarda un mensaje recibido en vivo (solo canales ya descargados)"""
+        if msg.channel.id not in self.sincronizados:
+            return
+        await self.db.ejecutar(self.INSERTAR, self._fila(msg))
+        # Solo avanzar la marca si no hubo huecos desde la última sincronización
+        if msg.channel.id in self._al_dia and msg.id > (self.sincronizados[msg.channel.id] or 0):
+            await self._guardar_estado(msg.channel.id, msg.guild.id if msg.guild else 0, msg.id)
+    
+    async def editar(self, channel_id: int, message_id: int, contenido: str):
+        if channel_id not in self.sincronizados:
+            return
+        await self.db.ejecutar(
+            'UPDATE mensajes SET contenido = ? WHERE channel_id = ? AND message_id = ?',
+            (contenido, channel_id, message_id)
+        )
+    
+    async def eliminar(self, channel_id: int, message_ids):
+        if channel_id not in self.sincronizados:
+            return
+        await self.db.ejecutar_muchos(
+            'DELETE FROM mensajes WHERE channel_id = ? AND message_id = ?',
+            [(channel_id, message_id) for message_id in message_ids]
+        )
+    
+    def marcar_desconectado(self):
+        """Tras una reconexión pueden faltar mensajes: re-sincronizar antes de leer"""
+        self._al_dia.clear()
+
+class EscritorPartes:
+    """Escribe filas CSV en partes numeradas (prefijo_1.csv, prefijo_2.csv...).
+    
+    Abre una parte nueva al llegar a `max_filas` filas o a `max_bytes` en
+    disco (comprimidos, si se usa gzip). La última columna de cada fila es el
+    nombre de su parte. No es asíncrono: se usa desde un hilo aparte.
+    """
+    def __init__(self, directorio: str, prefijo: str, columnas: List[str], comprimir: bool,
+                 max_filas: int, max_bytes: int, parte: int = 0):
+        self.directorio = directorio
+        self.prefijo = prefijo
+        self.columnas = columnas
+        self.comprimir = comprimir
+        self.max_filas = max_filas
+        self.max_bytes = max_bytes
+        self.parte = parte  # Última parte abierta (las anteriores no se tocan)
+        self.archivos: List[str] = []
+        self.nombre: Optional[str] = None
+        self.filas = 0
+        self._crudo = None
+        self._texto = None
+        self._csv = None
+    
+    def _abrir(self):
+        self.parte += 1
+        self.nombre = f"{self.prefijo}_{self.parte}.csv" + ('.gz' if self.comprimir else '')
+        self._crudo = open(os.path.join(self.directorio, self.nombre), 'wb')
+        capa = gzip.GzipFile(fileobj=self._crudo, mode='wb') if self.comprimir else self._crudo
+        self._texto = io.TextIOWrapper(capa, encoding='utf-8', newline='')
+        self._csv = csv.writer(self._texto)
+        self._csv.writerow(self.columnas)
+        self.archivos.append(self.nombre)
+        self.filas = 0
+    
+    def _llena(self) -> bool:
+        if self.filas >= self.max_filas:
+            return True
+        if self.filas % 256 == 0:  # El tamaño en disco se consulta de vez en cuando
+            self._texto.flush()
+            return self._crudo.tell() >= self.max_bytes
+        return False
+    
+    def escribir(self, filas: Iterable[list]):
+        for fila in filas:
+            if self._texto is None or self._llena():
+                self.cerrar()
+                self._abrir()
+            fila.append(self.nombre)
+            self._csv.writerow(fila)
+            self.filas += 1
+        if self._texto is not None:
+            self._texto.flush()
+    
+    def cerrar(self):
+        if self._texto is not None:
+            self._texto.close()  # Cierra también el gzip, pero no el archivo de debajo
+            self._crudo.close()
+            self._texto = self._crudo = self._csv = None
+
+class ExportadorHistorial:
+    """Exporta el historial completo de un canal a observer_data/csv.
+    
+    Los mensajes se leen de la API del más antiguo al más nuevo y se escriben
+    por lotes desde un hilo aparte mientras se lee el lote siguiente: en
+    memoria solo hay un lote en lectura y otro en escritura, sea cual sea el
+    tamaño del canal. Las partes (canalN_histo_K.csv, o .csv.gz) rotan por
+    filas o por tamaño. Tras cada lote se guarda el último id exportado en
+    canalN_histo_estado.json, así una exportación interrumpida (o una nueva
+    tras llegar más mensajes) continúa en la parte siguiente.
+    """
+    COLUMNAS = ['id_mensaje', 'autor', 'autor_id', 'timestamp', 'tipo_contenido', 'contenido_texto',
+                'url_imagen', 'tiene_archivos', 'canal_numero', 'parte_archivo']
+    COLUMNAS_EVENTOS = ['id_evento', 'tipo_evento', 'descripcion_clara', 'timestamp', 'ref_mensaje',
+                        'participantes', 'importancia', 'canal_origen']
+    EXTENSIONES_IMAGEN = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+    LOTE = 500
+    
+    def __init__(self, directorio: str = os.path.join(DIRECTORIO_DATOS, 'csv'),
+                 max_filas: int = EXPORTAR_FILAS_PARTE, max_mb: float = EXPORTAR_MB_PARTE):
+        self.directorio = directorio
+        self.max_filas = max_filas
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.en_curso = set()  # channel_id de las exportaciones en marcha
+    
+    def _ruta_estado(self, prefijo: str) -> str:
+        return os.path.join(self.directorio, f'{prefijo}_estado.json')
+    
+    def _descartar(self, prefijo: str):
+        """Borra las partes de una exportación anterior (para empezar desde cero)"""
+        for archivo in (self._leer_estado(prefijo) or {}).get('archivos', []):
+            try:
+                os.remove(os.path.join(self.directorio, archivo))
+            except OSError:
+                pass
+    
+    def _leer_estado(self, prefijo: str) -> Optional[Dict]:
+        try:
+            with open(self._ruta_estado(prefijo), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _guardar_estado(self, prefijo: str, estado: Dict):
+        ruta = self._ruta_estado(prefijo)
+        with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(estado, f, ensure_ascii=False, indent=2)
+        os.replace(ruta + '.tmp', ruta)  # Escritura atómica
+    
+    @classmethod
+    def _fila(cls, msg: discord.Message, numero: int) -> list:
+        imagenes = [
+            a for a in msg.attachments
+            if (a.content_type or '').startswith('image/') or a.filename.lower().endswith(cls.EXTENSIONES_IMAGEN)
+        ]
+        if imagenes:
+            tipo = 'imagen'
+        elif msg.attachments:
+            tipo = 'archivo'
+        elif msg.embeds and not msg.content:
+            tipo = 'embed'
+        else:
+            tipo = 'texto'
+        return [msg.id, msg.author.name, msg.author.id, msg.created_at.isoformat(), tipo, msg.content,
+                imagenes[0].url if imagenes else '', bool(msg.attachments), numero]
+    
+    async def exportar(self, channel, numero: int, comprimir: bool = EXPORTAR_GZIP, reanudar: bool = True,
+                       progreso: Optional['ReportadorProgreso'] = None) -> Dict:
+        """Exporta los mensajes posteriores al último exportado (o todos si reanudar=False).
+        
+        Devuelve el estado final: ultimo_id, mensajes, parte, archivos y las
+        cifras de esta ejecución (nuevos, segundos).
+        """
+        prefijo = f'canal{numero}_histo'
+        await asyncio.to_thread(os.makedirs, self.directorio, exist_ok=True)
+        if reanudar:
+            estado = await asyncio.to_thread(self._leer_estado, prefijo)
+        else:
+            await asyncio.to_thread(self._descartar, prefijo)
+            estado = None
+        if not estado or estado.get('canal_id') != channel.id:
+            estado = {'canal_id': channel.id, 'canal_nombre': channel.name, 'ultimo_id': None,
+                      'mensajes': 0, 'parte': 0, 'archivos': []}
+        
+        escritor = EscritorPartes(self.directorio, prefijo, self.COLUMNAS, comprimir,
+                                  self.max_filas, self.max_bytes, estado['parte'])
+        
+        def volcar(lote: List[list], ultimo_id: int, total: int):
+            escritor.escribir(lote)
+            estado.update(ultimo_id=ultimo_id, mensajes=total, parte=escritor.parte,
+                          archivos=estado['archivos'] + [a for a in escritor.archivos if a not in estado['archivos']])
+            self._guardar_estado(prefijo, estado)
+        
+        inicio = time.perf_counter()
+        despues = discord.Object(id=estado['ultimo_id']) if estado['ultimo_id'] else None
+        total = estado['mensajes']
+        nuevos = 0
+        lote = []
+        escritura = None  # Lote anterior, escribiéndose mientras se lee el siguiente
+        try:
+            async for msg in channel.history(limit=None, after=despues, oldest_first=True):
+                lote.append(self._fila(msg, numero))
+                nuevos += 1
+                if len(lote) >= self.LOTE:
+                    if escritura:
+                        await escritura
+                    escritura = asyncio.ensure_future(asyncio.to_thread(volcar, lote, msg.id, total + nuevos))
+                    lote = []
+                    if progreso:
+                        progreso.actualizar(f"📤 **Exportando** #{channel.name}...\n"
+                                            f"📈 {total + nuevos:,} mensajes • parte {max(escritor.parte, 1)}")
+            
+            if escritura:
+                await escritura
+            if lote:
+                await asyncio.to_thread(volcar, lote, msg.id, total + nuevos)
+        finally:
+            if escritura and not escritura.done():
+                await asyncio.wait([escritura])
+            await asyncio.to_thread(escritor.cerrar)
+        
+        metricas.registrar('exportacion', time.perf_counter() - inicio)
+        return {**estado, 'nuevos': nuevos, 'segundos': time.perf_counter() - inicio}
+    
+    async def exportar_eventos(self, channel, numero: int, analisis: Dict) -> int:
+        """Escribe canalN_eventos.csv con los eventos del último análisis. Devuelve cuántos"""
+        eventos = analisis.get('todos_eventos', analisis.get('eventos', []))
+        marca = int(datetime.fromisoformat(analisis['timestamp_analisis']).timestamp())
+        filas = [
+            [f"{channel.name}_{marca}_{i}", evento.get('tipo', ''), evento.get('descripcion', ''),
+             evento.get('timestamp', ''), evento.get('mensaje_id', ''), ', '.join(evento.get('participantes', [])),
+             evento.get('importancia', ''), channel.name]
+            for i, evento in enumerate(eventos)
+        ]
+        
+        def escribir():
+            ruta = os.path.join(self.directorio, f'canal{numero}_eventos.csv')
+            with open(ruta + '.tmp', 'w', newline='', encoding='utf-8') as f:
+                escritor = csv.writer(f)
+                escritor.writerow(self.COLUMNAS_EVENTOS)
+                escritor.writerows(filas)
+            os.replace(ruta + '.tmp', ruta)
+        
+        await asyncio.to_thread(escribir)
+        return len(filas)
+
 # ============= CLASES PRINCIPALES =============
 
 class CanalInfo:
     """Información básica de un canal"""
-    def __init__(self, id, nombre, numero, tipo='texto'):
+    def __init__(self, id, nombre, numero, tipo='texto', categoria=None):
         self.id = id
         self.nombre = nombre
         self.numero = numero
         self.tipo = tipo
+        self.categoria = categoria
         self.nombre_normalizado = self.normalizar_nombre(nombre)
     
-    def normalizar_nombre(self, texto):
+    @staticmethod
+    def normalizar_nombre(texto):
         """Normaliza nombres con caracteres Unicode"""
         # Convertir caracteres Unicode fancy a ASCII normal
         texto_normalizado = unicodedata.normalize('NFKD', texto)
@@ -61,6 +1289,433 @@ class CanalInfo:
             texto_normalizado = texto.lower()
         return texto_normalizado.lower().replace('-', ' ').replace('_', ' ').strip()
 
+class IndiceNombres:
+    """Índice de nombres de canal para búsquedas exactas y aproximadas.
+    
+    Se construye una vez por mapa: cada canal guarda su forma compacta
+    (Unicode normalizado, sin signos, espacios simples) y sus trigramas van a
+    un índice invertido. candidatos() puntúa solo los canales que comparten
+    algún trigrama con la búsqueda, así que no recorre todo el servidor.
+    """
+    UMBRAL_SIMILITUD = 0.5  # Similitud mínima para aceptar un resultado sin coincidencia de palabras
+    UMBRAL_ERRATA = 0.8  # Similitud mínima (difflib) con un nombre completo para tolerar erratas
+    
+    def __init__(self, canales: Iterable[CanalInfo]):
+        self.exactos: Dict[str, CanalInfo] = {}
+        self.formas: Dict[int, str] = {}  # {numero: forma compacta}
+        self.trigramas: Dict[int, int] = {}  # {numero: cantidad de trigramas}
+        self.invertido: Dict[str, List[CanalInfo]] = {}
+        
+        for canal in sorted(canales, key=lambda c: c.numero):
+            nombre = canal.nombre[len("Hilo: "):] if canal.tipo == 'hilo' else canal.nombre
+            forma = self.compactar(nombre)
+            self.formas[canal.numero] = forma
+            
+            for variante in (canal.nombre_normalizado, nombre.lower(),
+                             nombre.lower().replace('-', ' ').replace('_', ' '), forma):
+                if variante:
+                    self.exactos.setdefault(variante, canal)
+            
+            trigramas = self.extraer_trigramas(forma)
+            self.trigramas[canal.numero] = len(trigramas)
+            for trigrama in trigramas:
+                self.invertido.setdefault(trigrama, []).append(canal)
+    
+    @staticmethod
+    def compactar(texto: str) -> str:
+        """Forma de comparación: Unicode normalizado, solo letras/números y espacios simples"""
+        normalizado = CanalInfo.normalizar_nombre(texto)
+        return ' '.join(''.join(c if c.isalnum() else ' ' for c in normalizado).split())
+    
+    @staticmethod
+    def extraer_trigramas(forma: str) -> set:
+        trigramas = set()
+        for palabra in forma.split():
+            relleno = f" {palabra} "
+            trigramas.update(relleno[i:i + 3] for i in range(len(relleno) - 2))
+        return trigramas
+    
+    def buscar_exacto(self, texto: str) -> Optional[CanalInfo]:
+        """Canal cuyo nombre coincide exactamente con alguna variante del texto"""
+        for variante in (texto.lower().strip(), self.compactar(texto)):
+            if variante in self.exactos:
+                return self.exactos[variante]
+        return None
+    
+    def buscar(self, texto: str) -> Optional[CanalInfo]:
+        """Coincidencia exacta con alguna variante, el mejor candidato aceptable
+        o, si no, un nombre a una errata de distancia ("mercdo" → "mercado")"""
+        canal = self.buscar_exacto(texto)
+        if canal:
+            return canal
+        
+        candidatos = self.candidatos(texto, limite=1)
+        if candidatos:
+            puntuacion, contiene, canal = candidatos[0]
+            if contiene or puntuacion >= self.UMBRAL_SIMILITUD:
+                return canal
+        
+        parecidos = difflib.get_close_matches(self.compactar(texto), self.exactos, n=1, cutoff=self.UMBRAL_ERRATA)
+        return self.exactos[parecidos[0]] if parecidos else None
+    
+    def candidatos(self, texto: str, limite: int = 10) -> List[Tuple[float, bool, CanalInfo]]:
+        """Canales ordenados por relevancia: (similitud, contiene la búsqueda, canal).
+        
+        Primero los que contienen todas las palabras buscadas (o están
+        contenidos en la búsqueda); después por similitud de trigramas
+        (coeficiente de Dice) y, a igualdad, por número de canal.
+        """
+        consulta = self.compactar(texto)
+        trigramas_consulta = self.extraer_trigramas(consulta)
+        if not trigramas_consulta:
+            return []
+        
+        compartidos: Dict[int, int] = {}
+        canales: Dict[int, CanalInfo] = {}
+        for trigrama in trigramas_consulta:
+            for canal in self.invertido.get(trigrama, ()):
+                compartidos[canal.numero] = compartidos.get(canal.numero, 0) + 1
+                canales[canal.numero] = canal
+        
+        palabras = consulta.split()
+        resultados = []
+        for numero, comunes in compartidos.items():
+            forma = self.formas[numero]
+            similitud = 2 * comunes / (len(trigramas_consulta) + self.trigramas[numero])
+            contiene = all(p in forma for p in palabras) or (len(forma) > 2 and forma in consulta)
+            resultados.append((similitud, contiene, canales[numero]))
+        
+        resultados.sort(key=lambda r: (not r[1], -r[0], r[2].numero))
+        return resultados[:limite]
+
+class ReportadorProgreso:
+    """Actualiza un mensaje de estado sin saturar el rate limit de Discord.
+    
+    Agrupa las actualizaciones: como máximo una edición cada `intervalo`
+    segundos, siempre con el estado más reciente. actualizar() nunca espera a
+    la API; las ediciones se envían desde una tarea en segundo plano. Si no
+    hay mensaje (mensaje=None) no hace nada.
+    """
+    def __init__(self, mensaje: Optional[discord.Message], intervalo: float = INTERVALO_PROGRESO):
+        self.mensaje = mensaje
+        self.intervalo = intervalo
+        self.ediciones = 0
+        self.descartadas = 0  # Estados reemplazados por uno más nuevo antes de enviarse
+        self._pendiente: Optional[str] = None
+        self._ultimo_envio = 0.0
+        self._tarea: Optional[asyncio.Task] = None
+    
+    def actualizar(self, contenido: str):
+        """Registra el nuevo estado; se enviará en la próxima ventana libre"""
+        if self.mensaje is None:
+            return
+        if self._pendiente is not None:
+            self.descartadas += 1
+        self._pendiente = contenido
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.create_task(self._enviar_pendientes())
+    
+    async def _enviar_pendientes(self):
+        loop = asyncio.get_running_loop()
+        while self._pendiente is not None:
+            espera = self._ultimo_envio + self.intervalo - loop.time()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            contenido, self._pendiente = self._pendiente, None
+            await self._editar(content=contenido)
+            self._ultimo_envio = loop.time()
+    
+    async def _editar(self, **kwargs):
+        try:
+            with metricas.tramo('edicion_discord'):
+                await self.mensaje.edit(**kwargs)
+            self.ediciones += 1
+        except discord.HTTPException as e:
+            print(f"⚠️ No se pudo actualizar el progreso: {e}")
+    
+    async def detener(self):
+        """Descarta lo pendiente sin enviarlo (el llamador escribirá el resultado)"""
+        if self._tarea and not self._tarea.done():
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+        if self._pendiente is not None:
+            self.descartadas += 1
+            self._pendiente = None
+    
+    async def finalizar(self, contenido: Optional[str] = None, **kwargs):
+        """Envía el estado final de inmediato (o el último pendiente si no se indica)"""
+        if self.mensaje is None:
+            return
+        pendiente, self._pendiente = self._pendiente, None
+        await self.detener()
+        if contenido is None and not kwargs:
+            contenido = pendiente
+        elif pendiente is not None:
+            self.descartadas += 1
+        if contenido is not None or kwargs:
+            if contenido is not None:
+                kwargs['content'] = contenido
+            await self._editar(**kwargs)
+        if self.descartadas:
+            print(f"📉 Progreso: {self.ediciones} ediciones enviadas, {self.descartadas} agrupadas")
+
+class GrupoProgreso:
+    """Reparte el progreso de un mismo análisis entre varios mensajes de estado.
+    
+    Misma interfaz que ReportadorProgreso; cada mensaje tiene su propio
+    reportador (y su propio ritmo de ediciones). Quien se suma a mitad de
+    camino recibe de inmediato el último estado. `segundo_plano` indica que
+    nadie espera el análisis todavía (precalentado).
+    """
+    def __init__(self, segundo_plano: bool = False):
+        self.reportadores: List[ReportadorProgreso] = []
+        self.segundo_plano = segundo_plano
+        self._ultimo: Optional[str] = None
+    
+    def agregar(self, mensaje: Optional[discord.Message]) -> ReportadorProgreso:
+        reportador = ReportadorProgreso(mensaje)
+        self.reportadores.append(reportador)
+        if self._ultimo is not None:
+            reportador.actualizar(self._ultimo)
+        return reportador
+    
+    def actualizar(self, contenido: str):
+        self._ultimo = contenido
+        for reportador in self.reportadores:
+            reportador.actualizar(contenido)
+    
+    async def detener(self):
+        await asyncio.gather(*(reportador.detener() for reportador in self.reportadores))
+    
+    async def finalizar(self, contenido: Optional[str] = None, **kwargs):
+        await asyncio.gather(*(reportador.finalizar(contenido, **kwargs) for reportador in self.reportadores))
+
+class CatalogoHilos:
+    """Catálogo en memoria de los hilos de cada servidor.
+    
+    La primera carga reúne los hilos activos (caché del gateway) y pagina los
+    archivados de los últimos DIAS_HILOS_ARCHIVADOS días de todos los canales
+    y foros, hasta PADRES_CONCURRENTES a la vez. Después se mantiene con los
+    eventos de hilos, así que las consultas no tocan la API.
+    """
+    def __init__(self, dias_archivados: int = DIAS_HILOS_ARCHIVADOS, concurrencia: int = PADRES_CONCURRENTES):
+        self.dias_archivados = dias_archivados
+        self.concurrencia = concurrencia
+        self.hilos: Dict[int, Dict[int, discord.Thread]] = {}  # {guild_id: {thread_id: Thread}}
+        self._cargas: Dict[int, asyncio.Task] = {}
+        # Eventos recibidos durante la carga: {guild_id: {thread_id: Thread o None si se borró}}
+        self._pendientes: Dict[int, Dict[int, Optional[discord.Thread]]] = {}
+    
+    def _limite_archivado(self) -> datetime:
+        return discord.utils.utcnow() - timedelta(days=self.dias_archivados)
+    
+    def _vigente(self, thread: discord.Thread) -> bool:
+        if not thread.archived:
+            return True
+        return thread.archive_timestamp is not None and thread.archive_timestamp >= self._limite_archivado()
+    
+    def precargar(self, guild: discord.Guild) -> asyncio.Task:
+        """Inicia la carga en segundo plano (una sola por servidor)"""
+        tarea = self._cargas.get(guild.id)
+        if tarea is None:
+            self._pendientes[guild.id] = {}
+            tarea = asyncio.create_task(self._cargar(guild))
+            self._cargas[guild.id] = tarea
+        return tarea
+    
+    def cargado(self, guild_id: int) -> bool:
+        return guild_id in self.hilos
+    
+    async def cargar(self, guild: discord.Guild):
+        """Espera a que el catálogo del servidor esté cargado"""
+        if guild.id not in self.hilos:
+            await asyncio.shield(self.precargar(guild))
+    
+    async def _cargar(self, guild: discord.Guild):
+        inicio = time.perf_counter()
+        hilos = {thread.id: thread for thread in guild.threads}
+        limite = self._limite_archivado()
+        semaforo = asyncio.Semaphore(self.concurrencia)
+        
+        async def archivados(padre) -> List[discord.Thread]:
+            encontrados = []
+            async with semaforo:
+                try:
+                    # Discord los devuelve del archivado más reciente al más antiguo
+                    async for thread in padre.archived_threads(limit=None):
+                        if thread.archive_timestamp < limite:
+                            break
+                        encontrados.append(thread)
+                except discord.HTTPException as e:
+                    print(f"⚠️ No se pudieron leer los hilos archivados de {padre.name}: {e}")
+            return encontrados
+        
+        padres = [
+            canal for canal in (*guild.text_channels, *guild.forums)
+            if canal.permissions_for(guild.me).read_message_history
+        ]
+        try:
+            for encontrados in await asyncio.gather(*(archivados(padre) for padre in padres)):
+                for thread in encontrados:
+                    hilos.setdefault(thread.id, thread)
+            # Los eventos recibidos durante la carga son más recientes que la API
+            for thread_id, thread in self._pendientes[guild.id].items():
+                if thread is None or not self._vigente(thread):
+                    hilos.pop(thread_id, None)
+                else:
+                    hilos[thread_id] = thread
+            self.hilos[guild.id] = hilos
+        finally:
+            del self._cargas[guild.id]
+            del self._pendientes[guild.id]
+        
+        print(f"🧵 {len(hilos)} hilos catalogados en {guild.name} "
+              f"({len(padres)} canales, {time.perf_counter() - inicio:.1f}s)")
+    
+    def registrar(self, thread: discord.Thread):
+        """Agrega o actualiza un hilo (eventos de creación/edición)"""
+        if thread.guild.id in self._pendientes:
+            self._pendientes[thread.guild.id][thread.id] = thread
+        hilos = self.hilos.get(thread.guild.id)
+        if hilos is None:
+            return  # Se cargará completo cuando se necesite
+        if self._vigente(thread):
+            hilos[thread.id] = thread
+        else:
+            hilos.pop(thread.id, None)
+    
+    def eliminar(self, guild_id: int, thread_id: int):
+        if guild_id in self._pendientes:
+            self._pendientes[guild_id][thread_id] = None
+        self.hilos.get(guild_id, {}).pop(thread_id, None)
+    
+    def eliminar_padre(self, guild_id: int, parent_id: int):
+        """Olvida los hilos de un canal eliminado"""
+        hilos = self.hilos.get(guild_id, {})
+        for thread_id in [t.id for t in hilos.values() if t.parent_id == parent_id]:
+            del hilos[thread_id]
+    
+    def obtener(self, guild_id: int, thread_id: int) -> Optional[discord.Thread]:
+        return self.hilos.get(guild_id, {}).get(thread_id)
+    
+    def hilos_de(self, padre) -> List[discord.Thread]:
+        """Hilos vigentes de un canal o foro, por actividad más reciente"""
+        hilos = [
+            thread for thread in self.hilos.get(padre.guild.id, {}).values()
+            if thread.parent_id == padre.id and self._vigente(thread)
+        ]
+        hilos.sort(key=lambda x: x.last_message_id or 0, reverse=True)
+        return hilos
+
+class Precalentador:
+    """Re-analiza en segundo plano los canales que más se consultan.
+    
+    Lleva una puntuación con decaimiento exponencial (vida media
+    VIDA_MEDIA_POPULARIDAD horas) de las consultas y de los mensajes de cada
+    canal. Cada `intervalo` segundos refresca, de uno en uno, los
+    PRECALENTAR_CANALES más consultados cuyo análisis esté por caducar y
+    tenga mensajes nuevos. Solo arranca si no hay otros análisis en curso ni
+    llamadas a la IA en cola, y sus llamadas ceden el paso a las demás.
+    """
+    PESO_MENSAJE = 0.02  # Cincuenta mensajes cuentan como una consulta
+    
+    def __init__(self, analyzer: 'CanalAnalyzer', canales: int = PRECALENTAR_CANALES,
+                 intervalo: float = INTERVALO_PRECALENTADO, vida_media_horas: float = VIDA_MEDIA_POPULARIDAD):
+        self.analyzer = analyzer
+        self.canales = canales
+        self.intervalo = intervalo
+        self.vida_media = vida_media_horas * 3600
+        self.consultas: Dict[int, Tuple[float, float]] = {}  # {channel_id: (puntuación, instante)}
+        self.mensajes: Dict[int, Tuple[float, float]] = {}
+        self._tarea: Optional[asyncio.Task] = None
+    
+    def _sumar(self, tabla: Dict[int, Tuple[float, float]], channel_id: int, peso: float = 1.0):
+        ahora = time.monotonic()
+        valor, instante = tabla.get(channel_id, (0.0, ahora))
+        tabla[channel_id] = (valor * 0.5 ** ((ahora - instante) / self.vida_media) + peso, ahora)
+    
+    def _valor(self, tabla: Dict[int, Tuple[float, float]], channel_id: int, ahora: float) -> float:
+        valor, instante = tabla.get(channel_id, (0.0, ahora))
+        return valor * 0.5 ** ((ahora - instante) / self.vida_media)
+    
+    def registrar_consulta(self, channel_id: int):
+        self._sumar(self.consultas, channel_id)
+    
+    def registrar_mensaje(self, channel_id: int):
+        self._sumar(self.mensajes, channel_id)
+    
+    def calientes(self) -> List[int]:
+        """Canales consultados alguna vez, de más a menos populares"""
+        ahora = time.monotonic()
+        puntuacion = {
+            channel_id: self._valor(self.consultas, channel_id, ahora)
+                        + self._valor(self.mensajes, channel_id, ahora) * self.PESO_MENSAJE
+            for channel_id in self.consultas
+        }
+        return sorted(puntuacion, key=puntuacion.get, reverse=True)[:self.canales]
+    
+    def _hay_capacidad(self) -> bool:
+        return not self.analyzer.en_vuelo and not self.analyzer.llm.limitador.en_cola
+    
+    async def _necesita_refresco(self, channel) -> bool:
+        """Sin análisis, o con mensajes nuevos y a punto de caducar antes de la próxima revisión"""
+        anterior = await self.analyzer.analisis_cache.obtener(channel.id)
+        if anterior is None or self.analyzer._es_degradado(anterior, channel.guild.id):
+            return True
+        if anterior.get('ultimo_mensaje_id') == channel.last_message_id:
+            return False
+        cache = self.analyzer.analisis_cache
+        return cache.edad_minutos(anterior) >= cache.ttl_minutos - 2 * self.intervalo / 60
+    
+    async def revisar(self, obtener_canal) -> int:
+        """Refresca los canales calientes que lo necesiten. Devuelve cuántos se analizaron"""
+        analizados = 0
+        for channel_id in self.calientes():
+            if not self._hay_capacidad():
+                break  # Hay trabajo interactivo: se retoma en la próxima revisión
+            channel = obtener_canal(channel_id)
+            if channel is None or isinstance(channel, discord.ForumChannel):
+                continue
+            if self.analyzer.consumo.modo(channel.guild.id) != 'normal':
+                continue  # El presupuesto de IA se reserva para las consultas
+            if not await self._necesita_refresco(channel):
+                continue
+            
+            inicio = time.perf_counter()
+            try:
+                await self.analyzer.analizar_canal(channel, refrescar=True, segundo_plano=True)
+            except Exception as e:
+                print(f"⚠️ Error precalentando #{channel.name}: {e}")
+                continue
+            analizados += 1
+            metricas.incrementar('precalentados')
+            print(f"🔥 #{channel.name} precalentado en {time.perf_counter() - inicio:.1f}s")
+        return analizados
+    
+    async def _bucle(self, obtener_canal):
+        while True:
+            await asyncio.sleep(self.intervalo)
+            try:
+                await self.revisar(obtener_canal)
+            except Exception as e:
+                print(f"⚠️ Error en el precalentado: {e}")
+    
+    def iniciar(self, obtener_canal):
+        """Arranca las revisiones periódicas (obtener_canal: channel_id -> canal o None)"""
+        if self.canales > 0 and (self._tarea is None or self._tarea.done()):
+            self._tarea = asyncio.create_task(self._bucle(obtener_canal))
+    
+    async def detener(self):
+        if self._tarea and not self._tarea.done():
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+
 # ============= VISTAS INTERACTIVAS =============
 
 class ForoHilosSelect(discord.ui.Select):
@@ -75,7 +1730,7 @@ class ForoHilosSelect(discord.ui.Select):
             # Obtener información adicional del hilo
             descripcion = f"💬 {hilo.message_count if hasattr(hilo, 'message_count') else '?'} mensajes"
             if hasattr(hilo, 'created_at'):
-                dias = (datetime.now(hilo.created_at.tzinfo or datetime.now().astimezone().tzinfo) - hilo.created_at).days
+                dias = (discord.utils.utcnow() - hilo.created_at).days
                 if dias == 0:
                     descripcion += " • Creado hoy"
                 elif dias == 1:
@@ -104,8 +1759,9 @@ class ForoHilosSelect(discord.ui.Select):
             # Obtener el hilo
             hilo = self.foro.get_thread(hilo_id)
             if not hilo:
-                # Intentar obtenerlo del guild
-                hilo = interaction.guild.get_thread(hilo_id)
+                # Intentar obtenerlo del guild o del catálogo (hilos archivados)
+                hilo = (interaction.guild.get_thread(hilo_id)
+                        or self.bot.analyzer.catalogo_hilos.obtener(interaction.guild.id, hilo_id))
             
             if not hilo:
                 await interaction.response.send_message("❌ No puedo acceder a ese hilo.", ephemeral=True)
@@ -151,6 +1807,41 @@ class ForoHilosSelect(discord.ui.Select):
             else:
                 await interaction.followup.send(f"❌ Error al analizar: {str(e)}", ephemeral=True)
 
+class AnalizarForoButton(discord.ui.Button):
+    """Botón para analizar todos los hilos del foro de una vez"""
+    def __init__(self, bot, foro):
+        super().__init__(
+            label="Analizar foro completo",
+            style=discord.ButtonStyle.primary,
+            emoji="📊"
+        )
+        self.bot = bot
+        self.foro = foro
+    
+    async def callback(self, interaction: discord.Interaction):
+        try:
+            # Responder primero para evitar timeout
+            await interaction.response.defer()
+            
+            status_msg = await interaction.followup.send(f"📊 **Analizando todos los hilos** del foro {self.foro.name}...")
+            
+            informe = await self.bot.analyzer.analizar_foro(self.foro, status_msg)
+            
+            if not informe['hilos_analizados']:
+                await status_msg.edit(content=f"❌ No pude analizar ningún hilo del foro {self.foro.name}.")
+                return
+            
+            await status_msg.edit(content=None, embed=self.bot.crear_embed_foro(informe))
+            
+        except Exception as e:
+            print(f"Error en AnalizarForoButton: {e}")
+            import traceback
+            traceback.print_exc()
+            if interaction.response.is_done():
+                await interaction.followup.send(f"❌ Error: {str(e)}", ephemeral=True)
+            else:
+                await interaction.response.send_message(f"❌ Error: {str(e)}", ephemeral=True)
+
 class ForoView(discord.ui.View):
     """Vista especializada para mostrar hilos de un foro"""
     def __init__(self, bot, foro, hilos, timeout=300):
@@ -159,9 +1850,10 @@ class ForoView(discord.ui.View):
         self.foro = foro
         self.hilos = hilos
         
-        # Agregar el selector de hilos
+        # Agregar el selector de hilos y el análisis de todo el foro
         if hilos:
             self.add_item(ForoHilosSelect(bot, foro, hilos))
+            self.add_item(AnalizarForoButton(bot, foro))
 
 class HilosSelect(discord.ui.Select):
     """Dropdown para seleccionar hilos"""
@@ -189,7 +1881,8 @@ class HilosSelect(discord.ui.Select):
             hilo_id = int(self.values[0])
             
             # Obtener el hilo
-            hilo = interaction.guild.get_thread(hilo_id)
+            hilo = (interaction.guild.get_thread(hilo_id)
+                    or self.analyzer.catalogo_hilos.obtener(interaction.guild.id, hilo_id))
             if not hilo:
                 hilo = interaction.guild.get_channel(hilo_id)  # Intentar como canal normal
             
@@ -307,10 +2000,6 @@ class ActualizarButton(discord.ui.Button):
             # Responder primero
             await interaction.response.defer()
             
-            # Limpiar caché
-            if self.canal_info.id in self.analyzer.analisis_cache:
-                del self.analyzer.analisis_cache[self.canal_info.id]
-            
             # Re-analizar
             channel = interaction.guild.get_channel(self.canal_info.id)
             if not channel:
@@ -320,8 +2009,8 @@ class ActualizarButton(discord.ui.Button):
             # Mensaje de estado
             await interaction.followup.send(f"🔄 Actualizando análisis de #{self.canal_info.nombre}...", ephemeral=True)
             
-            # Analizar
-            analisis = await self.analyzer.analizar_canal(channel)
+            # Analizar solo los mensajes nuevos desde el último análisis
+            analisis = await self.analyzer.analizar_canal(channel, refrescar=True)
             
             if 'error' in analisis:
                 await interaction.followup.send(f"❌ {analisis['error']}", ephemeral=True)
@@ -381,98 +2070,305 @@ class AnalisisView(discord.ui.View):
 class CanalAnalyzer:
     """Analizador inteligente de canales Discord"""
     
+    MAX_HILOS_MAPA = 20  # Hilos activos que se numeran por servidor, para no saturar
+    MAX_HILOS_RETIRADOS = 500  # Números de hilos fuera del mapa que se recuerdan por servidor
+    
     def __init__(self):
         self.canales_mapeados = {}  # {guild_id: {numero: CanalInfo}}
-        self.canales_por_nombre = {}  # {guild_id: {nombre_normalizado: CanalInfo}}
-        self.analisis_cache = {}    # {channel_id: analisis_data}
-        self.client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        self.siguientes_numeros = {}  # {guild_id: próximo número libre}; nunca baja, ni al borrar canales
+        self.hilos_retirados = {}  # {guild_id: {thread_id: número}} hilos archivados que salieron del mapa
+        self.indices_nombres = {}  # {guild_id: IndiceNombres}
+        self.analisis_cache = CacheAnalisis()  # {channel_id: analisis_data} en memoria + disco
+        self.espejo = EspejoMensajes()  # Copia local del historial
+        self.cache_ia = CacheRespuestasIA()  # Respuestas de la IA por hash de contenido
+        self.catalogo_hilos = CatalogoHilos()  # Hilos activos y archivados recientes por servidor
+        self.consumo = RegistroConsumo()  # Tokens y costo de la IA por servidor y canal
+        self.en_vuelo: Dict[int, Tuple[asyncio.Task, GrupoProgreso]] = {}  # {channel_id: análisis en curso}
+        self.precalentador = Precalentador(self)  # Re-analiza los canales más consultados
+        metricas.fuentes.append(self._indicadores)
+        self.llm = ClienteLLM(OPENAI_API_KEY)
     
     async def mapear_servidor(self, guild: discord.Guild, mensaje_status=None) -> Dict:
-        """Mapea todos los canales disponibles del servidor con números"""
+        """Mapea todos los canales disponibles del servidor con números.
+        
+        Los canales que ya estaban mapeados conservan su número; los nuevos
+        reciben el siguiente libre. El mapa se guarda en disco.
+        """
         print(f"📍 Mapeando canales de {guild.name}...")
         
-        if mensaje_status:
-            await mensaje_status.edit(content="🔍 **Paso 1/3**: Escaneando estructura del servidor...")
+        progreso = ReportadorProgreso(mensaje_status)
+        progreso.actualizar("🔍 **Paso 1/3**: Escaneando estructura del servidor...")
         
+        anteriores = {c.id: c.numero for c in self.canales_mapeados.get(guild.id, {}).values()}
+        retirados = self.hilos_retirados.setdefault(guild.id, {})
+        siguiente = self._siguiente_numero(guild.id)
         canales = {}
-        canales_por_nombre = {}
-        numero = 1
+        
+        def agregar(channel):
+            nonlocal siguiente
+            numero = anteriores.get(channel.id) or retirados.pop(channel.id, None)
+            if numero is None:
+                numero = siguiente
+                siguiente += 1
+            canales[numero] = self._crear_canal_info(channel, numero)
         
         # Mapear canales de texto
-        if mensaje_status:
-            await mensaje_status.edit(content=f"📊 **Paso 2/3**: Identificando canales de texto... ({len(guild.text_channels)} encontrados)")
+        progreso.actualizar(f"📊 **Paso 2/3**: Identificando canales de texto... ({len(guild.text_channels)} encontrados)")
         
         for channel in guild.text_channels:
-            if channel.permissions_for(guild.me).read_message_history:
-                canal_info = CanalInfo(
-                    id=channel.id,
-                    nombre=channel.name,
-                    numero=numero,
-                    tipo='texto'
-                )
-                
-                canales[numero] = canal_info
-                
-                # Guardar múltiples variaciones del nombre para búsqueda
-                # 1. Nombre normalizado
-                canales_por_nombre[canal_info.nombre_normalizado] = canal_info
-                
-                # 2. Nombre original en minúsculas
-                canales_por_nombre[channel.name.lower()] = canal_info
-                
-                # 3. Nombre sin caracteres especiales
-                nombre_sin_especiales = ''.join(c for c in channel.name.lower() if c.isalnum() or c.isspace())
-                if nombre_sin_especiales and nombre_sin_especiales != channel.name.lower():
-                    canales_por_nombre[nombre_sin_especiales] = canal_info
-                
-                # 4. Nombre con guiones reemplazados por espacios
-                nombre_con_espacios = channel.name.lower().replace('-', ' ').replace('_', ' ')
-                if nombre_con_espacios != channel.name.lower():
-                    canales_por_nombre[nombre_con_espacios] = canal_info
-                
-                numero += 1
+            if self._es_mapeable(channel):
+                agregar(channel)
         
         # Mapear foros
         for forum in guild.forums:
-            canal_info = CanalInfo(
-                id=forum.id,
-                nombre=forum.name,
-                numero=numero,
-                tipo='foro'
-            )
-            
-            canales[numero] = canal_info
-            canales_por_nombre[canal_info.nombre_normalizado] = canal_info
-            canales_por_nombre[forum.name.lower()] = canal_info
-            numero += 1
+            agregar(forum)
         
         # Mapear algunos hilos activos
         thread_count = 0
         for thread in guild.threads:
-            if thread_count >= 20:  # Limitar para no saturar
+            if thread_count >= self.MAX_HILOS_MAPA:  # Limitar para no saturar
                 break
-            if not thread.archived:
-                canal_info = CanalInfo(
-                    id=thread.id,
-                    nombre=f"Hilo: {thread.name}",
-                    numero=numero,
-                    tipo='hilo'
-                )
-                
-                canales[numero] = canal_info
-                canales_por_nombre[canal_info.nombre_normalizado] = canal_info
-                numero += 1
+            if self._es_mapeable(thread):
+                agregar(thread)
                 thread_count += 1
         
+        # Los hilos que salen del mapa (archivados o fuera del tope) guardan su número
+        mapeados = {c.id for c in canales.values()}
+        for c in self.canales_mapeados.get(guild.id, {}).values():
+            if c.tipo == 'hilo' and c.id not in mapeados:
+                self._retirar_hilo(guild.id, c.id, c.numero)
+        
         self.canales_mapeados[guild.id] = canales
-        self.canales_por_nombre[guild.id] = canales_por_nombre
+        self.indices_nombres[guild.id] = IndiceNombres(canales.values())
+        self.siguientes_numeros[guild.id] = siguiente
+        await self.guardar_mapa(guild.id)
         
-        if mensaje_status:
-            await mensaje_status.edit(content=f"✅ **Paso 3/3**: ¡Mapeo completado! {len(canales)} canales identificados")
+        await progreso.finalizar(f"✅ **Paso 3/3**: ¡Mapeo completado! {len(canales)} canales identificados")
         
         print(f"✅ {len(canales)} canales mapeados")
         return canales
     
+    @staticmethod
+    def _es_mapeable(channel) -> bool:
+        """Canales que aparecen en el mapa: texto legible, foros e hilos activos"""
+        if isinstance(channel, discord.Thread):
+            return not channel.archived
+        if isinstance(channel, discord.ForumChannel):
+            return True
+        if isinstance(channel, discord.TextChannel):
+            return channel.permissions_for(channel.guild.me).read_message_history
+        return False
+    
+    @staticmethod
+    def _crear_canal_info(channel, numero: int) -> CanalInfo:
+        if isinstance(channel, discord.Thread):
+            nombre, tipo = f"Hilo: {channel.name}", 'hilo'
+        elif isinstance(channel, discord.ForumChannel):
+            nombre, tipo = channel.name, 'foro'
+        else:
+            nombre, tipo = channel.name, 'texto'
+        
+        return CanalInfo(
+            id=channel.id,
+            nombre=nombre,
+            numero=numero,
+            tipo=tipo,
+            categoria=channel.category.name if channel.category else None
+        )
+    
+    async def actualizar_canal(self, channel):
+        """Agrega, actualiza o quita un canal del mapa (eventos de creación/edición)"""
+        canales = self.canales_mapeados.get(channel.guild.id)
+        if canales is None:
+            return  # Servidor aún no mapeado
+        
+        if isinstance(channel, discord.CategoryChannel):
+            await self._renombrar_categoria(channel)
+            return
+        
+        actual = next((c for c in canales.values() if c.id == channel.id), None)
+        if not self._es_mapeable(channel):
+            if actual:
+                # Un hilo archivado puede volver: conserva su número para entonces
+                await self.eliminar_canal(channel.guild.id, channel.id,
+                                          conservar_numero=isinstance(channel, discord.Thread))
+            return
+        
+        if actual:
+            numero = actual.numero
+        else:
+            hilos = sum(1 for c in canales.values() if c.tipo == 'hilo')
+            if isinstance(channel, discord.Thread) and hilos >= self.MAX_HILOS_MAPA:
+                return
+            numero = self.hilos_retirados.get(channel.guild.id, {}).pop(channel.id, None)
+            if numero is None:
+                numero = self._siguiente_numero(channel.guild.id)
+                self.siguientes_numeros[channel.guild.id] = numero + 1
+        canales[numero] = self._crear_canal_info(channel, numero)
+        self.indices_nombres[channel.guild.id] = IndiceNombres(canales.values())
+        await self.guardar_mapa(channel.guild.id)
+    
+    async def _renombrar_categoria(self, categoria: discord.CategoryChannel):
+        """Actualiza la categoría de los canales del mapa (y sus hilos) que están en ella"""
+        guild = categoria.guild
+        cambiados = False
+        for canal_info in self.canales_mapeados[guild.id].values():
+            channel = (guild.get_channel_or_thread(canal_info.id)
+                       or self.catalogo_hilos.obtener(guild.id, canal_info.id))
+            if isinstance(channel, discord.Thread):
+                channel = guild.get_channel(channel.parent_id)
+            if channel is None or channel.category_id != categoria.id:
+                continue
+            if canal_info.categoria != categoria.name:
+                canal_info.categoria = categoria.name
+                cambiados = True
+        if cambiados:
+            await self.guardar_mapa(guild.id)
+    
+    def _retirar_hilo(self, guild_id: int, thread_id: int, numero: int):
+        """Recuerda el número de un hilo que sale del mapa (los más antiguos se olvidan)"""
+        retirados = self.hilos_retirados.setdefault(guild_id, {})
+        retirados.pop(thread_id, None)
+        retirados[thread_id] = numero
+        while len(retirados) > self.MAX_HILOS_RETIRADOS:
+            del retirados[next(iter(retirados))]
+    
+    def _siguiente_numero(self, guild_id: int) -> int:
+        """Número para el próximo canal nuevo: no reutiliza los de canales eliminados
+        (los archivos exportados canalN_* van por número)"""
+        usado = max(self.canales_mapeados.get(guild_id, {}), default=0) + 1
+        return max(self.siguientes_numeros.get(guild_id, 1), usado)
+    
+    async def eliminar_canal(self, guild_id: int, channel_id: int, conservar_numero: bool = False):
+        """Quita un canal del mapa sin renumerar los demás.
+        
+        Con conservar_numero (hilos archivados) el número se recuerda y el
+        hilo lo recupera si vuelve al mapa; si no, se olvida del todo.
+        """
+        if not conservar_numero:
+            self.hilos_retirados.get(guild_id, {}).pop(channel_id, None)
+        canales = self.canales_mapeados.get(guild_id)
+        if not canales:
+            return
+        
+        numeros = [numero for numero, c in canales.items() if c.id == channel_id]
+        if not numeros:
+            return
+        self.siguientes_numeros[guild_id] = self._siguiente_numero(guild_id)  # Antes de liberar el número
+        for numero in numeros:
+            if conservar_numero:
+                self._retirar_hilo(guild_id, channel_id, numero)
+            del canales[numero]
+        self.indices_nombres[guild_id] = IndiceNombres(canales.values())
+        await self.guardar_mapa(guild_id)
+    
+    @staticmethod
+    def _ruta_mapa(guild_id: int) -> str:
+        return os.path.join(DIRECTORIO_DATOS, 'csv', f'canales_map_{guild_id}.csv')
+    
+    async def guardar_mapa(self, guild_id: int):
+        """Guarda el mapa del servidor en observer_data/csv/canales_map_<guild>.csv
+        (y el próximo número libre y los hilos retirados en canales_map_<guild>.json)"""
+        filas = [
+            (c.id, c.numero, c.nombre, c.tipo, c.categoria or '')
+            for c in sorted(self.canales_mapeados.get(guild_id, {}).values(), key=lambda c: c.numero)
+        ]
+        await asyncio.to_thread(self._escribir_mapa, self._ruta_mapa(guild_id), filas,
+                                self._siguiente_numero(guild_id), dict(self.hilos_retirados.get(guild_id, {})))
+    
+    @staticmethod
+    def _escribir_mapa(ruta: str, filas: List[tuple], siguiente: int, retirados: Dict[int, int]):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = ruta + '.tmp'
+        with open(temporal, 'w', newline='', encoding='utf-8') as f:
+            escritor = csv.writer(f)
+            escritor.writerow(['id_canal', 'numero_interno', 'nombre_canal', 'tipo', 'categoria'])
+            escritor.writerows(filas)
+        ruta_contador = os.path.splitext(ruta)[0] + '.json'
+        with open(ruta_contador + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'siguiente_numero': siguiente, 'hilos_retirados': retirados}, f)
+        # Primero el contador: si se corta entre ambos, como mucho se salta un número
+        os.replace(ruta_contador + '.tmp', ruta_contador)
+        os.replace(temporal, ruta)  # Escritura atómica
+    
+    async def cargar_mapa(self, guild_id: int) -> bool:
+        """Carga el último mapa guardado del servidor. Devuelve False si no hay"""
+        ruta = self._ruta_mapa(guild_id)
+        if not os.path.exists(ruta):
+            return False
+        
+        def leer():
+            with open(ruta, newline='', encoding='utf-8') as f:
+                filas = list(csv.DictReader(f))
+            try:
+                with open(os.path.splitext(ruta)[0] + '.json', encoding='utf-8') as f:
+                    contador = json.load(f)
+                siguiente = int(contador['siguiente_numero'])
+                retirados = {int(k): int(v) for k, v in contador.get('hilos_retirados', {}).items()}
+            except (OSError, KeyError, ValueError):
+                # Mapa guardado antes del contador: se deduce del mapa
+                siguiente, retirados = 1, {}
+            return filas, siguiente, retirados
+        
+        try:
+            filas, siguiente, retirados = await asyncio.to_thread(leer)
+            canales = {}
+            for fila in filas:
+                canal_info = CanalInfo(
+                    id=int(fila['id_canal']),
+                    nombre=fila['nombre_canal'],
+                    numero=int(fila['numero_interno']),
+                    tipo=fila['tipo'],
+                    categoria=fila['categoria'] or None
+                )
+                canales[canal_info.numero] = canal_info
+        except (OSError, KeyError, ValueError) as e:
+            print(f"⚠️ No se pudo cargar el mapa de canales de {guild_id}: {e}")
+            return False
+        
+        self.canales_mapeados[guild_id] = canales
+        self.indices_nombres[guild_id] = IndiceNombres(canales.values())
+        self.siguientes_numeros[guild_id] = siguiente
+        self.hilos_retirados[guild_id] = retirados
+        return True
+    
+    def _indicadores(self) -> Dict[str, float]:
+        """Estado de cachés y cola de la IA para la exportación de métricas"""
+        cache_ia = self.cache_ia.estadisticas()
+        return {
+            'cache_ia_tasa_aciertos': cache_ia['tasa_aciertos'],
+            'cache_ia_tokens_ahorrados': cache_ia['tokens_ahorrados'],
+            'cache_analisis_en_memoria': len(self.analisis_cache.memoria),
+            'ia_en_cola': self.llm.limitador.en_cola
+        }
+    
+    async def _contabilizar(self, origen: Tuple[int, int], response: Dict, latencia: float):
+        """Registra tokens y latencia de una llamada a la IA para su servidor y canal"""
+        guild_id, channel_id = origen
+        try:
+            await self.consumo.registrar(guild_id, channel_id, response.get('model', MODELO_IA),
+                                         response.get('usage') or {}, latencia)
+        except Exception as e:
+            print(f"⚠️ No se pudo registrar el consumo de IA: {e}")
+    
+    async def analisis_caducado(self, channel) -> Optional[Dict]:
+        """Último análisis del canal si ya no está vigente (para mostrarlo mientras se actualiza)"""
+        anterior = await self.analisis_cache.obtener(channel.id)
+        if anterior and not self._es_vigente(anterior, channel):
+            return anterior
+        return None
+    
+    def _es_degradado(self, analisis: Dict, guild_id: int) -> bool:
+        """Indica si un análisis hecho con el presupuesto limitado ya no sirve
+        porque el servidor vuelve a tener presupuesto normal"""
+        return (analisis.get('modo_presupuesto', 'normal') != 'normal'
+                and self.consumo.modo(guild_id) == 'normal')
+    
+    def _es_vigente(self, analisis: Dict, channel) -> bool:
+        """Indica si el análisis guardado puede devolverse sin actualizarlo"""
+        return (not self._es_degradado(analisis, channel.guild.id)
+                and self.analisis_cache.es_vigente(analisis, getattr(channel, 'last_message_id', None)))
+    
     def buscar_canal(self, guild_id: int, busqueda: str) -> Optional[CanalInfo]:
         """Busca un canal por número o nombre"""
         if guild_id not in self.canales_mapeados:
@@ -490,50 +2386,144 @@ class CanalAnalyzer:
         except ValueError:
             pass
         
-        # Buscar por nombre
-        canales_por_nombre = self.canales_por_nombre.get(guild_id, {})
+        # Buscar por nombre (exacto y después aproximado)
+        indice = self.indices_nombres.get(guild_id)
+        canal = indice.buscar(busqueda) if indice else None
+        if canal:
+            print(f"✅ Encontrado: {canal.nombre}")
+            return canal
         
-        # Normalizar búsqueda - eliminar espacios extra y guiones
-        busqueda_normalizada = busqueda.lower().strip()
-        busqueda_normalizada = busqueda_normalizada.replace('-', ' ').replace('_', ' ')
+        print(f"❌ No encontrado: '{busqueda}'")
+        return None
+    
+    def sugerir_canales(self, guild_id: int, busqueda: str, limite: int = 10) -> List[CanalInfo]:
+        """Canales más parecidos a la búsqueda, del más al menos relevante"""
+        indice = self.indices_nombres.get(guild_id)
+        if not indice:
+            return []
+        return [canal for _, _, canal in indice.candidatos(busqueda, limite)]
+    
+    def canales_de_categoria(self, guild_id: int, categoria: str) -> List[CanalInfo]:
+        """Canales analizables (texto e hilos) cuya categoría coincide con la búsqueda"""
+        busqueda = CanalInfo.normalizar_nombre(categoria)
+        return [
+            canal for canal in self.canales_mapeados.get(guild_id, {}).values()
+            if canal.tipo != 'foro' and canal.categoria
+            and busqueda in CanalInfo.normalizar_nombre(canal.categoria)
+        ]
+    
+    async def analizar_lote(self, guild: discord.Guild, canales: List[CanalInfo], mensaje_status=None) -> Dict:
+        """Analiza varios canales en paralelo con un pool acotado.
         
-        # Búsqueda exacta primero
-        for nombre_key, canal in canales_por_nombre.items():
-            if busqueda_normalizada == nombre_key:
-                print(f"✅ Encontrado exacto: {canal.nombre}")
-                return canal
+        Como mucho CANALES_CONCURRENTES canales a la vez; los que tienen un
+        análisis vigente en caché se sirven sin volver a la API. El progreso
+        de todo el lote se muestra en un único mensaje.
+        """
+        progreso = ReportadorProgreso(mensaje_status)
+        semaforo = asyncio.Semaphore(CANALES_CONCURRENTES)
+        inicio = time.perf_counter()
+        resultados = {}  # {canal_id: análisis}
+        errores = {}     # {canal_id: descripción del error}
+        desde_cache = 0
         
-        # Búsqueda sin caracteres especiales
-        busqueda_sin_especiales = ''.join(c for c in busqueda_normalizada if c.isalnum() or c.isspace())
+        def informar():
+            terminados = len(resultados) + len(errores)
+            porcentaje = int(terminados / len(canales) * 100) if canales else 100
+            progreso.actualizar(
+                f"📦 **Análisis por lotes** - {porcentaje}%\n"
+                f"✅ {len(resultados)}/{len(canales)} canales analizados\n"
+                f"♻️ {desde_cache} desde caché • ❌ {len(errores)} con errores"
+            )
         
-        for nombre_key, canal in canales_por_nombre.items():
-            nombre_sin_especiales = ''.join(c for c in nombre_key if c.isalnum() or c.isspace())
+        async def procesar(canal_info: CanalInfo):
+            nonlocal desde_cache
+            channel = (guild.get_channel_or_thread(canal_info.id)
+                       or self.catalogo_hilos.obtener(guild.id, canal_info.id))
+            if not channel:
+                errores[canal_info.id] = 'No puedo acceder a ese canal'
+                informar()
+                return
             
-            # Comparar sin caracteres especiales
-            if busqueda_sin_especiales == nombre_sin_especiales:
-                print(f"✅ Encontrado sin especiales: {canal.nombre}")
-                return canal
+            async with semaforo:
+                try:
+                    anterior = await self.analisis_cache.obtener(channel.id)
+                    if anterior and self._es_vigente(anterior, channel):
+                        desde_cache += 1
+                    analisis = await self.analizar_canal(channel)
+                except Exception as e:
+                    analisis = {'error': str(e)}
+            
+            if 'error' in analisis:
+                errores[canal_info.id] = analisis['error']
+            else:
+                resultados[canal_info.id] = analisis
+            informar()
         
-        # Búsqueda parcial - buscar que todas las palabras de la búsqueda estén en el nombre
-        palabras_busqueda = busqueda_sin_especiales.split()
+        informar()
+        await asyncio.gather(*(procesar(canal) for canal in canales))
+        await progreso.finalizar(f"✅ **Lote completado**: {len(resultados)}/{len(canales)} canales analizados")
         
-        for nombre_key, canal in canales_por_nombre.items():
-            nombre_sin_especiales = ''.join(c for c in nombre_key if c.isalnum() or c.isspace())
-            
-            # Verificar que todas las palabras estén presentes
-            if all(palabra in nombre_sin_especiales for palabra in palabras_busqueda):
-                print(f"✅ Encontrado parcial: {canal.nombre}")
-                return canal
+        return {
+            'canales': [(canal, resultados[canal.id]) for canal in canales if canal.id in resultados],
+            'errores': [(canal, errores[canal.id]) for canal in canales if canal.id in errores],
+            'total': len(canales),
+            'desde_cache': desde_cache,
+            'duracion': time.perf_counter() - inicio
+        }
+    
+    async def analizar_foro(self, forum: discord.ForumChannel, mensaje_status=None) -> Dict:
+        """Analiza todos los hilos de un foro y los combina en un único informe.
         
-        # Si no encontramos nada, buscar en los nombres originales de los canales
-        for numero, canal in self.canales_mapeados[guild_id].items():
-            nombre_original = canal.nombre.lower()
-            if busqueda_normalizada in nombre_original or nombre_original in busqueda_normalizada:
-                print(f"✅ Encontrado en nombre original: {canal.nombre}")
-                return canal
+        Los hilos pasan por el mismo pool que los lotes (CANALES_CONCURRENTES a
+        la vez) y los que tienen un análisis vigente salen del caché.
+        """
+        hilos = await self.listar_hilos_foro(forum)
+        categoria = forum.category.name if forum.category else None
+        canales = [
+            CanalInfo(id=hilo.id, nombre=hilo.name, numero=i, tipo='hilo', categoria=categoria)
+            for i, hilo in enumerate(hilos, 1)
+        ]
+        lote = await self.analizar_lote(forum.guild, canales, mensaje_status)
         
-        print(f"❌ No encontrado: '{busqueda}'")
-        return None
+        usuarios = set()
+        personajes = set()
+        elementos_mundo = {}  # {elemento: número de hilos que lo mencionan}
+        eventos = []
+        mensajes_totales = 0
+        for canal_info, analisis in lote['canales']:
+            usuarios.update(analisis.get('lista_usuarios', []))
+            personajes.update(analisis.get('lista_personajes', []))
+            for elemento in analisis.get('elementos_mundo', []):
+                elementos_mundo[elemento] = elementos_mundo.get(elemento, 0) + 1
+            for evento in analisis.get('todos_eventos', []):
+                eventos.append({**evento, 'hilo': canal_info.nombre})
+            mensajes_totales += analisis.get('total_mensajes_revisados', 0)
+        
+        # Primero los importantes; dentro de cada grupo, los más recientes
+        eventos.sort(key=lambda e: e.get('timestamp') or '', reverse=True)
+        eventos.sort(key=lambda e: e.get('importancia', 'baja') == 'alta', reverse=True)
+        
+        return {
+            'canal_nombre': forum.name,
+            'canal_id': forum.id,
+            'tipo_canal': 'foro',
+            'total_hilos': len(hilos),
+            'hilos_analizados': len(lote['canales']),
+            'hilos_activos': sorted(
+                ((c.nombre, a.get('num_eventos', 0)) for c, a in lote['canales']),
+                key=lambda h: h[1], reverse=True
+            ),
+            'errores': [(c.nombre, error) for c, error in lote['errores']],
+            'desde_cache': lote['desde_cache'],
+            'duracion': lote['duracion'],
+            'total_mensajes_revisados': mensajes_totales,
+            'lista_usuarios': sorted(usuarios),
+            'lista_personajes': sorted(personajes),
+            'elementos_mundo': sorted(elementos_mundo, key=elementos_mundo.get, reverse=True),
+            'num_eventos': len(eventos),
+            'eventos': eventos[:15],
+            'timestamp_analisis': datetime.now().isoformat()
+        }
     
     async def detectar_canales_relacionados(self, channel: discord.TextChannel) -> Dict:
         """Detecta foros e hilos relacionados con el canal"""
@@ -543,66 +2533,87 @@ class CanalAnalyzer:
             'total': 0
         }
         
-        # Buscar hilos en el canal
+        # Buscar hilos en el canal: activos y archivados recientes desde el catálogo
+        # o, si todavía se está cargando, solo los activos (no se espera a la carga)
         try:
-            for thread in channel.threads:
-                if not thread.archived:
-                    relacionados['hilos_activos'].append({
-                        'nombre': thread.name,
-                        'id': thread.id,
-                        'mensajes': thread.message_count if hasattr(thread, 'message_count') else 0
-                    })
-            
-            # También buscar en threads archivados recientes (opcional)
-            async for thread in channel.archived_threads(limit=10):
-                if (datetime.now() - thread.archive_timestamp).days < 30:  # Solo últimos 30 días
-                    relacionados['hilos_activos'].append({
-                        'nombre': f"{thread.name} (archivado)",
-                        'id': thread.id,
-                        'mensajes': thread.message_count if hasattr(thread, 'message_count') else 0
-                    })
-            
-        except:
-            pass  # Algunos canales no tienen hilos
+            if self.catalogo_hilos.cargado(channel.guild.id):
+                hilos = self.catalogo_hilos.hilos_de(channel)
+            else:
+                self.catalogo_hilos.precargar(channel.guild)
+                hilos = [thread for thread in getattr(channel, 'threads', []) if not thread.archived]
+            
+            archivados = 0
+            for thread in hilos:
+                if thread.archived:
+                    if archivados >= 10:
+                        continue
+                    archivados += 1
+                relacionados['hilos_activos'].append({
+                    'nombre': f"{thread.name} (archivado)" if thread.archived else thread.name,
+                    'id': thread.id,
+                    'mensajes': thread.message_count if hasattr(thread, 'message_count') else 0
+                })
+        except Exception as e:
+            print(f"⚠️ No se pudieron listar los hilos de #{channel.name}: {e}")  # Algunos canales no tienen hilos
         
         relacionados['total'] = len(relacionados['foros']) + len(relacionados['hilos_activos'])
         return relacionados
     
     async def listar_hilos_foro(self, forum: discord.ForumChannel) -> List[discord.Thread]:
-        """Lista todos los hilos activos de un foro"""
-        hilos = []
+        """Lista los hilos activos y archivados recientes de un foro"""
+        await self.catalogo_hilos.cargar(forum.guild)
+        return self.catalogo_hilos.hilos_de(forum)
+    
+    async def analizar_canal(self, channel, mensaje_status=None, refrescar: bool = False,
+                             segundo_plano: bool = False) -> Dict:
+        """Analiza un canal con feedback detallado.
         
-        try:
-            # Obtener hilos activos
-            for thread in forum.threads:
-                if not thread.archived:
-                    hilos.append(thread)
-            
-            # Obtener hilos archivados recientes
-            async for thread in forum.archived_threads(limit=50):
-                # Solo incluir hilos de los últimos 30 días
-                if hasattr(thread, 'archive_timestamp'):
-                    dias_archivado = (datetime.now() - thread.archive_timestamp).days
-                    if dias_archivado <= 30:
-                        hilos.append(thread)
-            
-            # Ordenar por actividad más reciente
-            hilos.sort(key=lambda x: x.last_message_id or 0, reverse=True)
-            
-        except Exception as e:
-            print(f"Error listando hilos del foro: {e}")
+        Si hay un análisis previo solo se leen y analizan los mensajes nuevos
+        (posteriores a 'ultimo_mensaje_id') y se fusionan con el anterior.
+        Con refrescar=True se ignora la vigencia del caché.
         
-        return hilos
+        Si ya hay un análisis en curso del mismo canal no se lanza otro: se
+        espera ese mismo y su progreso se muestra también en `mensaje_status`.
+        Con segundo_plano=True (precalentado) sus llamadas a la IA ceden el
+        paso a las demás, hasta que alguien pida ese mismo canal.
+        """
+        if not segundo_plano:
+            self.precalentador.registrar_consulta(channel.id)
+        
+        if channel.id in self.en_vuelo:
+            tarea, grupo = self.en_vuelo[channel.id]
+            print(f"🔗 Uniéndose al análisis en curso de #{channel.name}")
+            metricas.incrementar('analisis_compartidos')
+            grupo.segundo_plano = grupo.segundo_plano and segundo_plano
+        else:
+            grupo = GrupoProgreso(segundo_plano)
+            tarea = asyncio.create_task(self._analizar_compartido(channel, grupo, refrescar))
+            self.en_vuelo[channel.id] = (tarea, grupo)
+        
+        progreso = grupo.agregar(mensaje_status)
+        try:
+            # Si un llamador se cancela, el análisis sigue para los demás
+            return await asyncio.shield(tarea)
+        finally:
+            # Que ninguna edición pendiente pise el resultado que escribe el llamador
+            await progreso.detener()
+    
+    async def _analizar_compartido(self, channel, progreso: GrupoProgreso, refrescar: bool) -> Dict:
+        analisis_actual.set(progreso)  # Lo heredan las tareas que se creen desde aquí
+        try:
+            with metricas.en_curso('analisis_en_curso'), metricas.tramo('analisis_canal'):
+                return await self._analizar_canal(channel, progreso, refrescar)
+        finally:
+            self.en_vuelo.pop(channel.id, None)
+            await progreso.detener()
     
-    async def analizar_canal(self, channel, mensaje_status=None) -> Dict:
-        """Analiza un canal con feedback detallado"""
+    async def _analizar_canal(self, channel, progreso: GrupoProgreso, refrescar: bool) -> Dict:
         
         # Verificar si es un foro
         if isinstance(channel, discord.ForumChannel):
             print(f"📂 Detectado canal de tipo Foro: {channel.name}")
             
-            if mensaje_status:
-                await mensaje_status.edit(content=f"📂 **{channel.name} es un foro**. Obteniendo lista de hilos...")
+            progreso.actualizar(f"📂 **{channel.name} es un foro**. Obteniendo lista de hilos...")
             
             # Obtener hilos del foro
             hilos = await self.listar_hilos_foro(channel)
@@ -633,135 +2644,132 @@ class CanalAnalyzer:
             }
         
         # Si ya está en caché, preguntar si re-analizar
-        if channel.id in self.analisis_cache:
-            cache_data = self.analisis_cache[channel.id]
-            tiempo_cache = datetime.fromisoformat(cache_data['timestamp_analisis'])
-            minutos_pasados = (datetime.now() - tiempo_cache).seconds // 60
-            
-            if minutos_pasados < 30:  # Cache válido por 30 minutos
-                return cache_data
+        anterior = await self.analisis_cache.obtener(channel.id)
+        if anterior and not refrescar:
+            if self._es_vigente(anterior, channel):
+                metricas.incrementar('cache_analisis', resultado='acierto')
+                return anterior
         
-        print(f"🔍 Analizando canal #{channel.name}...")
+        # Presupuesto diario del servidor: cerca del límite se leen menos mensajes
+        # y los resúmenes se combinan sin IA; superado, solo se usa lo ya guardado
+        modo = self.consumo.modo(channel.guild.id)
+        permitir_ia = modo != 'solo_cache'
+        limite = LIMITE_MENSAJES if modo == 'normal' else LIMITE_MENSAJES // 4
+        if modo == 'solo_cache' and anterior:
+            print(f"💸 Presupuesto agotado en {channel.guild.name}, se muestra el análisis anterior de #{channel.name}")
+            metricas.incrementar('cache_analisis', resultado='presupuesto')
+            return {**anterior, 'modo_presupuesto': modo}
         
-        # Recolectar mensajes con feedback
-        if mensaje_status:
-            await mensaje_status.edit(content=f"📊 **Recolectando mensajes** de #{channel.name}...\n⏳ Esto puede tomar unos segundos...")
+        # Análisis incremental: solo leer mensajes posteriores al último analizado
+        if anterior and not anterior.get('ultimo_mensaje_id'):
+            anterior = None  # Análisis antiguo sin marca de agua, repetir completo
+        elif anterior and self._es_degradado(anterior, channel.guild.id):
+            # Leyó menos mensajes y combinó sin IA: su marca de agua saltaría lo omitido
+            print(f"📈 El análisis anterior de #{channel.name} se hizo con presupuesto limitado, se repite completo")
+            anterior = None
+        metricas.incrementar('cache_analisis', resultado='incremental' if anterior else 'fallo')
+        despues_de = anterior['ultimo_mensaje_id'] if anterior else None
         
-        mensajes = []
-        mensajes_totales = 0
-        autores_unicos = set()
-        personajes_tupperbox = set()  # Para rastrear personajes de Tupperbox
+        if despues_de:
+            print(f"🔍 Actualizando canal #{channel.name} desde el mensaje {despues_de}...")
+        else:
+            print(f"🔍 Analizando canal #{channel.name}...")
+        
+        # Recolectar mensajes y analizarlos a la vez
+        progreso.actualizar(f"📊 **Recolectando mensajes** de #{channel.name}...\n⏳ Esto puede tomar unos segundos...")
         
         try:
-            async for msg in channel.history(limit=2000):  # Aumentamos el límite
-                mensajes_totales += 1
-                
-                # Detectar si es un mensaje de Tupperbox (webhook)
-                es_tupperbox = False
-                autor_real = msg.author.name
-                
-                # Los mensajes de Tupperbox vienen de webhooks
-                if msg.webhook_id:
-                    es_tupperbox = True
-                    # El nombre del webhook es el nombre del personaje
-                    autor_real = msg.author.name
-                    personajes_tupperbox.add(autor_real)
-                
-                # Incluir TODOS los mensajes con contenido (usuarios, bots y webhooks)
-                if msg.content:
-                    # Para Tupperbox, siempre incluir. Para otros bots, solo si son largos
-                    if es_tupperbox or not msg.author.bot or len(msg.content) > 100:
-                        mensajes.append({
-                            'id': msg.id,
-                            'autor': autor_real,
-                            'contenido': msg.content[:500],
-                            'timestamp': msg.created_at,
-                            'url': msg.jump_url,
-                            'es_bot': msg.author.bot and not es_tupperbox,
-                            'es_tupperbox': es_tupperbox
-                        })
-                        autores_unicos.add(autor_real)
-                
-                # Actualizar progreso cada 100 mensajes
-                if mensajes_totales % 100 == 0 and mensaje_status:
-                    await mensaje_status.edit(
-                        content=f"📊 **Recolectando mensajes** de #{channel.name}...\n"
-                                f"📈 {mensajes_totales} mensajes revisados\n"
-                                f"💬 {len(mensajes)} mensajes relevantes encontrados\n"
-                                f"👥 {len(autores_unicos)} usuarios únicos\n"
-                                f"🎭 {len(personajes_tupperbox)} personajes detectados"
-                    )
+            lectura = await self._recolectar_y_analizar(channel, despues_de, progreso, limite, permitir_ia)
         except discord.Forbidden:
             return {'error': 'No tengo permisos para leer este canal'}
         except Exception as e:
             return {'error': f'Error al leer canal: {str(e)}'}
         
-        if not mensajes:
-            return {'error': f'No se encontraron mensajes en este canal (revisados {mensajes_totales} mensajes totales)'}
+        mensajes_totales = lectura['mensajes_totales']
+        ultimo_mensaje_id = lectura['ultimo_mensaje_id'] or despues_de
+        autores_unicos = lectura['autores']
+        personajes_tupperbox = lectura['personajes']  # Para rastrear personajes de Tupperbox
+        resultados_chunks = lectura['resultados']
         
-        mensajes.reverse()  # Orden cronológico
+        if anterior and mensajes_totales >= limite:
+            # Hay más mensajes nuevos que el límite: equivale a un análisis completo
+            print(f"📈 Demasiados mensajes nuevos en #{channel.name}, se descarta el análisis anterior")
+            anterior = None
         
-        # Dividir en chunks para análisis
-        chunk_size = 50
-        chunks = [mensajes[i:i + chunk_size] for i in range(0, len(mensajes), chunk_size)]
+        if anterior is None and not lectura['mensajes_relevantes']:
+            return {'error': f'No se encontraron mensajes en este canal (revisados {mensajes_totales} mensajes totales)'}
         
-        if mensaje_status:
-            await mensaje_status.edit(
-                content=f"🤖 **Analizando con IA** {len(mensajes)} mensajes...\n"
-                        f"📊 Dividido en {len(chunks)} partes para análisis detallado\n"
-                        f"⏳ Procesando..."
-            )
+        # Partir del análisis anterior (si existe) y agregar solo lo nuevo
+        if anterior:
+            eventos = list(anterior.get('todos_eventos', anterior['eventos']))
+            resumen_general = anterior.get('resumen_ia', '')
+            temas_principales = anterior.get('temas_principales', [])
+            resumenes_parciales = list(anterior.get('resumenes_parciales') or [{
+                'resumen': resumen_general,
+                'temas': temas_principales,
+                'proposito_canal': anterior.get('proposito_canal', '')
+            }])
+            elementos_mundo = dict.fromkeys(anterior.get('elementos_mundo', []))
+            autores_unicos.update(anterior.get('lista_usuarios', []))
+            personajes_tupperbox.update(anterior.get('lista_personajes', []))
+            proposito_canal = anterior.get('proposito_canal', '')
+            mensajes_totales += anterior.get('total_mensajes_revisados', 0)
+            mensajes_analizados = anterior.get('mensajes_analizados', 0) + lectura['mensajes_relevantes']
+            mensaje_mas_antiguo = anterior.get('mensaje_mas_antiguo')
+            mensaje_mas_reciente = lectura['url_mas_reciente'] or anterior.get('mensaje_mas_reciente')
+        else:
+            eventos = []
+            resumen_general = ""
+            temas_principales = []
+            resumenes_parciales = []
+            elementos_mundo = {}  # Para acumular elementos únicos del mundo (en orden)
+            proposito_canal = ""
+            mensajes_analizados = lectura['mensajes_relevantes']
+            mensaje_mas_antiguo = lectura['url_mas_antigua']
+            mensaje_mas_reciente = lectura['url_mas_reciente']
         
-        # Analizar cada chunk
-        eventos = []
-        resumen_general = ""
-        temas_principales = []
-        elementos_mundo = set()  # Para acumular elementos únicos del mundo
-        
-        # Obtener lista de personajes de Tupperbox (si no la tenemos ya)
-        if 'personajes_tupperbox' not in locals():
-            personajes_tupperbox = set([msg['autor'] for msg in mensajes if msg.get('es_tupperbox')])
-        
-        for i, chunk in enumerate(chunks):
-            if mensaje_status:
-                porcentaje = int((i / len(chunks)) * 100)
-                await mensaje_status.edit(
-                    content=f"🤖 **Analizando con IA** - {porcentaje}%\n"
-                            f"📍 Procesando parte {i+1}/{len(chunks)}...\n"
-                            f"🔍 Detectando eventos y elementos del mundo"
-                )
-            
-            analisis_chunk = await self._analizar_chunk_con_ia(chunk, channel.name, i+1, len(chunks))
-            
+        # Resultados de los chunks en orden cronológico (eventos ya referenciados)
+        for analisis_chunk in resultados_chunks:
             if analisis_chunk.get('eventos'):
-                # Agregar referencia a mensajes específicos
-                for evento in analisis_chunk['eventos']:
-                    # Buscar mensaje relacionado y agregar metadatos
-                    for msg in chunk:
-                        if any(p in msg['autor'] for p in evento.get('participantes', [])):
-                            evento['mensaje_url'] = msg['url']
-                            evento['timestamp'] = msg['timestamp'].isoformat()
-                            break
-                
                 eventos.extend(analisis_chunk['eventos'])
             
             # Acumular elementos del mundo
             if analisis_chunk.get('elementos_mundo'):
-                elementos_mundo.update(analisis_chunk['elementos_mundo'])
+                elementos_mundo.update(dict.fromkeys(analisis_chunk['elementos_mundo']))
             
-            if i == 0:  # Primer chunk para resumen general
-                resumen_general = analisis_chunk.get('resumen', '')
-                temas_principales = analisis_chunk.get('temas', [])
+            # Resumen parcial de este chunk (hoja del árbol de reducción)
+            if analisis_chunk.get('resumen'):
+                resumenes_parciales.append({
+                    'resumen': analisis_chunk['resumen'],
+                    'temas': analisis_chunk.get('temas', []),
+                    'proposito_canal': analisis_chunk.get('proposito_canal', '')
+                })
+        
+        # Combinar los resúmenes parciales de todo el canal (map-reduce)
+        if len(resumenes_parciales) > MAX_RESUMENES_PARCIALES:
+            # Descartar los más antiguos en bloques que respetan la alineación del árbol
+            bloque = REDUCCION_GRUPO * REDUCCION_GRUPO
+            sobrantes = len(resumenes_parciales) - MAX_RESUMENES_PARCIALES
+            bloques = -(-sobrantes // bloque)  # Redondeo hacia arriba
+            resumenes_parciales = resumenes_parciales[bloques * bloque:]
+        
+        if resultados_chunks and resumenes_parciales:
+            if len(resumenes_parciales) > 1:
+                progreso.actualizar(f"🧠 **Combinando resúmenes** de {len(resumenes_parciales)} partes...")
+            
+            resumen_total = await self._reducir_resumenes(
+                resumenes_parciales, channel.name, (channel.guild.id, channel.id), permitir_ia=modo == 'normal'
+            )
+            resumen_general = resumen_total.get('resumen') or resumen_general
+            temas_principales = resumen_total.get('temas') or temas_principales
+            proposito_canal = resumen_total.get('proposito_canal') or proposito_canal
         
         # Detectar canales relacionados (hilos, etc)
-        canales_relacionados = await self.detectar_canales_relacionados(channel)
+        with metricas.tramo('hilos_relacionados'):
+            canales_relacionados = await self.detectar_canales_relacionados(channel)
         
-        # Consolidar análisis
-        proposito_canal = ""
-        for chunk_analisis in [a for a in [analisis_chunk] if a.get('proposito_canal')]:
-            if chunk_analisis.get('proposito_canal'):
-                proposito_canal = chunk_analisis['proposito_canal']
-                break
+        # Conservar solo los eventos más recientes entre actualizaciones
+        eventos = eventos[-MAX_EVENTOS_GUARDADOS:]
         
         # Información adicional sobre personajes si se detectaron
         info_personajes = ""
@@ -772,49 +2780,53 @@ class CanalAnalyzer:
             'canal_nombre': channel.name,
             'canal_id': channel.id,
             'total_mensajes_revisados': mensajes_totales,
-            'mensajes_analizados': len(mensajes),
+            'mensajes_analizados': mensajes_analizados,
             'usuarios_unicos': len(autores_unicos),
+            'lista_usuarios': list(autores_unicos),
             'personajes_tupperbox': len(personajes_tupperbox),
             'lista_personajes': list(personajes_tupperbox),
+            'resumen_ia': resumen_general,
+            'resumenes_parciales': resumenes_parciales,
             'resumen_general': resumen_general + info_personajes,
             'proposito_canal': proposito_canal,
             'temas_principales': temas_principales,
-            'elementos_mundo': list(elementos_mundo),  # Convertir set a lista
+            'elementos_mundo': list(elementos_mundo),  # Convertir a lista
             'num_eventos': len(eventos),
             'eventos': sorted(eventos, key=lambda x: x.get('importancia', 'baja') == 'alta', reverse=True)[:15],
+            'todos_eventos': eventos,
             'canales_relacionados': canales_relacionados,
             'timestamp_analisis': datetime.now().isoformat(),
-            'mensaje_mas_antiguo': mensajes[0]['url'] if mensajes else None,
-            'mensaje_mas_reciente': mensajes[-1]['url'] if mensajes else None
+            'ultimo_mensaje_id': ultimo_mensaje_id,
+            'mensaje_mas_antiguo': mensaje_mas_antiguo,
+            'mensaje_mas_reciente': mensaje_mas_reciente,
+            'modo_presupuesto': modo
         }
         
-        # Guardar en caché
-        self.analisis_cache[channel.id] = analisis_final
+        # Guardar en caché (con modo_presupuesto: si el análisis es degradado,
+        # el siguiente con presupuesto normal lo repite completo)
+        await self.analisis_cache.guardar(channel.id, analisis_final)
         
-        if mensaje_status:
-            await mensaje_status.edit(content="✅ **¡Análisis completado!**")
+        await progreso.finalizar("✅ **¡Análisis completado!**")
         
         return analisis_final
     
-    async def _analizar_chunk_con_ia(self, chunk: List[Dict], nombre_canal: str, parte: int, total_partes: int) -> Dict:
-        """Analiza un chunk de mensajes con IA"""
-        
-        # Preparar mensajes sin filtrar por bots
-        mensajes_texto = "\n".join([
-            f"[{msg['autor']}]{' (personaje)' if msg.get('es_tupperbox') else ''}: {msg['contenido']}"
-            for msg in chunk[:40]  # Limitamos para no exceder tokens
-        ])
-        
-        # Contar personajes únicos en este chunk
-        personajes_en_chunk = set([msg['autor'] for msg in chunk if msg.get('es_tupperbox')])
-        
-        prompt = f"""
-Analiza estos mensajes del canal #{nombre_canal} (Parte {parte}/{total_partes}).
+    @staticmethod
+    def _formatear_mensaje(msg: RegistroMensaje, indice: int) -> str:
+        """Línea de un mensaje tal como se envía a la IA (numerada dentro del chunk)"""
+        return f"{indice}. [{msg.autor}]{' (personaje)' if msg.es_tupperbox else ''}: {msg.contenido}"
+    
+    @staticmethod
+    def _construir_prompt(mensajes_texto: str, nombre_canal: str, parte: Optional[int] = None,
+                          total_partes: Optional[int] = None) -> str:
+        """Prompt de análisis de un chunk"""
+        etiqueta_parte = f" (Parte {parte}/{total_partes})" if parte and total_partes else ""
+        return f"""
+Analiza estos mensajes del canal #{nombre_canal}{etiqueta_parte}.
 
 CONTEXTO: Este es un servidor de roleplay/gaming donde los usuarios usan Tupperbox para interpretar personajes.
 Los mensajes marcados como "(personaje)" son de personajes de roleplay, NO usuarios normales.
 
-MENSAJES:
+MENSAJES (cada línea empieza con su número):
 {mensajes_texto}
 
 INSTRUCCIONES CRÍTICAS:
@@ -855,36 +2867,317 @@ Responde en JSON:
             "importancia": "alta/media/baja",
             "elementos_lore": ["elementos del mundo involucrados"],
             "ubicacion": "lugar específico donde ocurre",
-            "cita_relevante": "frase exacta importante del roleplay"
+            "cita_relevante": "frase exacta importante del roleplay",
+            "mensaje": 12
         }}
     ]
 }}
 
-NOTA: Los "participantes" deben ser los NOMBRES DE LOS PERSONAJES, no los usuarios."""
+NOTA: Los "participantes" deben ser los NOMBRES DE LOS PERSONAJES, no los usuarios.
+"mensaje" es el NÚMERO de la línea donde ocurre el evento."""
+    
+    def _crear_empaquetador(self, nombre_canal: str) -> 'EmpaquetadorChunks':
+        """Empaquetador con el presupuesto que dejan libre las instrucciones del prompt"""
+        base = estimar_tokens(self._construir_prompt('', nombre_canal, 9999, 9999))
+        presupuesto = max(PRESUPUESTO_TOKENS_CHUNK - base, MAX_TOKENS_MENSAJE)
+        # El número real se asigna al cerrar el chunk; 999 reserva su ancho
+        return EmpaquetadorChunks(presupuesto, lambda msg: self._formatear_mensaje(msg, 999))
+    
+    @staticmethod
+    def _atribuir_eventos(analisis_chunk: Dict, chunk: List[RegistroMensaje]):
+        """Agrega a cada evento la referencia al mensaje del chunk donde ocurre.
+        
+        Usa el número de línea que devuelve la IA. Si falta o no es válido,
+        recurre al primer mensaje de alguno de los participantes a través de
+        un índice {nombre o palabra del autor: primera posición}.
+        """
+        eventos = analisis_chunk.get('eventos') or []
+        if not eventos:
+            return
+        
+        posiciones = {}
+        for posicion, msg in enumerate(chunk):
+            autor = msg.autor.casefold()
+            posiciones.setdefault(autor, posicion)
+            for palabra in autor.split():
+                if len(palabra) > 2:
+                    posiciones.setdefault(palabra, posicion)
+        
+        for evento in eventos:
+            try:
+                posicion = int(evento.get('mensaje')) - 1
+            except (TypeError, ValueError):
+                posicion = -1
+            
+            if not 0 <= posicion < len(chunk):
+                candidatas = [
+                    posiciones[clave]
+                    for participante in evento.get('participantes') or []
+                    if isinstance(participante, str)
+                    for clave in (participante.casefold(), *participante.casefold().split())
+                    if clave in posiciones
+                ]
+                if not candidatas:
+                    continue
+                posicion = min(candidatas)
+            
+            msg = chunk[posicion]
+            evento['mensaje_id'] = msg.id
+            evento['mensaje_url'] = msg.url
+            evento['timestamp'] = msg.timestamp.isoformat()
+    
+    def _hay_trabajo_interactivo(self) -> bool:
+        """Hay un análisis pedido por un usuario en curso o llamadas a la IA esperando turno"""
+        return (self.llm.limitador.en_cola > 0
+                or any(not grupo.segundo_plano for _, grupo in self.en_vuelo.values()))
+    
+    async def _ceder_a_interactivos(self):
+        """Pausa un análisis de segundo plano mientras haya trabajo interactivo.
+        
+        Se llama antes de cada chunk, de cada reducción y de cada página del
+        historial; si un usuario pide el mismo canal, el análisis deja de ser
+        de segundo plano y sigue sin esperar.
+        """
+        origen = analisis_actual.get()
+        while origen is not None and origen.segundo_plano and self._hay_trabajo_interactivo():
+            await asyncio.sleep(0.25)
+    
+    async def _recolectar_y_analizar(self, channel, despues_de: Optional[int], progreso: GrupoProgreso,
+                                     limite: int = LIMITE_MENSAJES, permitir_ia: bool = True) -> Dict:
+        """Lee el historial y analiza sus chunks (productor/consumidor).
+        
+        El historial se recorre del más nuevo al más antiguo (como mucho
+        `limite` mensajes) y se empaqueta sobre la marcha: cada chunk lleno va
+        a una cola acotada que CHUNKS_CONCURRENTES consumidores analizan
+        mientras sigue la lectura. Los mensajes ancla cierran siempre su
+        chunk, así que al llegar mensajes nuevos solo cambian los chunks
+        posteriores a la última ancla y el resto sale del caché de la IA.
+        Un chunk lento o fallido no frena a los demás. Con permitir_ia=False
+        solo se aprovechan respuestas ya en caché.
+        """
+        cola = asyncio.Queue(maxsize=CHUNKS_CONCURRENTES)
+        resultados = {}  # {posición: análisis}, la posición 0 es el chunk más reciente
+        lectura = {
+            'mensajes_totales': 0,
+            'mensajes_relevantes': 0,
+            'ultimo_mensaje_id': None,
+            'autores': set(),
+            'personajes': set(),
+            'url_mas_reciente': None,
+            'url_mas_antigua': None
+        }
+        enviados = 0
+        
+        def informar():
+            progreso.actualizar(
+                f"🤖 **Analizando con IA** #{channel.name}...\n"
+                f"📈 {lectura['mensajes_totales']} mensajes revisados\n"
+                f"💬 {lectura['mensajes_relevantes']} mensajes relevantes\n"
+                f"📍 {len(resultados)}/{enviados} partes completadas\n"
+                f"🎭 {len(lectura['personajes'])} personajes detectados"
+            )
+        
+        async def consumidor():
+            while True:
+                item = await cola.get()
+                if item is None:
+                    return
+                posicion, chunk = item
+                await self._ceder_a_interactivos()
+                try:
+                    resultado = await self._analizar_chunk_con_ia(chunk, channel.name, permitir_ia=permitir_ia)
+                except Exception as e:
+                    print(f"❌ Error en una parte de {channel.name}: {e}")
+                    resultado = {"resumen": "", "temas": [], "eventos": []}
+                self._atribuir_eventos(resultado, chunk)
+                resultados[posicion] = resultado
+                informar()
+        
+        async def enviar(chunk: List[RegistroMensaje]):
+            nonlocal enviados
+            chunk.reverse()  # Orden cronológico dentro del chunk
+            await cola.put((enviados, chunk))
+            enviados += 1
+            informar()
+        
+        consumidores = [asyncio.create_task(consumidor()) for _ in range(CHUNKS_CONCURRENTES)]
+        empaquetador = self._crear_empaquetador(channel.name)
+        empaquetado = 0.0  # Tiempo total dentro del empaquetador
+        try:
+            async with aclosing(self.espejo.flujo(channel, despues_de, limite)) as flujo:
+                async for msg in flujo:
+                    lectura['mensajes_totales'] += 1
+                    if lectura['ultimo_mensaje_id'] is None:
+                        lectura['ultimo_mensaje_id'] = msg.id
+                    
+                    # Los mensajes de Tupperbox vienen de webhooks: el autor es el personaje
+                    if msg.es_tupperbox:
+                        lectura['personajes'].add(msg.autor)
+                    
+                    # Incluir TODOS los mensajes con contenido (usuarios, bots y webhooks)
+                    # Para Tupperbox, siempre incluir. Para otros bots, solo si son largos
+                    if msg.contenido and (msg.es_tupperbox or not msg.es_bot or len(msg.contenido) > 100):
+                        lectura['mensajes_relevantes'] += 1
+                        lectura['autores'].add(msg.autor)
+                        lectura['url_mas_reciente'] = lectura['url_mas_reciente'] or msg.url
+                        lectura['url_mas_antigua'] = msg.url
+                        
+                        inicio = time.perf_counter()
+                        chunk = empaquetador.agregar(msg)
+                        empaquetado += time.perf_counter() - inicio
+                        if chunk:
+                            await enviar(chunk)
+                        if EmpaquetadorChunks.es_ancla(msg.id):
+                            await enviar(empaquetador.vaciar())
+                    
+                    if lectura['mensajes_totales'] % 100 == 0:  # Una página del historial
+                        informar()
+                        await self._ceder_a_interactivos()
+            
+            chunk = empaquetador.vaciar()
+            if chunk:
+                await enviar(chunk)
+            metricas.registrar('empaquetado', empaquetado)
+            for _ in consumidores:
+                await cola.put(None)
+            await asyncio.gather(*consumidores)
+        except BaseException:
+            for tarea in consumidores:
+                tarea.cancel()
+            raise
+        
+        # Orden cronológico: del chunk más antiguo (última posición) al más reciente
+        lectura['resultados'] = [resultados[posicion] for posicion in sorted(resultados, reverse=True)]
+        return lectura
+    
+    async def _reducir_resumenes(self, parciales: List[Dict], nombre_canal: str, origen: Tuple[int, int],
+                                 permitir_ia: bool = True) -> Dict:
+        """Combina resúmenes parciales en un árbol de reducciones.
+        
+        Cada nivel agrupa REDUCCION_GRUPO resúmenes consecutivos y combina los
+        grupos en paralelo, hasta quedar uno solo. Los grupos se alinean desde
+        el inicio, así que al añadir partes nuevas solo cambian las ramas del
+        final: el resto sale del caché de respuestas de la IA. Con
+        permitir_ia=False las ramas que no estén en caché se combinan sin IA.
+        """
+        semaforo = asyncio.Semaphore(CHUNKS_CONCURRENTES)
+        
+        async def reducir(grupo: List[Dict]) -> Dict:
+            if len(grupo) == 1:
+                return grupo[0]
+            await self._ceder_a_interactivos()
+            async with semaforo:
+                resultado = await self._reducir_grupo_con_ia(grupo, nombre_canal, origen, permitir_ia)
+            
+            if resultado is None:
+                return self._combinar_sin_ia(grupo)
+            return resultado
+        
+        nivel = parciales
+        while len(nivel) > 1:
+            grupos = [nivel[i:i + REDUCCION_GRUPO] for i in range(0, len(nivel), REDUCCION_GRUPO)]
+            nivel = await asyncio.gather(*(reducir(grupo) for grupo in grupos))
+        return nivel[0] if nivel else {}
+    
+    @staticmethod
+    def _combinar_sin_ia(grupo: List[Dict]) -> Dict:
+        """Combinación simple de resúmenes cuando la IA no responde"""
+        temas = list(dict.fromkeys(t for r in grupo for t in r.get('temas', [])))
+        propositos = [r['proposito_canal'] for r in grupo if r.get('proposito_canal')]
+        return {
+            'resumen': ' '.join(r['resumen'] for r in grupo if r.get('resumen'))[:1500],
+            'temas': temas[:5],
+            'proposito_canal': max(set(propositos), key=propositos.count) if propositos else ''
+        }
+    
+    async def _reducir_grupo_con_ia(self, grupo: List[Dict], nombre_canal: str, origen: Tuple[int, int],
+                                    permitir_ia: bool = True) -> Optional[Dict]:
+        """Combina varios resúmenes parciales en uno. Devuelve None si falla"""
+        clave = CacheRespuestasIA.calcular_clave('reduccion', MODELO_IA, VERSION_PROMPT_REDUCCION, grupo)
+        en_cache = await self.cache_ia.obtener(clave)
+        if en_cache is not None or not permitir_ia:
+            return en_cache
+        
+        partes_texto = "\n\n".join(
+            f"PARTE {i}:\nResumen: {r.get('resumen', '')}\n"
+            f"Temas: {', '.join(r.get('temas', []))}\n"
+            f"Propósito: {r.get('proposito_canal', '')}"
+            for i, r in enumerate(grupo, 1)
+        )
+        prompt = f"""
+Estos son resúmenes parciales, en orden cronológico, del canal #{nombre_canal}.
+Combínalos en un único resumen de toda la historia, sin perder personajes ni sucesos clave.
+
+{partes_texto}
+
+Responde en JSON:
+{{
+    "resumen": "resumen ESPECÍFICO de la historia completa (máximo 6 frases)",
+    "temas": ["máximo 5 temas principales"],
+    "proposito_canal": "roleplay/información/social/reglas/mercado/batalla/otro"
+}}"""
         
         try:
-            # Hacer la llamada asíncrona con timeout
-            import asyncio
-            
-            # Crear una tarea con timeout
-            async def llamar_openai():
-                loop = asyncio.get_event_loop()
-                # Ejecutar en un thread separado para no bloquear
-                response = await loop.run_in_executor(
-                    None,
-                    lambda: self.client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.5,
-                        max_tokens=800,
-                        timeout=15  # Timeout de 15 segundos
-                    )
-                )
-                return response
+            inicio = time.perf_counter()
+            response = await self.llm.completar(
+                model=MODELO_IA,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3,
+                max_tokens=500,
+                timeout=20
+            )
+            latencia = time.perf_counter() - inicio
+            await self._contabilizar(origen, response, latencia)
+            with metricas.tramo('parseo_json'):
+                resultado = json.loads(response['choices'][0]['message']['content'].strip())
+            if not isinstance(resultado, dict) or not resultado.get('resumen'):
+                return None
             
+            combinado = {
+                'resumen': resultado['resumen'],
+                'temas': resultado.get('temas', [])[:5],
+                'proposito_canal': resultado.get('proposito_canal', '')
+            }
+            await self.cache_ia.guardar(clave, combinado, response.get('usage', {}).get('total_tokens', 0), latencia)
+            return combinado
+        except Exception as e:
+            print(f"❌ Error combinando resúmenes de {nombre_canal}: {e}")
+            return None
+    
+    async def _analizar_chunk_con_ia(self, chunk: List[RegistroMensaje], nombre_canal: str, parte: Optional[int] = None,
+                                     total_partes: Optional[int] = None, permitir_ia: bool = True) -> Dict:
+        """Analiza un chunk de mensajes con IA (con permitir_ia=False, solo desde el caché)"""
+        
+        # Preparar mensajes sin filtrar por bots (el empaquetador ya ajustó el tamaño)
+        mensajes_texto = "\n".join(self._formatear_mensaje(msg, i) for i, msg in enumerate(chunk, 1))
+        prompt = self._construir_prompt(mensajes_texto, nombre_canal, parte, total_partes)
+        
+        # Un chunk con los mismos mensajes, modelo y prompt no vuelve a la API
+        clave = CacheRespuestasIA.calcular_clave(
+            'chunk', MODELO_IA, VERSION_PROMPT_CHUNK,
+            [(msg.id, msg.autor, msg.es_tupperbox, msg.contenido) for msg in chunk]
+        )
+        en_cache = await self.cache_ia.obtener(clave)
+        if en_cache is not None:
+            return en_cache
+        if not permitir_ia:
+            return {"resumen": "", "temas": [], "eventos": []}
+        
+        try:
             try:
-                response = await asyncio.wait_for(llamar_openai(), timeout=20)
-                respuesta_texto = response.choices[0].message.content.strip()
+                # El timeout cancela también la petición HTTP subyacente
+                # (la espera en la cola del limitador no cuenta)
+                inicio = time.perf_counter()
+                response = await self.llm.completar(
+                    model=MODELO_IA,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.5,
+                    max_tokens=800,
+                    timeout=20
+                )
+                latencia = time.perf_counter() - inicio
+                await self._contabilizar((chunk[0].guild_id, chunk[0].channel_id), response, latencia)
+                respuesta_texto = response['choices'][0]['message']['content'].strip()
             except asyncio.TimeoutError:
                 print(f"⏱️ Timeout en análisis IA para {nombre_canal}")
                 return {
@@ -900,10 +3193,12 @@ NOTA: Los "participantes" deben ser los NOMBRES DE LOS PERSONAJES, no los usuari
             
             # Intentar parsear como JSON
             try:
-                resultado = json.loads(respuesta_texto)
+                with metricas.tramo('parseo_json'):
+                    resultado = json.loads(respuesta_texto)
                 # Asegurar que tiene la estructura esperada
                 if 'eventos' not in resultado:
                     resultado['eventos'] = []
+                await self.cache_ia.guardar(clave, resultado, response.get('usage', {}).get('total_tokens', 0), latencia)
                 return resultado
             except:
                 # Si falla el parseo, crear estructura básica
@@ -913,7 +3208,7 @@ NOTA: Los "participantes" deben ser los NOMBRES DE LOS PERSONAJES, no los usuari
                     "eventos": [{
                         "tipo": "actividad",
                         "descripcion": "Actividad general del canal",
-                        "participantes": list(set([msg['autor'] for msg in chunk[:5] if not msg.get('es_bot')])),
+                        "participantes": list(set([msg.autor for msg in chunk[:5] if msg.es_tupperbox or not msg.es_bot])),
                         "importancia": "media"
                     }]
                 }
@@ -938,12 +3233,41 @@ class ObserverBot(commands.Bot):
         
         self.analyzer = CanalAnalyzer()
         self.servidores_activos = set()
+        self.revalidaciones = set()  # Actualizaciones en segundo plano de análisis caducados
+        self.exportador = ExportadorHistorial()
+    
+    async def setup_hook(self):
+        await metricas.iniciar()
+        self.analyzer.precalentador.iniciar(self.get_channel)
+    
+    async def close(self):
+        await self.analyzer.precalentador.detener()
+        await metricas.detener()
+        await self.analyzer.llm.cerrar()
+        await super().close()
     
     async def on_ready(self):
         print(f'✅ {self.user} está listo!')
         print(f'📊 Conectado a {len(self.guilds)} servidores')
         print(f'📌 Versión con botones interactivos activa')
         
+        # Pudo haber mensajes mientras estábamos desconectados
+        self.analyzer.espejo.marcar_desconectado()
+        
+        # Cargar los mapas guardados y reconciliarlos con la caché del gateway
+        # (los números de canal se conservan; no se consulta la API)
+        for guild in self.guilds:
+            if await self.analyzer.cargar_mapa(guild.id):
+                await self.analyzer.mapear_servidor(guild)
+                self.servidores_activos.add(guild.id)
+            # Catalogar los hilos en segundo plano para que foros y selectores abran al instante.
+            # En una reconexión basta con los hilos activos que ya trae la caché de discord.py
+            if self.analyzer.catalogo_hilos.cargado(guild.id):
+                for thread in guild.threads:
+                    self.analyzer.catalogo_hilos.registrar(thread)
+            else:
+                self.analyzer.catalogo_hilos.precargar(guild)
+        
         await self.change_presence(
             activity=discord.Activity(
                 type=discord.ActivityType.listening,
@@ -952,6 +3276,11 @@ class ObserverBot(commands.Bot):
         )
     
     async def on_message(self, message):
+        # Mantener al día la copia local (incluye bots y Tupperbox)
+        if message.guild:
+            await self.analyzer.espejo.registrar(message)
+            self.analyzer.precalentador.registrar_mensaje(message.channel.id)
+        
         # Ignorar mensajes propios y de bots
         if message.author.bot:
             return
@@ -963,6 +3292,44 @@ class ObserverBot(commands.Bot):
         
         await self.process_commands(message)
     
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if 'content' in payload.data:
+            await self.analyzer.espejo.editar(payload.channel_id, payload.message_id, payload.data['content'])
+    
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        await self.analyzer.espejo.eliminar(payload.channel_id, [payload.message_id])
+    
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        await self.analyzer.espejo.eliminar(payload.channel_id, payload.message_ids)
+    
+    async def on_guild_channel_create(self, channel):
+        await self.analyzer.actualizar_canal(channel)
+    
+    async def on_guild_channel_update(self, before, after):
+        await self.analyzer.actualizar_canal(after)
+    
+    async def on_guild_channel_delete(self, channel):
+        self.analyzer.catalogo_hilos.eliminar_padre(channel.guild.id, channel.id)
+        await self.analyzer.eliminar_canal(channel.guild.id, channel.id)
+    
+    async def on_thread_create(self, thread: discord.Thread):
+        self.analyzer.catalogo_hilos.registrar(thread)
+        await self.analyzer.actualizar_canal(thread)
+    
+    async def on_thread_join(self, thread: discord.Thread):
+        # También llega cuando se desarchiva un hilo que no estaba en caché
+        self.analyzer.catalogo_hilos.registrar(thread)
+        await self.analyzer.actualizar_canal(thread)
+    
+    async def on_thread_update(self, before: discord.Thread, after: discord.Thread):
+        self.analyzer.catalogo_hilos.registrar(after)
+        await self.analyzer.actualizar_canal(after)
+    
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
+        # Versión raw: también llega para hilos archivados que no están en caché
+        self.analyzer.catalogo_hilos.eliminar(payload.guild_id, payload.thread_id)
+        await self.analyzer.eliminar_canal(payload.guild_id, payload.thread_id)
+    
     async def procesar_comando_natural(self, message: discord.Message):
         """Procesa comandos en lenguaje natural"""
         
@@ -982,8 +3349,27 @@ class ObserverBot(commands.Bot):
             self.servidores_activos.add(message.guild.id)
             await asyncio.sleep(1)
         
+        # Detectar intención: métricas de rendimiento (solo administradores).
+        # La palabra clave debe abrir el mensaje: puede ser parte del nombre de un canal
+        contenido_lower = contenido.lower()
+        if re.match(r'(m[ée]tricas|rendimiento)\b', contenido_lower):
+            await self.comando_metricas(message)
+        
+        # Detectar intención: consumo de la IA y presupuesto diario (solo administradores)
+        elif re.match(r'(consumo|gastos?|presupuesto)\b', contenido_lower):
+            await self.comando_consumo(message, contenido_lower)
+        
+        # Detectar intención: exportar el historial de un canal (solo administradores)
+        elif re.search(r'\bexporta(r)?\b', contenido_lower):
+            await self.comando_exportar_canal(message, contenido)
+        
+        # Detectar intención: analizar una categoría o todo el servidor
+        elif (any(palabra in contenido_lower for palabra in ['analiza', 'analizar']) and
+                self._es_analisis_por_lotes(message, contenido_lower)):
+            await self.comando_analizar_lote(message, contenido)
+        
         # Detectar intención: analizar canal
-        if any(palabra in contenido.lower() for palabra in ['analiza', 'analizar', 'mira', 'revisa', 'checa', 'canal']):
+        elif any(palabra in contenido.lower() for palabra in ['analiza', 'analizar', 'mira', 'revisa', 'checa', 'canal']):
             await self.comando_analizar_canal(message, contenido)
         
         # Detectar intención: listar canales
@@ -994,15 +3380,33 @@ class ObserverBot(commands.Bot):
         else:
             await self.comando_ayuda(message)
     
-    def crear_embed_analisis(self, analisis: Dict, es_hilo: bool = False) -> discord.Embed:
-        """Crea un embed con los resultados del análisis"""
+    def crear_embed_analisis(self, analisis: Dict, es_hilo: bool = False, caducado: bool = False,
+                             aviso: Optional[str] = None) -> discord.Embed:
+        """Crea un embed con los resultados del análisis.
+        
+        Con caducado=True se indica la antigüedad del análisis y que se está
+        actualizando (o `aviso`, si no se pudo actualizar).
+        """
+        with metricas.tramo('crear_embed'):
+            return self._crear_embed_analisis(analisis, es_hilo, caducado, aviso)
+    
+    @staticmethod
+    def _formatear_antiguedad(minutos: float) -> str:
+        if minutos < 90:
+            return f"{minutos:.0f} min"
+        if minutos < 48 * 60:
+            return f"{minutos / 60:.0f} h"
+        return f"{minutos / 1440:.0f} días"
+    
+    def _crear_embed_analisis(self, analisis: Dict, es_hilo: bool, caducado: bool, aviso: Optional[str]) -> discord.Embed:
         
         # Si es un foro, crear embed especial
         if analisis.get('es_foro') or analisis.get('tipo_canal') == 'foro':
             embed = discord.Embed(
                 title=f"📂 Foro: {analisis['canal_nombre']}",
                 description=f"Este es un canal de tipo **Foro** con {analisis['total_hilos']} hilos disponibles.\n\n"
-                           f"Selecciona un hilo del menú desplegable para analizarlo en detalle.",
+                           f"Selecciona un hilo del menú desplegable para analizarlo en detalle, "
+                           f"o pulsa **Analizar foro completo** para un informe de todos los hilos.",
                 color=0x5865F2  # Color morado de Discord para foros
             )
             
@@ -1057,9 +3461,17 @@ class ObserverBot(commands.Bot):
         embed = discord.Embed(
             title=titulo,
             description=descripcion_canal,
-            color=0x00ff00
+            color=0xFEE75C if caducado else 0x00ff00
         )
         
+        if caducado:
+            antiguedad = self._formatear_antiguedad(CacheAnalisis.edad_minutos(analisis))
+            embed.add_field(
+                name=f"⏳ Análisis de hace {antiguedad}",
+                value=aviso or "Actualizando en segundo plano... este mensaje se editará con el resultado.",
+                inline=False
+            )
+        
         # Estadísticas
         stats_text = f"• **Mensajes totales**: {analisis['total_mensajes_revisados']:,}\n"
         stats_text += f"• **Mensajes analizados**: {analisis['mensajes_analizados']:,}\n"
@@ -1169,10 +3581,46 @@ class ObserverBot(commands.Bot):
                     inline=False
                 )
         
-        embed.set_footer(text=f"Análisis realizado el {datetime.now().strftime('%Y-%m-%d %H:%M')} • Caché válido por 30 min")
+        modo = analisis.get('modo_presupuesto', 'normal')
+        if modo != 'normal':
+            embed.add_field(
+                name="💸 Presupuesto de IA",
+                value="Límite diario alcanzado: se muestra lo ya analizado, sin nuevas consultas a la IA."
+                      if modo == 'solo_cache' else
+                      f"Cerca del límite diario: análisis reducido a los últimos {LIMITE_MENSAJES // 4} mensajes.",
+                inline=False
+            )
+        
+        realizado = datetime.fromisoformat(analisis['timestamp_analisis'])
+        embed.set_footer(text=f"Análisis realizado el {realizado.strftime('%Y-%m-%d %H:%M')} • Caché válido por {CACHE_TTL_MINUTOS} min")
         
         return embed
     
+    @staticmethod
+    def _extraer_busqueda(contenido: str) -> str:
+        """Nombre o número de canal de un comando de análisis"""
+        # Limpiar el contenido de palabras clave
+        palabras_clave = ['analiza', 'analizar', 'el', 'canal', 'mira', 'revisa', 'checa', '@observer']
+        busqueda = contenido.lower()
+        
+        # Eliminar las palabras clave
+        for palabra in palabras_clave:
+            busqueda = busqueda.replace(palabra, ' ')
+        
+        # Limpiar espacios múltiples
+        return ' '.join(busqueda.split()).strip()
+    
+    def _es_analisis_por_lotes(self, message: discord.Message, contenido_lower: str) -> bool:
+        """Pide una categoría o todo el servidor, y no es el nombre de un único canal"""
+        if message.channel_mentions:
+            return False
+        # Frases explícitas; el guion cuenta como parte de la palabra ("todo-rol" es un canal)
+        if not re.search(r'(?<![\w-])(?:categor[ií]a\s+\S|(?:todo el servidor|todos los canales|el servidor)(?![\w-]))',
+                         contenido_lower):
+            return False
+        indice = self.analyzer.indices_nombres.get(message.guild.id)
+        return not (indice and indice.buscar_exacto(self._extraer_busqueda(contenido_lower)))
+    
     async def comando_analizar_canal(self, message: discord.Message, contenido: str):
         """Analiza un canal específico"""
         
@@ -1188,16 +3636,7 @@ class ObserverBot(commands.Bot):
             else:
                 busqueda = canal_mencionado.name
         else:
-            # Limpiar el contenido de palabras clave
-            palabras_clave = ['analiza', 'analizar', 'el', 'canal', 'mira', 'revisa', 'checa', '@observer']
-            busqueda = contenido.lower()
-            
-            # Eliminar las palabras clave
-            for palabra in palabras_clave:
-                busqueda = busqueda.replace(palabra, ' ')
-            
-            # Limpiar espacios múltiples
-            busqueda = ' '.join(busqueda.split()).strip()
+            busqueda = self._extraer_busqueda(contenido)
         
         print(f"📝 Comando recibido: '{contenido}'")
         print(f"🔍 Búsqueda extraída: '{busqueda}'")
@@ -1229,17 +3668,10 @@ class ObserverBot(commands.Bot):
             )
             
             # Buscar canales similares
-            sugerencias = []
-            busqueda_palabras = busqueda.lower().split()
-            
-            for num, canal in canales.items():
-                nombre_lower = canal.nombre.lower()
-                # Si alguna palabra de la búsqueda está en el nombre
-                if any(palabra in nombre_lower for palabra in busqueda_palabras if len(palabra) > 2):
-                    sugerencias.append(f"**{num}.** {canal.nombre}")
-                    
-                if len(sugerencias) >= 10:
-                    break
+            sugerencias = [
+                f"**{canal.numero}.** {canal.nombre}"
+                for canal in self.analyzer.sugerir_canales(message.guild.id, busqueda)
+            ]
             
             if sugerencias:
                 embed.add_field(
@@ -1274,6 +3706,16 @@ class ObserverBot(commands.Bot):
             await message.channel.send("❌ No puedo acceder a ese canal.")
             return
         
+        # Si hay un análisis caducado se muestra ya y se actualiza en segundo plano
+        caducado = await self.analyzer.analisis_caducado(channel)
+        if caducado:
+            vista = AnalisisView(self, caducado, canal_info)
+            status_msg = await message.channel.send(embed=self.crear_embed_analisis(caducado, caducado=True), view=vista)
+            tarea = asyncio.create_task(self.revalidar_analisis(status_msg, vista, caducado, channel, canal_info))
+            self.revalidaciones.add(tarea)
+            tarea.add_done_callback(self.revalidaciones.discard)
+            return
+        
         # Mensaje de estado
         status_msg = await message.channel.send(f"🔍 **Iniciando análisis** de #{canal_info.nombre}...")
         
@@ -1293,7 +3735,7 @@ class ObserverBot(commands.Bot):
                 # Vista especial para foros
                 hilos = [
                     message.guild.get_thread(h['id']) or 
-                    channel.get_thread(h['id']) 
+                    self.analyzer.catalogo_hilos.obtener(message.guild.id, h['id'])
                     for h in analisis.get('hilos', [])
                 ]
                 hilos = [h for h in hilos if h is not None]  # Filtrar None
@@ -1315,6 +3757,313 @@ class ObserverBot(commands.Bot):
             import traceback
             traceback.print_exc()
     
+    async def revalidar_analisis(self, mensaje: discord.Message, vista: discord.ui.View, caducado: Dict,
+                                 channel, canal_info: CanalInfo):
+        """Re-analiza el canal y reemplaza en el mensaje el análisis caducado por el nuevo.
+        
+        Si no se puede actualizar, el análisis caducado se queda marcado como
+        tal, con el motivo y sin botones.
+        """
+        try:
+            analisis = await self.analyzer.analizar_canal(channel)
+            if 'error' in analisis:
+                aviso = f"⚠️ No se pudo actualizar: {analisis['error']}"
+            elif analisis.get('timestamp_analisis') == caducado.get('timestamp_analisis'):
+                # Presupuesto agotado: se devolvió el mismo análisis de antes
+                aviso = "⚠️ No se pudo actualizar: se alcanzó el límite diario de IA del servidor."
+            else:
+                vista.stop()
+                await mensaje.edit(embed=self.crear_embed_analisis(analisis), view=AnalisisView(self, analisis, canal_info))
+                return
+        except Exception as e:
+            print(f"❌ Error actualizando el análisis de #{channel.name}: {e}")
+            aviso = "⚠️ No se pudo actualizar el análisis. Vuelve a pedirlo en unos minutos."
+        
+        vista.stop()
+        try:
+            await mensaje.edit(embed=self.crear_embed_analisis(caducado, caducado=True, aviso=aviso), view=None)
+        except discord.HTTPException as e:
+            print(f"⚠️ No se pudo marcar el análisis caducado de #{channel.name}: {e}")
+    
+    def crear_embed_lote(self, lote: Dict, titulo: str) -> discord.Embed:
+        """Crea un embed con el resumen de un análisis por lotes"""
+        embed = discord.Embed(
+            title=f"📦 Análisis por lotes: {titulo}",
+            description=f"**{len(lote['canales'])}/{lote['total']} canales** analizados en {lote['duracion']:.0f} s",
+            color=0x00ff00
+        )
+        
+        total_eventos = sum(a.get('num_eventos', 0) for _, a in lote['canales'])
+        personajes = {p for _, a in lote['canales'] for p in a.get('lista_personajes', [])}
+        embed.add_field(
+            name="📈 Estadísticas",
+            value=f"• **Eventos detectados**: {total_eventos}\n"
+                  f"• **Personajes de RP**: {len(personajes)}\n"
+                  f"• **Desde caché**: {lote['desde_cache']}\n"
+                  f"• **Con errores**: {len(lote['errores'])}",
+            inline=False
+        )
+        
+        # Canales con más eventos
+        mas_activos = sorted(lote['canales'], key=lambda c: c[1].get('num_eventos', 0), reverse=True)
+        lineas = []
+        for canal_info, analisis in mas_activos[:10]:
+            linea = f"**{canal_info.numero}.** {canal_info.nombre[:40]} — {analisis.get('num_eventos', 0)} eventos"
+            if analisis.get('proposito_canal'):
+                linea += f" • {analisis['proposito_canal']}"
+            lineas.append(linea)
+        if lineas:
+            valor = '\n'.join(lineas)
+            embed.add_field(
+                name="🔥 Canales más activos",
+                value=valor[:1020] + "..." if len(valor) > 1024 else valor,
+                inline=False
+            )
+        
+        if lote['errores']:
+            valor = '\n'.join(f"**{c.numero}.** {c.nombre[:40]}: {error[:60]}" for c, error in lote['errores'][:5])
+            embed.add_field(name="❌ Errores", value=valor[:1024], inline=False)
+        
+        embed.set_footer(text="Usa @Observer analiza canal [número] para ver el detalle de un canal")
+        return embed
+    
+    def crear_embed_foro(self, informe: Dict) -> discord.Embed:
+        """Crea un embed con el informe combinado de todos los hilos de un foro"""
+        embed = discord.Embed(
+            title=f"📂 Informe del foro: {informe['canal_nombre']}",
+            description=f"**{informe['hilos_analizados']}/{informe['total_hilos']} hilos** analizados en {informe['duracion']:.0f} s",
+            color=0x5865F2
+        )
+        
+        embed.add_field(
+            name="📈 Estadísticas",
+            value=f"• **Mensajes totales**: {informe['total_mensajes_revisados']:,}\n"
+                  f"• **Usuarios únicos**: {len(informe['lista_usuarios'])}\n"
+                  f"• **Personajes de RP**: {len(informe['lista_personajes'])}\n"
+                  f"• **Eventos detectados**: {informe['num_eventos']}\n"
+                  f"• **Desde caché**: {informe['desde_cache']}",
+            inline=False
+        )
+        
+        if informe['lista_personajes']:
+            valor = ', '.join(informe['lista_personajes'])
+            embed.add_field(
+                name="🎭 Personajes",
+                value=valor[:1020] + "..." if len(valor) > 1024 else valor,
+                inline=False
+            )
+        
+        if informe['elementos_mundo']:
+            valor = ', '.join(informe['elementos_mundo'][:20])
+            embed.add_field(
+                name="🌍 Elementos del mundo",
+                value=valor[:1020] + "..." if len(valor) > 1024 else valor,
+                inline=False
+            )
+        
+        if informe['eventos']:
+            lineas = []
+            for evento in informe['eventos'][:8]:
+                desc = evento.get('descripcion', '')[:60]
+                if evento.get('mensaje_url'):
+                    desc = f"[{desc}]({evento['mensaje_url']})"
+                lineas.append(f"• **{evento['hilo'][:25]}**: {desc}")
+            valor = '\n'.join(lineas)
+            embed.add_field(
+                name="📅 Eventos destacados",
+                value=valor[:1020] + "..." if len(valor) > 1024 else valor,
+                inline=False
+            )
+        
+        if informe['hilos_activos']:
+            valor = '\n'.join(f"🧵 {nombre[:40]} — {eventos} eventos" for nombre, eventos in informe['hilos_activos'][:8])
+            embed.add_field(name="🔥 Hilos más activos", value=valor[:1024], inline=False)
+        
+        if informe['errores']:
+            valor = '\n'.join(f"{nombre[:40]}: {error[:60]}" for nombre, error in informe['errores'][:5])
+            embed.add_field(name="❌ Errores", value=valor[:1024], inline=False)
+        
+        embed.set_footer(text="Usa el menú desplegable para ver el detalle de un hilo")
+        return embed
+    
+    async def comando_analizar_lote(self, message: discord.Message, contenido: str):
+        """Analiza todos los canales de una categoría o del servidor"""
+        coincidencia = re.search(r'\bcategor[ií]a\s+(.+)$', contenido, re.IGNORECASE)
+        if coincidencia:
+            categoria = coincidencia.group(1).strip()
+            canales = self.analyzer.canales_de_categoria(message.guild.id, categoria)
+            titulo = f"categoría {categoria}"
+            
+            if not canales:
+                categorias = sorted({c.categoria for c in self.analyzer.canales_mapeados.get(message.guild.id, {}).values() if c.categoria})
+                await message.channel.send(
+                    f"❌ No encontré canales en la categoría **'{categoria}'**.\n\n"
+                    f"**Categorías disponibles:** {', '.join(categorias[:25]) or 'ninguna'}"
+                )
+                return
+        else:
+            canales = [c for c in self.analyzer.canales_mapeados.get(message.guild.id, {}).values() if c.tipo != 'foro']
+            titulo = message.guild.name
+        
+        status_msg = await message.channel.send(f"📦 **Iniciando análisis por lotes** de {len(canales)} canales ({titulo})...")
+        
+        try:
+            lote = await self.analyzer.analizar_lote(message.guild, canales, status_msg)
+            await status_msg.edit(content=None, embed=self.crear_embed_lote(lote, titulo))
+        except Exception as e:
+            await status_msg.edit(content=f"❌ Error en el análisis por lotes: {str(e)}")
+            print(f"Error en análisis por lotes: {e}")
+            import traceback
+            traceback.print_exc()
+    
+    async def comando_metricas(self, message: discord.Message):
+        """Muestra p50/p95 por etapa y el estado de cachés y cola (solo administradores)"""
+        if not message.author.guild_permissions.administrator:
+            await message.channel.send("❌ Solo los administradores pueden ver las métricas.")
+            return
+        
+        embed = discord.Embed(
+            title="📈 Métricas de rendimiento",
+            description=f"Últimas {METRICAS_VENTANA} mediciones por etapa",
+            color=0x5865F2
+        )
+        
+        lineas = [
+            f"`{etapa[:22]:<22}` p50 **{valores['p50'] * 1000:,.0f} ms** • p95 **{valores['p95'] * 1000:,.0f} ms** ({valores['cantidad']})"
+            for etapa, valores in metricas.resumen().items()
+        ]
+        valor = '\n'.join(lineas) or "Todavía no hay mediciones"
+        embed.add_field(name="⏱️ Etapas", value=valor[:1020] + "..." if len(valor) > 1024 else valor, inline=False)
+        
+        cache_ia = self.analyzer.cache_ia.estadisticas()
+        resultados_cache = {
+            dict(etiquetas).get('resultado'): valor
+            for (nombre, etiquetas), valor in metricas.contadores.items() if nombre == 'cache_analisis'
+        }
+        consultas = sum(resultados_cache.values())
+        embed.add_field(
+            name="♻️ Cachés",
+            value=f"• **Análisis vigentes**: {resultados_cache.get('acierto', 0) / consultas if consultas else 0:.0%} "
+                  f"({resultados_cache.get('incremental', 0):g} incrementales)\n"
+                  f"• **Respuestas IA**: {cache_ia['tasa_aciertos']:.0%} • {cache_ia['tokens_ahorrados']:,} tokens ahorrados",
+            inline=False
+        )
+        embed.add_field(
+            name="⚙️ Estado",
+            value=f"• **Análisis en curso**: {metricas.indicadores.get('analisis_en_curso', 0):g}\n"
+                  f"• **Peticiones IA en cola**: {self.analyzer.llm.limitador.en_cola}\n"
+                  f"• **Retraso del event loop**: {metricas.indicadores.get('retraso_event_loop_segundos', 0) * 1000:.1f} ms",
+            inline=False
+        )
+        if METRICAS_PUERTO:
+            embed.set_footer(text=f"Prometheus: http://127.0.0.1:{METRICAS_PUERTO}/metrics")
+        
+        await message.channel.send(embed=embed)
+    
+    async def comando_exportar_canal(self, message: discord.Message, contenido: str):
+        """Exporta el historial de un canal a observer_data/csv (solo administradores).
+        
+        Continúa desde el último mensaje exportado salvo que se pida
+        `desde cero`; con `comprimido` o `gzip` las partes se guardan en .csv.gz.
+        """
+        if not message.author.guild_permissions.administrator:
+            await message.channel.send("❌ Solo los administradores pueden exportar historiales.")
+            return
+        
+        contenido_lower = contenido.lower()
+        comprimir = EXPORTAR_GZIP or bool(re.search(r'\bcomprimid[oa]\b|\bgzip\b', contenido_lower))
+        reanudar = 'desde cero' not in contenido_lower
+        
+        if message.channel_mentions:
+            canal_info = next((c for c in self.analyzer.canales_mapeados.get(message.guild.id, {}).values()
+                               if c.id == message.channel_mentions[0].id), None)
+        else:
+            busqueda = re.sub(r'\b(exportar|exporta|el|historial|del|canal|comprimid[oa]|gzip|desde cero)\b', ' ', contenido_lower)
+            busqueda = ' '.join(busqueda.split())
+            canal_info = self.analyzer.buscar_canal(message.guild.id, busqueda) if busqueda else None
+        
+        if not canal_info:
+            await message.channel.send("❓ ¿Qué canal quieres exportar? Ejemplo: `@Observer exporta canal 21`")
+            return
+        
+        channel = message.guild.get_channel_or_thread(canal_info.id)
+        if channel is None or isinstance(channel, (discord.ForumChannel, discord.CategoryChannel)):
+            await message.channel.send(f"❌ No puedo exportar el historial de {canal_info.nombre}.")
+            return
+        if channel.id in self.exportador.en_curso:
+            await message.channel.send(f"⏳ Ya se está exportando #{channel.name}.")
+            return
+        
+        status_msg = await message.channel.send(f"📤 **Iniciando exportación** de #{channel.name}...")
+        progreso = ReportadorProgreso(status_msg)
+        self.exportador.en_curso.add(channel.id)
+        try:
+            resultado = await self.exportador.exportar(channel, canal_info.numero, comprimir, reanudar, progreso)
+            
+            eventos = 0
+            analisis = await self.analyzer.analisis_cache.obtener(channel.id)
+            if analisis and 'error' not in analisis:
+                eventos = await self.exportador.exportar_eventos(channel, canal_info.numero, analisis)
+            
+            archivos = resultado['archivos']
+            lineas = [
+                f"✅ **Exportación de #{channel.name} completada** en {resultado['segundos']:.1f}s",
+                f"📈 {resultado['nuevos']:,} mensajes nuevos • {resultado['mensajes']:,} en total"
+            ]
+            if archivos:
+                lineas.append(f"📁 {len(archivos)} partes: `{archivos[0]}`" + (f" ... `{archivos[-1]}`" if len(archivos) > 1 else ""))
+            if eventos:
+                lineas.append(f"🎯 {eventos} eventos en `canal{canal_info.numero}_eventos.csv`")
+            await progreso.finalizar('\n'.join(lineas))
+        except discord.Forbidden:
+            await progreso.finalizar("❌ No tengo permisos para leer el historial de ese canal.")
+        except Exception as e:
+            await progreso.finalizar(f"❌ Error al exportar: {str(e)}")
+            print(f"Error en exportación: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            self.exportador.en_curso.discard(channel.id)
+    
+    async def comando_consumo(self, message: discord.Message, contenido: str):
+        """Muestra los canales que más gastan en IA y fija el presupuesto diario (solo administradores).
+        
+        `presupuesto N` fija N tokens diarios para el servidor (0 = sin límite).
+        """
+        if not message.author.guild_permissions.administrator:
+            await message.channel.send("❌ Solo los administradores pueden ver el consumo de IA.")
+            return
+        
+        consumo = self.analyzer.consumo
+        guild_id = message.guild.id
+        nuevo = re.search(r'\bpresupuesto\s+(\d[\d.,]*)', contenido)
+        if nuevo:
+            await consumo.fijar_presupuesto(guild_id, int(re.sub(r'[.,]', '', nuevo.group(1))))
+        
+        dias = 7
+        filas = await consumo.mayores_consumidores(guild_id, dias=dias)
+        presupuesto = consumo.presupuesto(guild_id)
+        usado = consumo.tokens_hoy.get(guild_id, 0)
+        estado = {'normal': '🟢 normal', 'reducido': '🟡 reducido', 'solo_cache': '🔴 solo caché'}[consumo.modo(guild_id)]
+        
+        embed = discord.Embed(
+            title="💸 Consumo de IA",
+            description=f"**Hoy**: {usado:,} tokens de {f'{presupuesto:,}' if presupuesto else '∞'} • Modo {estado}",
+            color=0xFEE75C
+        )
+        lineas = []
+        for _, channel_id, llamadas, tokens, costo, segundos in filas:
+            canal = message.guild.get_channel_or_thread(channel_id)
+            nombre = canal.name if canal else str(channel_id)
+            lineas.append(f"• **#{nombre[:25]}**: {tokens:,} tokens • ${costo:.4f} • {llamadas} llamadas • {segundos / llamadas:.1f} s/llamada")
+        valor = '\n'.join(lineas) or "Todavía no hay consultas registradas"
+        embed.add_field(name=f"📊 Canales con más gasto ({dias} días)",
+                        value=valor[:1020] + "..." if len(valor) > 1024 else valor, inline=False)
+        embed.set_footer(text=f"Precio por millón de tokens: ${PRECIO_ENTRADA_1M} entrada • ${PRECIO_SALIDA_1M} salida • "
+                              f"@Observer presupuesto [tokens] para cambiar el límite")
+        
+        await message.channel.send(embed=embed)
+    
     async def comando_listar_canales(self, message: discord.Message):
         """Lista TODOS los canales disponibles"""
         
@@ -1328,9 +4077,12 @@ class ObserverBot(commands.Bot):
         canales_por_embed = 20
         total_embeds = (len(canales) + canales_por_embed - 1) // canales_por_embed
         
+        numeros = sorted(canales)  # Puede haber huecos si se eliminaron canales
+        
         for embed_num in range(total_embeds):
             inicio = embed_num * canales_por_embed
             fin = min(inicio + canales_por_embed, len(canales))
+            numeros_pagina = numeros[inicio:fin]
             
             embed = discord.Embed(
                 title=f"📋 Lista Completa de Canales ({embed_num + 1}/{total_embeds})",
@@ -1340,28 +4092,27 @@ class ObserverBot(commands.Bot):
             
             # Dividir en columnas
             canales_texto = []
-            for num in range(inicio + 1, fin + 1):
-                if num in canales:
-                    canal = canales[num]
-                    tipo_icon = "💬" if canal.tipo == "texto" else "📂" if canal.tipo == "foro" else "🧵"
-                    canales_texto.append(f"{tipo_icon} **{num}.** {canal.nombre}")
+            for num in numeros_pagina:
+                canal = canales[num]
+                tipo_icon = "💬" if canal.tipo == "texto" else "📂" if canal.tipo == "foro" else "🧵"
+                canales_texto.append(f"{tipo_icon} **{num}.** {canal.nombre}")
             
             # Dividir en dos columnas si hay muchos
             if len(canales_texto) > 10:
                 mitad = len(canales_texto) // 2
                 embed.add_field(
-                    name=f"Canales {inicio + 1}-{inicio + mitad}",
+                    name=f"Canales {numeros_pagina[0]}-{numeros_pagina[mitad - 1]}",
                     value='\n'.join(canales_texto[:mitad]),
                     inline=True
                 )
                 embed.add_field(
-                    name=f"Canales {inicio + mitad + 1}-{fin}",
+                    name=f"Canales {numeros_pagina[mitad]}-{numeros_pagina[-1]}",
                     value='\n'.join(canales_texto[mitad:]),
                     inline=True
                 )
             else:
                 embed.add_field(
-                    name=f"Canales {inicio + 1}-{fin}",
+                    name=f"Canales {numeros_pagina[0]}-{numeros_pagina[-1]}",
                     value='\n'.join(canales_texto),
                     inline=False
                 )
@@ -1391,7 +4142,12 @@ class ObserverBot(commands.Bot):
         embed.add_field(
             name="📌 Comandos Principales",
             value="• `@Observer analiza canal [número/nombre]`\n"
+                  "• `@Observer analiza categoría [nombre]`\n"
+                  "• `@Observer analiza todo el servidor`\n"
                   "• `@Observer lista todos los canales`\n"
+                  "• `@Observer métricas` (administradores)\n"
+                  "• `@Observer consumo` / `presupuesto [tokens]` (administradores)\n"
+                  "• `@Observer exporta canal [número]` (administradores)\n"
                   "• `@Observer ayuda`",
             inline=False
         )
@@ -1429,7 +4185,7 @@ class ObserverBot(commands.Bot):
         embed.add_field(
             name="⚡ Tips",
             value="• Puedo buscar por **número** de canal o por **nombre**\n"
-                  "• Los análisis se guardan en caché por 30 minutos\n"
+                  f"• Los análisis se guardan en caché por {CACHE_TTL_MINUTOS} minutos\n"
                   "• Incluyo links directos a eventos importantes\n"
                   "• Proceso hasta 2000 mensajes por canal\n"
                   "• Para foros, te muestro todos los hilos disponibles",